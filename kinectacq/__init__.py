@@ -3,3 +3,22 @@ from . import paths
 from . import video_io
 from . import visualization
 from . import interrupt_handler
+from . import shared_memory
+from . import queues
+from . import telemetry
+from . import simulation
+from . import benchmark
+from . import frame_log
+from . import video_reader
+from . import frame_index
+from . import chunked
+from . import preprocessing
+from . import range_mapping
+from . import alignment
+from . import capture
+from . import resources
+from . import encoder_tuning
+from . import segments
+from . import archive
+from . import catalog
+from . import controller
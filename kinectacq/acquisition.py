@@ -2,22 +2,35 @@
 Acquisition - functions for recording from azure
 """
 
-import datetime, subprocess, numpy as np, time, sys
-from multiprocessing import Process, Queue
+import json, subprocess, numpy as np, time, sys
+from multiprocessing import Event, Process, Queue
+from threading import BrokenBarrierError, Thread
 from tqdm.auto import tqdm
 
-from pyk4a import (
-    PyK4A,
-    Config,
-    ColorResolution,
-    DepthMode,
-    WiredSyncMode,
-)
+try:
+    from pyk4a import (
+        PyK4A,
+        Config,
+        ColorResolution,
+        DepthMode,
+        WiredSyncMode,
+    )
+except ImportError:
+    # without the Azure Kinect SDK, only simulated devices can be recorded from
+    PyK4A = Config = ColorResolution = DepthMode = WiredSyncMode = None
 
 
-from kinectacq.video_io import write_images
-from kinectacq.visualization import display_images
+from kinectacq.video_io import write_stream
+from kinectacq.visualization import display_previews, make_preview
 from kinectacq.paths import ensure_dir
+from kinectacq.shared_memory import FrameRingBuffer, FrameMailbox
+from kinectacq.queues import FrameQueue, StreamRouter
+from kinectacq.telemetry import Telemetry, summarize_session
+from kinectacq.simulation import SimulatedK4A
+from kinectacq.frame_log import FrameLog
+from kinectacq.preprocessing import PreprocessStage, PREPROCESS_WORKERS
+from kinectacq.capture import CaptureThread
+from kinectacq.resources import set_affinity
 
 def identity(x):
     return x
@@ -39,16 +52,38 @@ def capture_from_azure(
     depth_dtype=np.uint8,
     ir_dtype=np.uint8,
     ir_display_fcn=identity,
+    depth_display_fcn=None,
     depth_write_frames_kwargs={},
     ir_write_frames_kwargs={},
     color_write_frames_kwargs={},
     pbar_device=None,
+    transport="queue",
+    ring_buffer_slots=64,
+    image_queue_maxsize=0,
+    image_queue_policy="block",
+    display_mailboxes=None,
+    display_max_fps=15,
+    writer_workers="process",
+    stream_priority=("depth", "ir", "color"),
+    telemetry=False,
+    telemetry_interval=1.0,
+    preprocess_workers="thread",
+    n_preprocess_workers=2,
+    preprocess_max_pending=None,
+    ready_event=None,
+    wait_for=(),
+    start_barrier=None,
+    startup_timeout=60,
+    capture_buffer_slots=8,
+    core_plan=None,
+    stop_event=None,
+    status=None,
 ):
     """Continuously captures data from Azure Kinect camera and writes to frames.
 
 
     Args:
-        k4a (k4a object): Camera K4A object
+        k4a (k4a object): Camera K4A object, or a SimulatedK4A
         filename_prefix (pathlib2.path): File storage location
         recording_duration (float): [recording duration (seconds)]
         save_color (bool, optional): Whether to save the color data. Defaults to False.
@@ -60,152 +95,394 @@ def capture_from_azure(
         display_resolution_downsample (int, optional): How much to downsample display resolution. Defaults to 2
         display_frequency (int, optional): How frequently to display frames. Defaults to 2
         display_time_frequency (int, optional): How frequently to display time. Defaults to 15
-        samplerate (int, optional): Samplerate of camera in Hz. Defaults to 30
+        ir_display_fcn (function, optional): Function converting ir frames for display,
+            e.g. a range_mapping.RangeMap, which is then applied together with the
+            downsampling. Defaults to identity.
+        depth_display_fcn (function, optional): Function converting depth frames for
+            display. Defaults to None, scaling each preview to its own range.
+        samplerate (int, optional): Samplerate of camera in Hz, saved in the frame
+            log. Defaults to 30
+        depth_write_frames_kwargs, ir_write_frames_kwargs, color_write_frames_kwargs
+            (dict, optional): Writer settings of each stream. "backend" selects
+            "ffmpeg" (default), "raw", "chunked" (lossless 16-bit depth) or "null",
+            see video_io.make_writer. With "segment_frames" or "segment_seconds",
+            ffmpeg streams are written in segments with a manifest, see
+            video_io.FrameWriter and segments.
+        transport (str, optional): How frames are passed to the writer process,
+            "queue" (multiprocessing.Queue) or "shared_memory" (FrameRingBuffer).
+            Defaults to "queue".
+        ring_buffer_slots (int, optional): Number of frames held by the shared
+            memory ring buffer. Defaults to 64.
+        image_queue_maxsize (int, optional): Maximum number of frames waiting to be
+            written per stream, 0 for no limit. Defaults to 0.
+        image_queue_policy (str, optional): What to do with new frames when a stream's
+            queue is full: "block", "drop_oldest", "drop_newest" or "spill" (to disk).
+            Only "block" and "drop_newest" work with shared memory. Defaults to "block".
+        display_mailboxes (dict, optional): shared_memory.FrameMailbox per stream that
+            previews are written to, shown by a compositor shared by all devices (see
+            start_recording). Defaults to None, opening a window for this device if
+            display_frames.
+        display_max_fps (int, optional): Refresh rate of the window opened for this
+            device. Defaults to 15.
+        writer_workers (str, optional): Whether each stream is written by its own
+            "process" or "thread". Defaults to "process".
+        stream_priority (tuple, optional): Streams from most to least important. When
+            the writers fall behind, the least important streams are dropped first.
+            Defaults to ("depth", "ir", "color").
+        telemetry (bool, optional): Whether the capture process and each writer
+            periodically save timing, queue depth, throughput and CPU/memory use to
+            telemetry_*.jsonl files in filename_prefix. Defaults to False.
+        telemetry_interval (float, optional): Seconds between telemetry samples.
+            Defaults to 1.0.
+        preprocess_workers (str, optional): Where depth_function, ir_function and
+            color_function run: a pool of "thread"s or "process"es (functions must
+            be picklable), or "inline" in the capture loop. Frames stay in order
+            either way. Defaults to "thread".
+        n_preprocess_workers (int, optional): Size of the preprocessing pool.
+            Defaults to 2.
+        preprocess_max_pending (int, optional): Captures being preprocessed at once,
+            beyond which the capture loop waits. Defaults to 4 * n_preprocess_workers.
+        ready_event (multiprocessing.Event, optional): Set once the camera has
+            started. Defaults to None.
+        wait_for (tuple, optional): Events (of other devices) to wait for before
+            starting the camera, e.g. a master waits for its subordinates.
+            Defaults to ().
+        start_barrier (multiprocessing.Barrier, optional): Shared by all devices,
+            so that capture only begins once every device has started. Defaults
+            to None.
+        startup_timeout (float, optional): Seconds to wait for other devices
+            before giving up. Defaults to 60.
+        capture_buffer_slots (int, optional): Recycled buffers per stream that the
+            capture thread copies images into. Defaults to 8.
+        core_plan (dict, optional): CPU cores of this device's capture loop, of its
+            preprocessing pool, and of each stream's writer and encoder, from
+            resources.plan_cores. Defaults to None (not pinned).
+        stop_event (multiprocessing.Event, optional): Set to stop recording before
+            recording_duration, within a frame period. Defaults to None.
+        status (controller.DeviceStatus, optional): Where the state and frame
+            counts of this device are published while recording. Defaults to None.
     """
 
-    # initialize the queue to write images to videos
-    image_queue = Queue()
-    write_process = Process(
-        target=write_images,
-        args=(
-            image_queue,
-            filename_prefix,
-            ir_dtype,
-            depth_dtype,
-            save_color,
-            ir_write_frames_kwargs,
-            depth_write_frames_kwargs,
-            color_write_frames_kwargs,
-            pbar_device,
-        ),
-    )
-    write_process.start()
+    if transport not in ["queue", "shared_memory"]:
+        raise ValueError("transport {} has not been defined".format(transport))
+    if writer_workers not in ["process", "thread"]:
+        raise ValueError("writer_workers {} has not been defined".format(writer_workers))
+    if preprocess_workers not in PREPROCESS_WORKERS:
+        raise ValueError(
+            "preprocess_workers {} has not been defined".format(preprocess_workers)
+        )
 
-    # Initialize the queue to display images on screen
-    if display_frames:
-        display_queue = Queue()
-        display_process = Process(target=display_images, args=(display_queue,ir_display_fcn))
-        display_process.start()
+    # threads and processes started from here on inherit the affinity, except
+    #   the preprocessing pool, which is pinned to cores of its own
+    if core_plan is not None:
+        set_affinity(core_plan["capture"])
+
+    stream_names = ["ir", "depth"] + (["color"] if save_color else [])
+    stream_settings = {
+        "ir": {"video_dtype": ir_dtype, "write_frames_kwargs": ir_write_frames_kwargs},
+        "depth": {
+            "video_dtype": depth_dtype,
+            "write_frames_kwargs": depth_write_frames_kwargs,
+        },
+        "color": {
+            "video_dtype": np.uint8,
+            "pixel_format": "rgb24",
+            "write_frames_kwargs": color_write_frames_kwargs,
+        },
+    }
+    Worker = Process if writer_workers == "process" else Thread
+
+    def start_writer(stream, stream_queue):
+        """Start a worker writing one stream, and route its frames to it"""
+        router.add(stream, stream_queue)
+        writers[stream] = Worker(
+            target=write_stream,
+            args=(stream_queue, filename_prefix / "{}.avi".format(stream)),
+            kwargs=dict(
+                stream_settings[stream],
+                pbar_device=pbar_device if stream == "depth" else None,
+                telemetry_path=filename_prefix / "telemetry_{}.jsonl".format(stream)
+                if telemetry
+                else None,
+                telemetry_interval=telemetry_interval,
+                device_clock=getattr(k4a, "device_clock", None),
+                cores=core_plan["streams"][stream]["cores"] if core_plan else None,
+            ),
+        )
+        writers[stream].start()
+        if telemetry and writer_workers == "process":
+            capture_telemetry.watch_process(
+                "{}_writer".format(stream), writers[stream].pid
+            )
 
-    # initialize K4A object
-    k4a.start()
+    capture_telemetry = None
+    if telemetry:
+        capture_telemetry = Telemetry(
+            filename_prefix / "telemetry_capture.jsonl",
+            interval=telemetry_interval,
+            name="{} capture".format(filename_prefix.stem),
+        )
 
-    # announce that the camera has been successfully initialized
-    print("capture_from_azure initialized: {} ".format(filename_prefix.stem))
+    # initialize a queue and writer for each stream. Shared memory ring
+    #   buffers are sized from the first frame, so they are created in the loop
+    router = StreamRouter(priority=stream_priority)
+    writers = {}
+    if transport == "queue":
+        for stream in stream_names:
+            start_writer(
+                stream,
+                FrameQueue(
+                    Queue(maxsize=image_queue_maxsize),
+                    policy=image_queue_policy,
+                    spill_dir=filename_prefix / "spill" / stream,
+                    name="{} queue ({})".format(stream, filename_prefix.stem),
+                    maxsize=image_queue_maxsize,
+                ),
+            )
+    if telemetry:
+        # the gauges read a copy of the queues, as the dispatcher thread adds
+        #   shared memory queues while the telemetry thread samples them
+        capture_telemetry.gauge(
+            "queue_depth",
+            function=lambda: {
+                stream: stream_queue.qsize()
+                for stream, stream_queue in list(router.queues.items())
+            },
+        )
+        capture_telemetry.gauge(
+            "dropped",
+            function=lambda: {
+                stream: stream_queue.n_dropped
+                for stream, stream_queue in list(router.queues.items())
+            },
+        )
 
-    # pre-allocate an array of timestamps (overallocate to ensure no errors)
-    n_samples = int(np.ceil(samplerate * (recording_duration * 1.5)))
-    system_timestamps = np.zeros(n_samples, dtype=np.uint64)
-    depth_timestamps = np.zeros(n_samples, dtype=np.uint64)
-    ir_timestamps = np.zeros(n_samples, dtype=np.uint64)
-    if save_color:
-        color_timestamps = np.zeros(n_samples, dtype=np.uint64)
+    # the frame log holds the timestamps of every frame, and notes that this
+    #   device is still writing until it is closed
+    frame_log = FrameLog(
+        filename_prefix / "frame_log.bin",
+        stream_names,
+        metadata={"device": filename_prefix.stem, "samplerate": samplerate},
+    )
+
+    # previews are written to mailboxes that only hold the newest frame, and
+    #   shown by a compositor. Without mailboxes from start_recording, this
+    #   device opens its own window
+    display_process = None
+    if display_frames and display_mailboxes is None:
+        display_mailboxes = {stream: FrameMailbox() for stream in stream_names}
+        display_stop = Event()
+        display_process = Process(
+            target=display_previews,
+            args=(
+                {
+                    (filename_prefix.stem, stream): mailbox
+                    for stream, mailbox in display_mailboxes.items()
+                },
+                display_stop,
+            ),
+            kwargs={"max_fps": display_max_fps},
+        )
+        display_process.start()
+    previews = {}
+    if display_frames:
+        display_fcns = {"ir": ir_display_fcn, "depth": depth_display_fcn}
+        previews = {
+            stream: make_preview(display_fcns.get(stream), display_resolution_downsample)
+            for stream in display_mailboxes
+        }
+
+    def deliver(frames, timestamps):
+        """Put preprocessed frames on the stream queues, to save, and display them"""
+        t0 = time.perf_counter_ns()
+        if transport == "shared_memory":
+            for stream, frame in frames.items():
+                if stream not in writers and frame is not None:
+                    start_writer(
+                        stream,
+                        FrameQueue(
+                            FrameRingBuffer((frame,), n_slots=ring_buffer_slots),
+                            policy=image_queue_policy,
+                            name="{} queue ({})".format(stream, filename_prefix.stem),
+                        ),
+                    )
+        router.put(frames, timestamps)
+        if telemetry:
+            capture_telemetry.record("enqueue", t0)
+
+        # every n frames, replace the previews
+        if previews and n_delivered[0] % display_frequency == 0:
+            for stream, preview in previews.items():
+                if frames.get(stream) is not None:
+                    display_mailboxes[stream].put(
+                        preview(frames[stream]), timestamp=timestamps[stream]
+                    )
+        n_delivered[0] += 1
+
+    # depth_function, ir_function and color_function run on a pool of workers,
+    #   so that the capture loop only grabs frames and timestamps. Frames
+    #   already have these dtypes, cast by the capture thread while copying
+    capture_dtypes = {"ir": np.uint16, "depth": np.int16, "color": np.uint8}
+    n_delivered = [0]
+    preprocess = PreprocessStage(
+        {
+            "depth": (np.int16, depth_function),
+            "ir": (np.uint16, ir_function),
+            "color": (np.uint8, color_function),
+        },
+        deliver,
+        workers=preprocess_workers,
+        n_workers=n_preprocess_workers,
+        max_pending=preprocess_max_pending,
+        telemetry=capture_telemetry,
+        name="preprocess ({})".format(filename_prefix.stem),
+        cores=None if core_plan is None else core_plan["preprocess"],
+    )
 
     start_time = time.time()
     count = 0
+    capture_thread = None
 
     try:
-        # loop while computer time is less than recording length
-        while time.time() - start_time < recording_duration:
+        # with wired sync, subordinates must run before the master starts, and
+        #   all devices wait for each other, so that recordings start together
+        t0 = time.perf_counter()
+        for event in wait_for:
+            if not event.wait(startup_timeout):
+                raise TimeoutError("timed out waiting for other devices to start")
+        t_waited = time.perf_counter() - t0
+
+        # initialize K4A object
+        k4a.start()
+        t_started = time.perf_counter() - t0 - t_waited
+        if ready_event is not None:
+            ready_event.set()
+        if start_barrier is not None:
+            try:
+                start_barrier.wait(startup_timeout)
+            except BrokenBarrierError:
+                raise TimeoutError("timed out waiting for other devices to start")
+
+        # announce that the camera has been successfully initialized
+        print(
+            "capture_from_azure initialized: {} (started in {:.3f}s, waited {:.3f}s "
+            "for other devices)".format(
+                filename_prefix.stem,
+                t_started,
+                time.perf_counter() - t0 - t_started,
+            )
+        )
+        start_time = time.time()
+        if status is not None:
+            status.set_state("recording")
+
+        # get_capture runs on its own thread, which copies each image once
+        #   into a recycled buffer
+        capture_thread = CaptureThread(
+            k4a,
+            {stream: capture_dtypes[stream] for stream in stream_names},
+            n_slots=capture_buffer_slots,
+            telemetry=capture_telemetry,
+        )
+        capture_thread.start()
+
+        # loop while computer time is less than recording length, or until stopped
+        n_dropped = 0
+        while time.time() - start_time < recording_duration and not (
+            stop_event is not None and stop_event.is_set()
+        ):
             # get output of device
-            capture = k4a.get_capture()
+            system_ns, frames, timestamps = capture_thread.get()
+            t0 = time.perf_counter_ns()
 
             # if there is no depth data, this frame is dropped, so skip it
-            if capture.ir is None:
-                print("Dropped frame: ir")
-
-            if capture.depth is None:
-                print("Dropped frame: depth")
-
-            if save_color:
-                if capture.color is None:
-                    print("Dropped frame: color")
-
-            # grab and save the timestamps for this frame
-            system_timestamps[count] = time.time_ns()
-            ir_timestamps[count] = capture._depth_timestamp_usec
-            depth_timestamps[count] = capture._ir_timestamp_usec
-            if save_color:
-                color_timestamps[count] = capture._color_timestamp_usec
-
-            # grab depth data
-            depth = capture.depth.astype(np.int16)
-            ir = capture.ir.astype(np.uint16)
-            if save_color:
-                color = capture.color
-
-            # preprocess depth data
-            if (depth is not None) & (depth_function is not None):
-                depth = depth_function(depth)
-
-            # preprocess IR data
-            if (ir is not None) & (ir_function is not None):
-                ir = ir_function(ir)
-
-            # save color information
-            if save_color:
-                if color is not None:
-                    color = color.astype(np.uint8)
-                    if color_function is not None:
-                        color = color_function(color)
-
-            # get timestamps
-            if save_color:
-                capture._color_timestamp_usec
-
-            # add IR and depth data to image queue, to save
-            if save_color:
-                image_queue.put((ir, depth, color))
-            else:
-                image_queue.put((ir, depth))
-
-            # every n frames, write to display
-            # TODO add freq as variable
-            if display_frames and count % display_frequency == 0:
-                display_queue.put(
-                    (
-                        ir[
-                            ::display_resolution_downsample,
-                            ::display_resolution_downsample,
-                        ],
-                    )
-                )
+            for stream, frame in frames.items():
+                if frame is None:
+                    print("Dropped frame: {}".format(stream))
+                    n_dropped += 1
+
+            # log the timestamps for this frame
+            frame_log.append(
+                system_ns,
+                timestamps,
+                dropped={stream: frame is None for stream, frame in frames.items()},
+            )
+
+            # preprocess and queue the frames off the capture loop
+            preprocess.put(frames, timestamps)
+            for stream, dropped in router.pop_dropped().items():
+                frame_log.mark_dropped(stream, dropped)
+            if telemetry:
+                capture_telemetry.record("submit", t0)
+                capture_telemetry.count("frames_captured")
+                capture_telemetry.maybe_sample()
 
             count += 1
+            if status is not None:
+                status.update(count, n_dropped)
 
-    except (OSError, KeyboardInterrupt):
+    except (OSError, KeyboardInterrupt) as error:
         print("Recording stopped early")
+        if status is not None and isinstance(error, OSError):
+            status.set_state("failed")
 
     finally:
         # stop the camera object
-        k4a.stop()
-
-        # save the system and device timestamps
-        np.save(filename_prefix / "system_timestamps.npy", system_timestamps[:count])
-        np.save(filename_prefix / "depth_timestamps.npy", depth_timestamps[:count])
-        np.save(filename_prefix / "ir_timestamps.npy", ir_timestamps[:count])
-        if save_color:
-            np.save(filename_prefix / "color_timestamps.npy", color_timestamps)
+        if capture_thread is not None:
+            capture_thread.stop()
+            if sum(capture_thread.n_misses.values()) > 0:
+                print(
+                    "Capture buffers ({}): allocated {} frames outside the pool".format(
+                        filename_prefix.stem, capture_thread.n_misses
+                    )
+                )
+        if k4a.is_running:
+            k4a.stop()
+        # the camera is free for the next session while the writers finish
+        if status is not None and status.state != "failed":
+            status.set_state("finalizing")
 
-        nsec = (np.max(system_timestamps) - np.min(system_timestamps[:count])) * 1e-9
         # output the framerate info
-        framerate = round(count / nsec, 4)
-        print("Framerate ({}):{}".format(filename_prefix.stem, framerate))
-
-        # empty tuple tells write_images to save
-        image_queue.put(tuple())
-        write_process.join()
-
-        # empty tuple tells display_images to close window
-        if display_frames:
-            display_queue.put(tuple())
+        if count > 1:
+            nsec = (frame_log.last_system_ns - frame_log.first_system_ns) * 1e-9
+            framerate = round((count - 1) / nsec, 4)
+            print("Framerate ({}):{}".format(filename_prefix.stem, framerate))
+
+        # finish preprocessing the frames in flight before closing the queues
+        preprocess.close()
+
+        # empty tuple tells each writer to finish, writers drain in parallel
+        router.close()
+        for writer in writers.values():
+            writer.join()
+        for stream, dropped in router.pop_dropped().items():
+            frame_log.mark_dropped(stream, dropped)
+        router.report()
+        if transport == "shared_memory":
+            for stream_queue in router.queues.values():
+                stream_queue.close()
+
+        # mark the log as finished
+        frame_log.close()
+
+        if telemetry:
+            capture_telemetry.close(verbose=False)
+            summarize_session(filename_prefix)
+
+        # close the window, if this device opened its own
+        if display_process is not None:
+            display_stop.set()
             display_process.join()
+            for mailbox in display_mailboxes.values():
+                mailbox.close()
 
+        if status is not None and status.state != "failed":
+            status.set_state("finished")
 
-def start_recording(
-    filename_prefix,
-    recording_duration,
-    devices={
+
+def default_devices():
+    """A single master camera recording depth and IR, with a display window"""
+    return {
         "master": {
             "id": "master",
             "pyk4a_config": {
@@ -220,7 +497,63 @@ def start_recording(
                 "display_time": False,
             },
         }
-    },
+    }
+
+
+def is_subordinate(device):
+    """Whether a device (from the devices dict) is a wired sync subordinate"""
+    mode = device.get("pyk4a_config", {}).get("wired_sync_mode")
+    return getattr(mode, "name", mode) == "SUBORDINATE"
+
+
+def prepare_device(device, device_dir, warmup=1.0):
+    """Open a device, let it warm up, and save its calibration.
+
+    Args:
+        device (dict): Config info of the device (an entry of devices)
+        device_dir (pathlib2.Path): Where calibration.json and startup.json are saved
+        warmup (float, optional): Seconds the camera runs before the calibration
+            is saved. Defaults to 1.0.
+
+    Returns:
+        k4a object: The (stopped) device, or a SimulatedK4A
+        dict: Seconds spent opening and starting the device (open_s), warming up
+            (warmup_s) and saving the calibration (calibration_s)
+    """
+    t0 = time.perf_counter()
+    if "simulation" in device:
+        k4a_obj = SimulatedK4A(
+            device.get("pyk4a_config"), device_id=device["id"], **device["simulation"]
+        )
+    else:
+        k4a_obj = PyK4A(Config(**device["pyk4a_config"]), device_id=device["id"])
+
+    # ensure a directory exists for device
+    ensure_dir(device_dir)
+
+    # save camera parameters
+    k4a_obj.start()
+    t1 = time.perf_counter()
+    time.sleep(warmup)
+    t2 = time.perf_counter()
+    k4a_obj.save_calibration_json(device_dir / "calibration.json")
+    k4a_obj.stop()
+    t3 = time.perf_counter()
+
+    startup = {
+        "open_s": round(t1 - t0, 3),
+        "warmup_s": round(t2 - t1, 3),
+        "calibration_s": round(t3 - t2, 3),
+    }
+    with open(device_dir / "startup.json", "w") as f:
+        json.dump(startup, f)
+    return k4a_obj, startup
+
+
+def start_recording(
+    filename_prefix,
+    recording_duration,
+    devices=None,
     ir_dtype=np.uint8,
     depth_dtype=np.uint8,
     ir_write_frames_kwargs={
@@ -256,86 +589,97 @@ def start_recording(
     depth_function=None,
     ir_function=None,
     ir_display_fcn = identity, 
+    transport="queue",
+    image_queue_maxsize=0,
+    image_queue_policy="block",
+    writer_workers="process",
+    stream_priority=("depth", "ir", "color"),
+    telemetry=False,
+    preprocess_workers="thread",
+    n_preprocess_workers=2,
+    display_max_fps=15,
+    warmup=1.0,
+    pin_cores=False,
+    catalog=True,
 ):
-    """Runs a recording session by running a subprocess for each camera.
+    """Runs a recording session by running a subprocess for each camera, and
+    returns once every device has finished writing. See
+    controller.RecordingController to start and stop sessions without blocking.
 
     Args:
         filename_prefix (str): Prefix of filename
         recording_duration (int): Duration to record (seconds)
-        devices (dict): Dictionary of config info for each device
-        depth_function (function): Function for processing depth data
+        devices (dict): Dictionary of config info for each device. A device with a
+            "simulation" entry is replaced by a SimulatedK4A, created with those
+            kwargs. Defaults to default_devices().
+        depth_write_frames_kwargs, ir_write_frames_kwargs, color_write_frames_kwargs
+            (dict): Writer settings of each stream. "backend" selects "ffmpeg",
+            "raw", "chunked" or "null", see video_io.make_writer
+        depth_function (function): Function for processing depth data, e.g. a
+            range_mapping.RangeMap converting it to 8-bit
         ir_function (function): Function for processing IR data
+        ir_display_fcn (function): Function converting IR data for display
+        transport (str): How frames are passed from capture to writer processes,
+            "queue" or "shared_memory"
+        image_queue_maxsize (int): Maximum number of frames waiting to be written
+            per device, 0 for no limit
+        image_queue_policy (str): What to do when the image queue is full,
+            "block", "drop_oldest", "drop_newest" or "spill"
+        writer_workers (str): Whether each stream is written by its own "process"
+            or "thread"
+        stream_priority (tuple): Streams from most to least important, the least
+            important are dropped first when writers fall behind
+        telemetry (bool): Whether to save pipeline telemetry for each device
+        preprocess_workers (str): Where depth_function and ir_function run, a pool
+            of "thread"s or "process"es, or "inline" in the capture loop
+        n_preprocess_workers (int): Size of the preprocessing pool of each device
+        display_max_fps (int): Refresh rate of the preview window, which tiles the
+            streams of every device with display_frames
+        warmup (float): Seconds each device runs before its calibration is saved.
+            Devices are opened and warmed up concurrently
+        pin_cores (bool): Whether to plan which CPU cores each capture process,
+            writer and encoder runs on (see resources.plan_cores), pin them, and
+            set the encoder threads to match
+        catalog (bool or pathlib2.Path): Session catalog the session is added to
+            once every device has finished, see controller.RecordingController
     """
 
-    process_list = []
-
-    for device_name in devices:
-
-        # Create a k4a object referencing master
-        k4a_obj = PyK4A(
-            Config(**devices[device_name]["pyk4a_config"]),
-            device_id=devices[device_name]["id"],
-        )
-
-        # create a progress bar for monitoring frame writing
-        pbar_device = tqdm(
-            total=30 * recording_duration,
-            desc="{} (frames written)".format(device_name),
-        )
-
-        # ensure a directory exists for device
-        ensure_dir(filename_prefix / device_name)
-
-        # save camera parameters
-        if True:
-            k4a_obj.start()
-            time.sleep(1)
-
-            k4a_obj.save_calibration_json(
-                filename_prefix / device_name / "calibration.json"
-            )
-            k4a_obj.stop()
-
-        # create a subprocess to run acqusition with that camera
-        process_list.append(
-            Process(
-                target=capture_from_azure,
-                args=(
-                    k4a_obj,
-                    filename_prefix / device_name,
-                    recording_duration,
-                ),
-                kwargs={
-                    "display_frames": devices[device_name]["process_kwargs"][
-                        "display_frames"
-                    ],
-                    "display_time": devices[device_name]["process_kwargs"][
-                        "display_time"
-                    ],
-                    "save_color": devices[device_name]["process_kwargs"]["save_color"],
-                    "depth_function": depth_function,
-                    "ir_display_fcn": ir_display_fcn,
-                    "ir_function": ir_function,
-                    "depth_dtype": depth_dtype,
-                    "ir_dtype": ir_dtype,
-                    "depth_write_frames_kwargs": depth_write_frames_kwargs,
-                    "ir_write_frames_kwargs": ir_write_frames_kwargs,
-                    "color_write_frames_kwargs": color_write_frames_kwargs,
-                    "pbar_device": pbar_device,
-                },
-            )
-        )
-
-    for p in process_list:
-        p.start()
-
-    start_time = time.time()
+    # the controller imports this module
+    from kinectacq.controller import RecordingController
+
+    controller = RecordingController(
+        devices,
+        warmup=warmup,
+        pin_cores=pin_cores,
+        catalog=catalog,
+        display_max_fps=display_max_fps,
+        progress=True,
+        ir_dtype=ir_dtype,
+        depth_dtype=depth_dtype,
+        ir_write_frames_kwargs=ir_write_frames_kwargs,
+        depth_write_frames_kwargs=depth_write_frames_kwargs,
+        color_write_frames_kwargs=color_write_frames_kwargs,
+        depth_function=depth_function,
+        ir_function=ir_function,
+        ir_display_fcn=ir_display_fcn,
+        transport=transport,
+        image_queue_maxsize=image_queue_maxsize,
+        image_queue_policy=image_queue_policy,
+        writer_workers=writer_workers,
+        stream_priority=stream_priority,
+        telemetry=telemetry,
+        preprocess_workers=preprocess_workers,
+        n_preprocess_workers=n_preprocess_workers,
+    )
     try:
+        controller.start(filename_prefix, recording_duration)
+        start_time = time.time()
         with tqdm(total=recording_duration, desc="Recording (s)") as pbar:
-            while time.time() - start_time < recording_duration:
-                time.sleep(1)
-                pbar.update(1)
-            pbar.close()
-        print("Finished recording: {}".format(datetime.datetime.now()))
+            while controller.is_recording:
+                time.sleep(0.1)
+                pbar.update(min(int(time.time() - start_time), recording_duration) - pbar.n)
     except KeyboardInterrupt:
         print("Exiting: KeyboardInterrupt")
+    finally:
+        # devices are stopped through their stop event, not by the interrupt
+        controller.close()
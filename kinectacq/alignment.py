@@ -0,0 +1,225 @@
+"""
+Alignment - matches the frames of every device and stream of a session to a
+common timeline, and caches the merged frame table next to the session
+"""
+
+import json, numpy as np
+from pathlib2 import Path
+
+from kinectacq.frame_log import load_frame_log
+
+ALIGNMENT_FILE = "alignment.npz"
+
+
+def load_device_timestamps(device_dir, streams=("depth", "ir")):
+    """Device and system timestamps of the frames written for each stream of
+    a device, from its frame log (or the .npy timestamps of older recordings).
+
+    Args:
+        device_dir (pathlib2.Path): Directory of the device
+        streams (tuple, optional): Streams to load. Defaults to ("depth", "ir").
+
+    Returns:
+        dict: (device timestamps (usec), system timestamps (usec)) per stream,
+            one per frame in the stream's video
+    """
+    device_dir = Path(device_dir)
+    if (device_dir / "frame_log.bin").exists():
+        frames, _ = load_frame_log(device_dir / "frame_log.bin")
+        system_usec = frames["system_ns"] // 1000
+        columns = {
+            stream: (
+                frames["{}_timestamp_usec".format(stream)],
+                frames["{}_dropped".format(stream)],
+            )
+            for stream in streams
+        }
+    else:
+        system_usec = np.load(device_dir / "system_timestamps.npy") // 1000
+        columns = {}
+        for stream in streams:
+            timestamps = np.load(device_dir / "{}_timestamps.npy".format(stream))
+            timestamps = timestamps[: len(system_usec)]
+            columns[stream] = (timestamps, timestamps == 0)
+    # frames dropped by the device or a queue are not in the video
+    return {
+        stream: (timestamps[~dropped], system_usec[~dropped])
+        for stream, (timestamps, dropped) in columns.items()
+    }
+
+
+def fit_clock(device_usec, system_usec):
+    """Linear map from a device's clock to the host clock, robust to frames
+    that reached the host late.
+
+    Returns:
+        tuple: (slope, intercept), such that system = slope * device + intercept
+    """
+    device_usec = np.asarray(device_usec, dtype=np.float64)
+    system_usec = np.asarray(system_usec, dtype=np.float64)
+    if len(device_usec) < 2:
+        return 1.0, float(np.sum(system_usec - device_usec))
+    # fit relative to the first frame, to keep the numbers small
+    x, y = device_usec - device_usec[0], system_usec - device_usec[0]
+    slope, intercept = np.polyfit(x, y, 1)
+    residual = y - (slope * x + intercept)
+    mad = np.median(np.abs(residual - np.median(residual)))
+    keep = residual <= np.median(residual) + 3 * mad + 1
+    if keep.sum() >= 2:
+        slope, intercept = np.polyfit(x[keep], y[keep], 1)
+    return float(slope), float(intercept - slope * device_usec[0] + device_usec[0])
+
+
+def match_nearest(reference, times, tolerance):
+    """Index of the nearest of times (sorted) to each reference time, -1 where
+    none is within tolerance
+    """
+    if len(times) == 0:
+        return np.full(len(reference), -1, dtype=np.int64)
+    right = np.clip(np.searchsorted(times, reference), 0, len(times) - 1)
+    left = np.maximum(right - 1, 0)
+    nearest = np.where(
+        np.abs(times[left] - reference) <= np.abs(times[right] - reference), left, right
+    )
+    nearest[np.abs(times[nearest] - reference) > tolerance] = -1
+    return nearest.astype(np.int64)
+
+
+def align_session(
+    filename_prefix,
+    streams=("depth", "ir"),
+    devices=None,
+    reference=None,
+    tolerance_usec=None,
+    cache=True,
+):
+    """Merged frame table of a session: one row per frame of a reference stream,
+    with the matching frame of every device and stream.
+
+    The device clocks are mapped onto the host clock (each frame log holds both
+    clocks), and frames are matched with a sorted search for the nearest
+    timestamp, so millions of frames align in about a second. The table is
+    saved as alignment.npz in the session directory, and loaded from there
+    while it is newer than every frame log and was made with the same settings.
+
+        table, metadata = align_session(session_dir)
+        complete = table[~table["missing"].any(axis=1)]
+        depth_frames = table["frame"][:, metadata["columns"].index("master/depth")]
+
+    Args:
+        filename_prefix (pathlib2.Path): Session directory, holding a directory
+            per device
+        streams (tuple, optional): Streams to align. Defaults to ("depth", "ir").
+        devices (list, optional): Device names. Defaults to every directory with
+            a frame log (or timestamps).
+        reference (tuple, optional): (device, stream) whose frames form the rows.
+            Defaults to the first device and stream.
+        tolerance_usec (float, optional): Furthest a match can be from the reference
+            frame. Defaults to half of the median reference frame interval.
+        cache (bool, optional): Whether to load and save alignment.npz. Defaults to True.
+
+    Returns:
+        np.array: Table with fields time_usec (host clock), and frame (video frame
+            index, -1 if missing), offset_usec and missing, each with a column per
+            device and stream
+        dict: metadata, with columns ("device/stream"), reference, tolerance_usec,
+            and the clock fit (slope, intercept) of each device
+    """
+    filename_prefix = Path(filename_prefix)
+    if devices is None:
+        devices = sorted(
+            path.name
+            for path in filename_prefix.iterdir()
+            if (path / "frame_log.bin").exists()
+            or (path / "system_timestamps.npy").exists()
+        )
+    if reference is None:
+        reference = (devices[0], streams[0])
+    settings = {
+        "streams": list(streams),
+        "devices": list(devices),
+        "reference": list(reference),
+        "tolerance_usec": tolerance_usec,
+    }
+
+    cache_path = filename_prefix / ALIGNMENT_FILE
+    if cache and cache_path.exists():
+        sources = [
+            path
+            for device in devices
+            for path in [
+                filename_prefix / device / "frame_log.bin",
+                filename_prefix / device / "system_timestamps.npy",
+            ]
+            if path.exists()
+        ]
+        if all(cache_path.stat().st_mtime >= path.stat().st_mtime for path in sources):
+            with np.load(cache_path) as cached:
+                metadata = json.loads(str(cached["metadata"]))
+                if metadata["settings"] == settings:
+                    return cached["table"], metadata
+
+    # put every stream on the host clock
+    times, clocks = {}, {}
+    for device in devices:
+        loaded = load_device_timestamps(filename_prefix / device, streams)
+        device_usec, system_usec = max(loaded.values(), key=lambda ts: len(ts[0]))
+        slope, intercept = fit_clock(device_usec, system_usec)
+        clocks[device] = (slope, intercept)
+        for stream, (device_usec, _) in loaded.items():
+            times[(device, stream)] = slope * device_usec.astype(np.float64) + intercept
+
+    columns = [(device, stream) for device in devices for stream in streams]
+    reference_times = times[tuple(reference)]
+    if tolerance_usec is None:
+        tolerance_usec = (
+            float(np.median(np.diff(reference_times))) / 2
+            if len(reference_times) > 1
+            else np.inf
+        )
+
+    table = np.zeros(
+        len(reference_times),
+        dtype=[
+            ("time_usec", np.float64),
+            ("frame", np.int64, (len(columns),)),
+            ("offset_usec", np.float32, (len(columns),)),
+            ("missing", np.bool_, (len(columns),)),
+        ],
+    )
+    table["time_usec"] = reference_times
+    for i, column in enumerate(columns):
+        # device timestamps are monotonic, but sort in case of a clock reset
+        order = np.argsort(times[column], kind="stable")
+        nearest = match_nearest(reference_times, times[column][order], tolerance_usec)
+        matched = nearest >= 0
+        frame = np.full(len(reference_times), -1, dtype=np.int64)
+        frame[matched] = order[nearest[matched]]
+        table["frame"][:, i] = frame
+        table["missing"][:, i] = ~matched
+        table["offset_usec"][matched, i] = times[column][frame[matched]] - reference_times[matched]
+
+    metadata = {
+        "columns": ["{}/{}".format(device, stream) for device, stream in columns],
+        "reference": "{}/{}".format(*reference),
+        "tolerance_usec": tolerance_usec,
+        "clocks": clocks,
+        "settings": settings,
+    }
+    if cache:
+        with open(cache_path, "wb") as f:
+            np.savez(f, table=table, metadata=json.dumps(metadata))
+    return table, metadata
+
+
+def missing_frames(table, metadata):
+    """Number of reference frames each device is missing at least one stream of"""
+    devices = [column.split("/")[0] for column in metadata["columns"]]
+    return {
+        device: int(
+            table["missing"][
+                :, [i for i, name in enumerate(devices) if name == device]
+            ].any(axis=1).sum()
+        )
+        for device in dict.fromkeys(devices)
+    }
@@ -0,0 +1,407 @@
+"""
+Archive - transcodes the videos of finished sessions to smaller archival
+formats in parallel, verifies their decoded frame counts against the frame
+logs, and records checksums, skipping work that is already done
+
+    python -m kinectacq.archive data/ --n-workers 8
+"""
+
+import hashlib, json, os, subprocess, time, click
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib2 import Path
+
+from kinectacq.alignment import load_device_timestamps
+from kinectacq.frame_index import FrameIndex
+from kinectacq.frame_log import is_writing
+from kinectacq.paths import is_session
+from kinectacq.segments import (
+    closed_segments,
+    concatenate_segments,
+    load_manifest,
+    manifest_path,
+)
+from kinectacq.video_reader import probe_video
+
+ARCHIVE_SUFFIX = ".archive.mkv"
+# ffmpeg output options per kind of source. Depth and IR (gray16 and gray)
+#   are measurements and stay lossless, with ffv1's slower range coder and
+#   large context model. Color goes to h264.
+DEFAULT_ARCHIVE_SETTINGS = {
+    "gray16": ["-c:v", "ffv1", "-level", "3", "-coder", "1", "-context", "1", "-g", "1"]
+    + ["-slices", "4", "-slicecrc", "1"],
+    "gray": ["-c:v", "ffv1", "-level", "3", "-coder", "1", "-context", "1", "-g", "1"]
+    + ["-slices", "4", "-slicecrc", "1"],
+    "color": ["-c:v", "libx264", "-preset", "slow", "-crf", "20", "-pix_fmt", "yuv420p"],
+}
+# codecs whose decoded frames are identical to what they encoded
+LOSSLESS_CODECS = ["ffv1", "huffyuv", "png", "rawvideo"]
+# seconds without a frame log flush (once per 30 frames) after which a session
+#   still marked as writing is taken to have crashed
+STALE_AFTER = 60
+
+
+def find_sessions(paths):
+    """Session directories among paths, and in the directories holding sessions"""
+    sessions = []
+    for path in map(Path, paths):
+        if is_session(path):
+            sessions.append(path)
+        elif path.is_dir():
+            sessions.extend(sorted(p for p in path.iterdir() if is_session(p)))
+    return list(dict.fromkeys(sessions))
+
+
+def archive_path(video):
+    """Where the archive of a video is written ({stem}.archive.mkv)"""
+    video = Path(video)
+    return video.parent / (video.stem + ARCHIVE_SUFFIX)
+
+
+def record_path(video):
+    """Where the archive record of a video is saved ({stem}.archive.json)"""
+    video = Path(video)
+    return video.parent / (video.stem + ".archive.json")
+
+
+def sha256(filename, chunk_size=1 << 22):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def count_decoded_frames(filename, threads=1):
+    """Number of frames in a video, counted by decoding all of it"""
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-threads",
+        str(threads),
+        "-count_frames",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=nb_read_frames",
+        "-of",
+        "csv=p=0",
+        str(filename),
+    ]
+    out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode != 0:
+        raise IOError("could not decode {}: {}".format(filename, out.stderr.decode()))
+    return int(out.stdout.decode().strip().split(",")[0])
+
+
+def frame_checksums(filename, pix_fmt, threads=1):
+    """md5 of every decoded frame of a video, in pix_fmt (ffmpeg's framemd5)"""
+    command = ["ffmpeg", "-v", "error", "-threads", str(threads), "-i", str(filename)]
+    command += ["-map", "0:v:0", "-vsync", "passthrough", "-pix_fmt", pix_fmt]
+    command += ["-f", "framemd5", "-"]
+    out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode != 0:
+        raise IOError("could not decode {}: {}".format(filename, out.stderr.decode()))
+    # stream, dts, pts, duration, size, hash. Timestamps differ between containers
+    return [
+        line.split(",")[-1].strip()
+        for line in out.stdout.decode().splitlines()
+        if line and not line.startswith("#")
+    ]
+
+
+def is_lossless(options):
+    """Whether ffmpeg output options decode to the frames they encoded"""
+    codec = options[options.index("-c:v") + 1] if "-c:v" in options else None
+    if codec in LOSSLESS_CODECS:
+        return True
+    return "-qp" in options and options[options.index("-qp") + 1] == "0"
+
+
+def archive_settings(pix_fmt, settings=DEFAULT_ARCHIVE_SETTINGS):
+    """ffmpeg output options for a source pixel format"""
+    if pix_fmt.startswith("gray16"):
+        return settings["gray16"]
+    if pix_fmt.startswith("gray"):
+        return settings["gray"]
+    return settings["color"]
+
+
+def is_archived(video):
+    """Whether a video has a verified archive that is unchanged since, and the
+    video is unchanged too (or was deleted once archived)
+    """
+    path = record_path(video)
+    if not path.exists():
+        return False
+    with open(path) as f:
+        record = json.load(f)
+    archive = Path(video).parent / record["archive"]
+    return (
+        record["verified"]
+        and archive.exists()
+        and os.path.getsize(archive) == record["archive_bytes"]
+        and (not Path(video).exists() or os.path.getsize(video) == record["source_bytes"])
+    )
+
+
+def archive_stream(video, expected_frames, settings=DEFAULT_ARCHIVE_SETTINGS, threads=2):
+    """Transcode a video, verify the archive and save a record next to it.
+
+    The archive is written to a temporary file and renamed once complete, so an
+    interrupted run leaves no archive that looks finished. The record is saved
+    last, and is what later runs look for. With lossless settings, every
+    decoded frame of the archive is also compared with the source's (by md5),
+    which is what allows the source to be deleted.
+
+    Args:
+        video (pathlib2.Path): Recorded video
+        expected_frames (int): Frames in the frame log (or timestamps) of the stream
+        settings (dict, optional): ffmpeg output options per kind of source.
+            Defaults to DEFAULT_ARCHIVE_SETTINGS.
+        threads (int, optional): Encoder and decoder threads. Defaults to 2.
+
+    Returns:
+        dict: the record, with the frame counts, sizes, checksums, whether the
+            archive is verified (frame counts match), whether its frames are
+            identical to the source's (None if lossy), and the time taken
+    """
+    t0 = time.perf_counter()
+    video = Path(video)
+    archive = archive_path(video)
+    tmp = archive.parent / (archive.stem + ".tmp" + archive.suffix)
+    info = probe_video(video)
+    options = archive_settings(info["pix_fmt"], settings)
+    command = (
+        ["ffmpeg", "-y", "-loglevel", "error", "-threads", str(threads), "-i", str(video)]
+        + ["-map", "0:v:0", "-vsync", "passthrough", "-threads", str(threads)]
+        + options
+        + [str(tmp)]
+    )
+    out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode != 0:
+        if tmp.exists():
+            os.remove(tmp)
+        raise IOError("could not transcode {}: {}".format(video, out.stderr.decode()))
+    os.replace(tmp, archive)
+
+    source_frames = count_decoded_frames(video, threads)
+    archive_frames = count_decoded_frames(archive, threads)
+    verified = source_frames == archive_frames == expected_frames
+    frames_identical = None
+    if is_lossless(options):
+        frames_identical = verified and frame_checksums(
+            video, info["pix_fmt"], threads
+        ) == frame_checksums(archive, info["pix_fmt"], threads)
+    record = {
+        "source": video.name,
+        "archive": archive.name,
+        "expected_frames": int(expected_frames),
+        "source_frames": source_frames,
+        "archive_frames": archive_frames,
+        "verified": verified,
+        "lossless": frames_identical is not None,
+        "frames_identical": frames_identical,
+        "source_bytes": os.path.getsize(video),
+        "archive_bytes": os.path.getsize(archive),
+        "source_sha256": sha256(video),
+        "archive_sha256": sha256(archive),
+        "command": command[:-1] + [archive.name],
+        "elapsed_s": None,
+        "archived_at": datetime.now().isoformat(),
+    }
+
+    # carry the device timestamps over to the archive's index
+    if record["verified"]:
+        index = FrameIndex.load(archive, fps=info["fps"])
+        source_index = FrameIndex.load(video, fps=info["fps"])
+        if len(source_index) == len(index):
+            index.timestamps = source_index.timestamps
+            index.save(FrameIndex.path(archive))
+
+    record["elapsed_s"] = round(time.perf_counter() - t0, 2)
+    with open(record_path(video), "w") as f:
+        json.dump(record, f, indent=2)
+    return record
+
+
+def is_recording(frame_log, stale_after=STALE_AFTER):
+    """Whether a frame log is still being written. Its is_writing flag stays set
+    when a recording crashes, so a log is only counted as recording if it was
+    also modified in the last stale_after seconds.
+    """
+    if not is_writing(frame_log):
+        return False
+    if time.time() - os.path.getmtime(frame_log) < stale_after:
+        return True
+    print(
+        "Warning: {} is marked as writing but unchanged for over {} s, "
+        "archiving it as a crashed recording".format(frame_log, stale_after)
+    )
+    return False
+
+
+def remove_source(video):
+    """Delete a video, with its frame index, and the segments (and their
+    indexes and manifest) it was joined from
+    """
+    video = Path(video)
+    for segment in closed_segments(video):
+        for path in [segment, FrameIndex.path(segment)]:
+            if path.exists():
+                os.remove(path)
+    for path in [manifest_path(video), FrameIndex.path(video), video]:
+        if path.exists():
+            os.remove(path)
+
+
+def session_jobs(session, streams=("depth", "ir", "color"), stale_after=STALE_AFTER):
+    """(video, expected frames) of every stream of every device of a finished
+    session that is not archived yet. Streams recorded in segments are joined
+    first (without re-encoding). Devices still recording are skipped, see
+    is_recording.
+    """
+    jobs = []
+    for device_dir in sorted(p for p in Path(session).iterdir() if p.is_dir()):
+        frame_log = device_dir / "frame_log.bin"
+        if frame_log.exists() and is_recording(frame_log, stale_after):
+            print("Skipping {}, still recording".format(device_dir))
+            continue
+        present = []
+        for stream in streams:
+            video = device_dir / "{}.avi".format(stream)
+            manifest = load_manifest(video)
+            if (
+                not video.exists()
+                and not record_path(video).exists()
+                and manifest is not None
+                and manifest["finished"]
+            ):
+                concatenate_segments(video)
+            if video.exists():
+                present.append(stream)
+        if len(present) == 0:
+            continue
+        try:
+            timestamps = load_device_timestamps(device_dir, present)
+        except FileNotFoundError:
+            print("Skipping {}, no frame log or timestamps".format(device_dir))
+            continue
+        for stream in present:
+            video = device_dir / "{}.avi".format(stream)
+            if not is_archived(video):
+                jobs.append((video, len(timestamps[stream][0])))
+    return jobs
+
+
+def archive_sessions(
+    paths,
+    n_workers=None,
+    threads=2,
+    streams=("depth", "ir", "color"),
+    settings=DEFAULT_ARCHIVE_SETTINGS,
+    delete_source=False,
+    stale_after=STALE_AFTER,
+    verbose=True,
+):
+    """Archive every stream of every session in paths, in a pool of processes.
+
+    Sessions are the directories named "%Y-%m-%d_%H-%M-%S" in paths (or paths
+    themselves). Videos with a verified record are skipped, so an interrupted
+    run picks up where it stopped. The largest videos start first, so that the
+    pool is not left waiting on one long transcode at the end. The records of
+    each session are gathered in its archive.json.
+
+    Args:
+        paths (list): Session directories, or directories holding sessions
+        n_workers (int, optional): Videos transcoded at once. Defaults to the
+            number of CPUs over threads.
+        threads (int, optional): ffmpeg threads per video. Defaults to 2.
+        streams (tuple, optional): Streams to archive. Defaults to ("depth", "ir", "color").
+        settings (dict, optional): See archive_stream. Defaults to DEFAULT_ARCHIVE_SETTINGS.
+        delete_source (bool, optional): Delete each video (see remove_source) once
+            every frame of its archive is verified to be identical. Videos with
+            lossy archives are kept. Defaults to False.
+        stale_after (float, optional): Seconds after which a frame log still
+            marked as writing is archived as crashed. Defaults to STALE_AFTER.
+        verbose (bool, optional): Print each video as it finishes. Defaults to True.
+
+    Returns:
+        dict: record of each video archived in this run, and the error of each
+            that failed
+    """
+    t0 = time.perf_counter()
+    n_workers = n_workers or max((os.cpu_count() or 1) // threads, 1)
+    sessions = find_sessions(paths)
+    jobs = [job for session in sessions for job in session_jobs(session, streams, stale_after)]
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+    if verbose:
+        print(
+            "{} videos to archive in {} sessions, {} at a time".format(
+                len(jobs), len(sessions), n_workers
+            )
+        )
+
+    results = {}
+    with ProcessPoolExecutor(n_workers) as executor:
+        futures = {
+            executor.submit(archive_stream, video, expected, settings, threads): video
+            for video, expected in jobs
+        }
+        for future in as_completed(futures):
+            video = futures[future]
+            try:
+                record = future.result()
+            except Exception as error:
+                results[str(video)] = {"error": str(error)}
+                print("Failed {}: {}".format(video, error))
+                continue
+            results[str(video)] = record
+            if verbose:
+                print(
+                    "{} {}: {} frames, {:.1f}x smaller, {} s{}".format(
+                        video.parent.name,
+                        video.name,
+                        record["archive_frames"],
+                        record["source_bytes"] / max(record["archive_bytes"], 1),
+                        record["elapsed_s"],
+                        "" if record["verified"] else " NOT VERIFIED ({} expected)".format(
+                            record["expected_frames"]
+                        ),
+                    )
+                )
+            if delete_source and record["frames_identical"]:
+                remove_source(video)
+
+    for session in sessions:
+        records = {}
+        for path in sorted(Path(session).glob("*/*.archive.json")):
+            with open(path) as f:
+                records["{}/{}".format(path.parent.name, path.name)] = json.load(f)
+        if len(records) > 0:
+            with open(Path(session) / "archive.json", "w") as f:
+                json.dump(records, f, indent=2)
+    if verbose:
+        print("Archived {} videos in {:.0f} s".format(len(results), time.perf_counter() - t0))
+    return results
+
+
+@click.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--n-workers", default=None, type=int, help="Videos transcoded at once")
+@click.option("--threads", default=2, help="ffmpeg threads per video")
+@click.option("--color/--no-color", default=True, help="Also archive the color stream")
+@click.option("--delete-source", is_flag=True, help="Delete videos once their archive's frames are verified identical")
+def main(paths, n_workers, threads, color, delete_source):
+    archive_sessions(
+        paths,
+        n_workers=n_workers,
+        threads=threads,
+        streams=("depth", "ir", "color") if color else ("depth", "ir"),
+        delete_source=delete_source,
+    )
+
+
+if __name__ == "__main__":
+    main()
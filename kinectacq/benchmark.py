@@ -0,0 +1,381 @@
+"""
+Benchmark - end-to-end throughput, latency and CPU cost of the acquisition
+pipeline for each writer configuration, using simulated devices
+"""
+
+import datetime, json, os, platform, subprocess, numpy as np
+from multiprocessing import Process
+from pathlib2 import Path
+
+from kinectacq.acquisition import capture_from_azure
+from kinectacq.paths import ensure_dir
+from kinectacq.simulation import SimulatedK4A
+from kinectacq.telemetry import load_telemetry
+
+# encoder settings used by start_recording
+FFV1_KWARGS = {
+    "codec": "ffv1",
+    "crf": 14,
+    "threads": 6,
+    "fps": 30,
+    "slices": 24,
+    "slicecrc": 1,
+}
+H264_KWARGS = dict(FFV1_KWARGS, codec="h264", crf=22)
+
+DEFAULT_CONFIGURATIONS = {
+    "queue_process": {"transport": "queue", "writer_workers": "process"},
+    "queue_thread": {"transport": "queue", "writer_workers": "thread"},
+    "shared_memory_process": {"transport": "shared_memory", "writer_workers": "process"},
+    "raw_process": {
+        "transport": "queue",
+        "writer_workers": "process",
+        "depth_write_frames_kwargs": {"backend": "raw"},
+        "ir_write_frames_kwargs": {"backend": "raw"},
+        "color_write_frames_kwargs": {"backend": "raw"},
+    },
+    "chunked_depth_process": {
+        "transport": "queue",
+        "writer_workers": "process",
+        "depth_write_frames_kwargs": {"backend": "chunked"},
+    },
+    "null_process": {
+        "transport": "queue",
+        "writer_workers": "process",
+        "depth_write_frames_kwargs": {"backend": "null"},
+        "ir_write_frames_kwargs": {"backend": "null"},
+        "color_write_frames_kwargs": {"backend": "null"},
+    },
+}
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return round(float(np.mean(values)), 1) if len(values) > 0 else None
+
+
+def _cpu_percent(samples, names):
+    """Total of the mean CPU use of each named process over a telemetry file"""
+    means = []
+    for name in names:
+        usage = [sample["processes"].get(name) for sample in samples]
+        means.append(_mean([None if use is None else use["cpu_percent"] for use in usage]))
+    means = [mean for mean in means if mean is not None]
+    return round(sum(means), 1) if len(means) > 0 else None
+
+
+def _write_rate(samples):
+    """Frames written per second by a writer while it was writing: between its
+    first sample that counted frames written and the first that reached the
+    final count, so that startup and teardown are left out. None with fewer
+    than two such samples.
+    """
+    counts = [
+        (sample["time"], sample["counters"].get("frames_written", 0)) for sample in samples
+    ]
+    counts = [(t, n) for t, n in counts if n > 0]
+    if len(counts) == 0:
+        return None
+    first = counts[0]
+    last = next((t, n) for t, n in counts if n == counts[-1][1])
+    if last[0] <= first[0]:
+        return None
+    return (last[1] - first[1]) / (last[0] - first[0])
+
+
+def summarize_device(device_dir):
+    """Throughput, drops, frame age and CPU use of one device from its telemetry.
+
+    Args:
+        device_dir (pathlib2.Path): Directory the device was recorded to
+
+    Returns:
+        dict: summary of the recording
+    """
+    capture_samples, capture = load_telemetry(device_dir / "telemetry_capture.jsonl")
+    duration_s = capture["duration_s"]
+    summary = {
+        "duration_s": duration_s,
+        "frames_captured": capture["counters"].get("frames_captured", 0),
+        "frames_written": {},
+        "write_fps": {},
+        "dropped": capture_samples[-1]["gauges"].get("dropped") or {},
+        "frame_age_us": {},
+    }
+
+    # the capture process watches itself and its writer processes, each writer
+    #   watches its encoder. With thread workers, writers are part of "self"
+    cpu_percent = [
+        _cpu_percent(capture_samples, capture_samples[-1]["processes"].keys())
+    ]
+    for path in sorted(device_dir.glob("telemetry_*.jsonl")):
+        stream = path.stem[len("telemetry_") :]
+        if stream == "capture":
+            continue
+        samples, totals = load_telemetry(path)
+        summary["frames_written"][stream] = totals["counters"].get("frames_written", 0)
+        summary["write_fps"][stream] = _write_rate(samples)
+        if "frame_age" in totals["stages"]:
+            summary["frame_age_us"][stream] = totals["stages"]["frame_age"]
+        cpu_percent.append(_cpu_percent(samples, ["encoder"]))
+
+    # the slowest stream, over the writers' active window rather than the whole
+    #   capture process, which includes device startup and writer teardown
+    rates = [rate for rate in summary["write_fps"].values() if rate is not None]
+    if len(rates) > 0:
+        summary["fps_written"] = round(min(rates), 2)
+    else:
+        summary["fps_written"] = round(
+            min(list(summary["frames_written"].values()) or [0]) / duration_s, 2
+        )
+    cpu_percent = [value for value in cpu_percent if value is not None]
+    summary["cpu_percent"] = round(sum(cpu_percent), 1) if cpu_percent else None
+    return summary
+
+
+def run_configuration(
+    output_dir,
+    capture_kwargs,
+    recording_duration=10,
+    fps=30,
+    n_cameras=1,
+    save_color=False,
+    simulation_kwargs={},
+    telemetry_interval=0.5,
+):
+    """Record from simulated cameras with one writer configuration, and
+    summarize the recording.
+
+    Args:
+        output_dir (pathlib2.Path): Where the recording is saved
+        capture_kwargs (dict): Passed on to capture_from_azure
+        recording_duration (float, optional): Seconds to record. Defaults to 10.
+        fps (float, optional): Frame rate of the simulated cameras. Defaults to 30.
+        n_cameras (int, optional): Number of cameras recorded in parallel. Defaults to 1.
+        save_color (bool, optional): Whether to record color. Defaults to False.
+        simulation_kwargs (dict, optional): Passed on to SimulatedK4A. Defaults to {}.
+        telemetry_interval (float, optional): Seconds between telemetry samples.
+            Defaults to 0.5.
+
+    Returns:
+        dict: the per-camera mean of each metric, and each camera's summary
+    """
+    kwargs = {
+        "depth_write_frames_kwargs": dict(FFV1_KWARGS, fps=fps),
+        "ir_write_frames_kwargs": dict(FFV1_KWARGS, fps=fps),
+        "color_write_frames_kwargs": dict(H264_KWARGS, fps=fps),
+    }
+    kwargs.update(capture_kwargs)
+    kwargs.update(
+        save_color=save_color,
+        samplerate=fps,
+        telemetry=True,
+        telemetry_interval=telemetry_interval,
+    )
+
+    device_dirs = [output_dir / "camera_{}".format(i) for i in range(n_cameras)]
+    process_list = []
+    for i, device_dir in enumerate(device_dirs):
+        ensure_dir(device_dir)
+        k4a = SimulatedK4A(device_id=i, fps=fps, **simulation_kwargs)
+        process_list.append(
+            Process(
+                target=capture_from_azure,
+                args=(k4a, device_dir, recording_duration),
+                kwargs=kwargs,
+            )
+        )
+    for p in process_list:
+        p.start()
+    for p in process_list:
+        p.join()
+
+    cameras = [summarize_device(device_dir) for device_dir in device_dirs]
+    streams = cameras[0]["frames_written"].keys()
+    frame_ages = [age for camera in cameras for age in camera["frame_age_us"].values()]
+    return {
+        "capture_fps": _mean(
+            [camera["frames_captured"] / recording_duration for camera in cameras]
+        ),
+        "fps_written": _mean([camera["fps_written"] for camera in cameras]),
+        "dropped": {
+            stream: _mean([camera["dropped"].get(stream, 0) for camera in cameras])
+            for stream in streams
+        },
+        "frame_age_p50_us": _mean([age["p50_us"] for age in frame_ages]),
+        "frame_age_p99_us": _mean([age["p99_us"] for age in frame_ages]),
+        "cpu_percent_per_camera": _mean([camera["cpu_percent"] for camera in cameras]),
+        "cameras": cameras,
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": datetime.datetime.now().isoformat(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit,
+    }
+
+
+def run_benchmark(
+    output_dir,
+    configurations=None,
+    recording_duration=10,
+    fps=30,
+    max_fps=300,
+    n_cameras=1,
+    save_color=False,
+    simulation_kwargs={},
+    history_file=None,
+):
+    """Benchmark each writer configuration with simulated cameras.
+
+    Every configuration is recorded twice. First the cameras run at max_fps,
+    with bounded, blocking queues, so that the capture loop is held back to
+    the rate the writers sustain ("fps_written"). Then they run at fps, to
+    measure the frame age (capture to written) and CPU cost per camera at
+    the camera's real rate.
+
+    Results are saved to output_dir/benchmark.json, and appended as one
+    line of JSON to history_file, so that regressions can be tracked over
+    time with compare_results.
+
+    Args:
+        output_dir (pathlib2.Path): Where recordings and results are saved
+        configurations (dict, optional): capture_from_azure kwargs per configuration
+            name. Defaults to DEFAULT_CONFIGURATIONS.
+        recording_duration (float, optional): Seconds per recording. Defaults to 10.
+        fps (float, optional): Real frame rate of the cameras. Defaults to 30.
+        max_fps (float, optional): Frame rate used to find the sustainable
+            rate, should be above it. Defaults to 300.
+        n_cameras (int, optional): Cameras recorded in parallel. Defaults to 1.
+        save_color (bool, optional): Whether to record color. Defaults to False.
+        simulation_kwargs (dict, optional): Passed on to SimulatedK4A. Defaults to {}.
+        history_file (pathlib2.Path, optional): JSON lines file the results
+            are appended to. Defaults to None.
+
+    Returns:
+        dict: environment and one result per configuration
+    """
+    output_dir = Path(output_dir) / datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    configurations = configurations or DEFAULT_CONFIGURATIONS
+    results = {"environment": _environment(), "results": []}
+
+    for name, capture_kwargs in configurations.items():
+        print("Benchmarking {}".format(name))
+        saturated = run_configuration(
+            output_dir / name / "max_fps",
+            dict(
+                {"image_queue_maxsize": 32, "image_queue_policy": "block"},
+                **capture_kwargs
+            ),
+            recording_duration=recording_duration,
+            fps=max_fps,
+            n_cameras=n_cameras,
+            save_color=save_color,
+            simulation_kwargs=simulation_kwargs,
+        )
+        paced = run_configuration(
+            output_dir / name / "fps",
+            capture_kwargs,
+            recording_duration=recording_duration,
+            fps=fps,
+            n_cameras=n_cameras,
+            save_color=save_color,
+            simulation_kwargs=simulation_kwargs,
+        )
+        result = {
+            "name": name,
+            "configuration": capture_kwargs,
+            "n_cameras": n_cameras,
+            "save_color": save_color,
+            "fps": fps,
+            "max_sustainable_fps": saturated["fps_written"],
+            "fps_written": paced["fps_written"],
+            "dropped": paced["dropped"],
+            "frame_age_p50_us": paced["frame_age_p50_us"],
+            "frame_age_p99_us": paced["frame_age_p99_us"],
+            "cpu_percent_per_camera": paced["cpu_percent_per_camera"],
+            "runs": {"max_fps": saturated, "fps": paced},
+        }
+        print(
+            "  max {} fps, {} fps at {} fps, frame age p99<={}us, {}% cpu per camera".format(
+                result["max_sustainable_fps"],
+                result["fps_written"],
+                fps,
+                result["frame_age_p99_us"],
+                result["cpu_percent_per_camera"],
+            )
+        )
+        results["results"].append(result)
+
+    ensure_dir(output_dir)
+    with open(output_dir / "benchmark.json", "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    if history_file is not None:
+        ensure_dir(Path(history_file))
+        with open(history_file, "a") as f:
+            f.write(json.dumps(results, default=str) + "\n")
+    return results
+
+
+def load_results(path):
+    """Load benchmark results, from benchmark.json or the last line of a history file"""
+    with open(path) as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if len(lines) > 0 and Path(path).suffix == ".jsonl":
+        return json.loads(lines[-1])
+    return json.loads("\n".join(lines))
+
+
+def compare_results(baseline, current, tolerance=0.1):
+    """Find configurations that got worse than a baseline by more than tolerance.
+
+    Args:
+        baseline (dict): Results of run_benchmark (or load_results)
+        current (dict): Results of run_benchmark (or load_results)
+        tolerance (float, optional): Relative change that is ignored. Defaults to 0.1.
+
+    Returns:
+        list: one dict (name, metric, baseline, current) per regression
+    """
+    # metrics where higher is better (1) or worse (-1)
+    metrics = {
+        "max_sustainable_fps": 1,
+        "fps_written": 1,
+        "frame_age_p99_us": -1,
+        "cpu_percent_per_camera": -1,
+    }
+    key = lambda result: (result["name"], result["n_cameras"], result["save_color"])
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        reference = baseline_results.get(key(result))
+        if reference is None:
+            continue
+        for metric, sign in metrics.items():
+            before, after = reference.get(metric), result.get(metric)
+            if before is None or after is None or before == 0:
+                continue
+            if sign * (after - before) / before < -tolerance:
+                regressions.append(
+                    {
+                        "name": result["name"],
+                        "metric": metric,
+                        "baseline": before,
+                        "current": after,
+                    }
+                )
+    return regressions
@@ -0,0 +1,133 @@
+"""
+Capture - grabs captures from a device on a dedicated thread, copying each
+image once into a recycled buffer
+"""
+
+import sys, threading, time, numpy as np
+from queue import Queue, Empty
+
+
+class BufferPool:
+    """Pre-allocated frame buffers of one stream, recycled once nothing uses
+    them anymore.
+
+    A buffer is free when the pool holds the only reference to it, so it
+    returns to the pool on its own once every consumer in the process (the
+    preprocessing workers, a queue's feeder thread pickling it, a shared
+    memory ring buffer copying it) has let go of it and of any view of it.
+    The buffers are allocated from the first image. When every buffer is in
+    use, or an image has another shape, a new array is allocated instead.
+
+    Args:
+        dtype (np.dtype): dtype of the buffers. Images are cast while copied.
+        n_slots (int, optional): Number of buffers. Defaults to 8.
+    """
+
+    def __init__(self, dtype, n_slots=8):
+        self.dtype = np.dtype(dtype)
+        self.n_slots = n_slots
+        self.slots = []
+        self.n_misses = 0
+        self._next = 0
+
+    def _free_slot(self):
+        for i in range(self.n_slots):
+            index = (self._next + i) % self.n_slots
+            # one reference from the list, one from getrefcount's argument
+            if sys.getrefcount(self.slots[index]) <= 2:
+                self._next = index + 1
+                return self.slots[index]
+        return None
+
+    def copy(self, image):
+        """Copy an image into a free buffer (casting it to dtype), and return it"""
+        if len(self.slots) == 0:
+            self.slots = [
+                np.empty(image.shape, dtype=self.dtype) for _ in range(self.n_slots)
+            ]
+        slot = self._free_slot() if image.shape == self.slots[0].shape else None
+        if slot is None:
+            self.n_misses += 1
+            return image.astype(self.dtype)
+        np.copyto(slot, image, casting="unsafe")
+        return slot
+
+
+class CaptureThread(threading.Thread):
+    """Calls get_capture in a loop on its own thread, and queues the images of
+    each capture (copied into BufferPools) with their device timestamps and
+    the host time they arrived.
+
+    The capture is released right after its images are copied, so the SDK
+    gets its buffers back immediately, and the time between get_capture
+    calls does not depend on what the rest of the capture process is doing.
+    When the queue is full, the thread waits, and the device drops frames
+    as it would with a slow capture loop.
+
+    Args:
+        k4a (k4a object): Started camera K4A object, or a SimulatedK4A
+        dtypes (dict): dtype per stream to capture, e.g. {"depth": np.int16}
+        n_slots (int, optional): Buffers per stream. Defaults to 8.
+        maxsize (int, optional): Captures waiting to be taken. Defaults to n_slots.
+        telemetry (Telemetry, optional): Where get_capture and copy times are
+            recorded. Defaults to None.
+    """
+
+    def __init__(self, k4a, dtypes, n_slots=8, maxsize=None, telemetry=None):
+        super().__init__(daemon=True)
+        self.k4a = k4a
+        self.pools = {stream: BufferPool(dtype, n_slots) for stream, dtype in dtypes.items()}
+        self.captures = Queue(maxsize=maxsize or n_slots)
+        self.telemetry = telemetry
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                t0 = time.perf_counter_ns()
+                capture = self.k4a.get_capture()
+                system_ns = time.time_ns()
+                if self.telemetry is not None:
+                    self.telemetry.record("get_capture", t0)
+                    t0 = time.perf_counter_ns()
+                frames, timestamps = {}, {}
+                for stream, pool in self.pools.items():
+                    # the timestamp is set when the image is read
+                    image = getattr(capture, stream)
+                    frames[stream] = None if image is None else pool.copy(image)
+                    timestamps[stream] = getattr(
+                        capture, "_{}_timestamp_usec".format(stream)
+                    )
+                del capture, image
+                if self.telemetry is not None:
+                    self.telemetry.record("copy", t0)
+                self.captures.put((system_ns, frames, timestamps))
+        except Exception as error:
+            # raised in the capture loop by get
+            self.error = error
+        finally:
+            self.captures.put(None)
+
+    def get(self, timeout=None):
+        """The next capture, as (host time (ns), frames, timestamps)"""
+        item = self.captures.get(timeout=timeout)
+        if item is None:
+            raise self.error or OSError("capture thread stopped")
+        return item
+
+    def stop(self, timeout=5):
+        """Stop capturing, discarding the captures that were not taken"""
+        self._stop_event.set()
+        deadline = time.monotonic() + timeout
+        while self.is_alive() and time.monotonic() < deadline:
+            # make room, so that the thread is not stuck on a full queue
+            try:
+                self.captures.get(timeout=0.1)
+            except Empty:
+                pass
+
+    @property
+    def n_misses(self):
+        """Images that could not be copied into a free buffer"""
+        return {stream: pool.n_misses for stream, pool in self.pools.items()}
@@ -0,0 +1,411 @@
+"""
+Catalog - a persistent SQLite index of recorded sessions, their devices and
+streams, for finding sessions by date, device, duration or drops without
+walking the data directory
+"""
+
+import os, sqlite3, time, numpy as np
+from datetime import datetime
+from pathlib2 import Path
+
+from kinectacq.frame_log import load_frame_log
+from kinectacq.paths import session_time
+
+# the catalog is kept in the user's home directory, not next to the package,
+#   which may be installed read-only. KINECTACQ_CATALOG overrides it, e.g. with
+#   a local disk when the data directory is on network storage
+CATALOG_PATH = Path(
+    os.environ.get("KINECTACQ_CATALOG", Path.home() / ".kinectacq" / "catalog.sqlite")
+)
+STREAMS = ("depth", "ir", "color")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    parent TEXT NOT NULL,
+    started_at REAL,
+    duration_s REAL,
+    n_devices INTEGER,
+    n_frames INTEGER,
+    n_dropped INTEGER,
+    dropped_fraction REAL,
+    total_bytes INTEGER,
+    is_writing INTEGER,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started_at);
+CREATE INDEX IF NOT EXISTS sessions_parent ON sessions (parent, started_at);
+CREATE INDEX IF NOT EXISTS sessions_dropped ON sessions (dropped_fraction);
+CREATE INDEX IF NOT EXISTS sessions_duration ON sessions (duration_s);
+CREATE INDEX IF NOT EXISTS sessions_writing ON sessions (is_writing);
+CREATE TABLE IF NOT EXISTS devices (
+    session_id INTEGER NOT NULL REFERENCES sessions (id) ON DELETE CASCADE,
+    device TEXT NOT NULL,
+    n_frames INTEGER,
+    duration_s REAL,
+    n_dropped INTEGER,
+    total_bytes INTEGER,
+    is_writing INTEGER,
+    PRIMARY KEY (session_id, device)
+);
+CREATE INDEX IF NOT EXISTS devices_device ON devices (device);
+CREATE TABLE IF NOT EXISTS streams (
+    session_id INTEGER NOT NULL REFERENCES sessions (id) ON DELETE CASCADE,
+    device TEXT NOT NULL,
+    stream TEXT NOT NULL,
+    n_frames INTEGER,
+    n_dropped INTEGER,
+    total_bytes INTEGER,
+    PRIMARY KEY (session_id, device, stream)
+);
+"""
+
+
+def _timestamp(value):
+    """Unix time of a datetime, a "%Y-%m-%d_%H-%M-%S" (or ISO) string, or a number"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        parsed = session_time(value)
+        value = parsed if parsed is not None else datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+def summarize_device(device_dir, streams=STREAMS):
+    """Frames, drops, duration and size of a device directory, from its frame
+    log (or the .npy timestamps of older recordings) and file sizes
+
+    Returns:
+        dict: n_frames, n_dropped, duration_s, total_bytes, is_writing and
+            start_time (None if unknown), and per stream in "streams", its
+            n_frames (written), n_dropped and total_bytes. None if the
+            directory holds no recording.
+    """
+    device_dir = Path(device_dir)
+    sizes = {path.name: path.stat().st_size for path in device_dir.iterdir() if path.is_file()}
+    start_time = None
+    if "frame_log.bin" in sizes:
+        frames, metadata = load_frame_log(device_dir / "frame_log.bin")
+        is_writing, start_time = metadata["is_writing"], metadata.get("start_time")
+        system_ns = frames["system_ns"]
+        dropped = {
+            stream: frames["{}_dropped".format(stream)]
+            for stream in metadata["streams"]
+            if stream in streams
+        }
+    elif "system_timestamps.npy" in sizes:
+        system_ns = np.load(device_dir / "system_timestamps.npy")
+        # saved True when the recording starts, and False once it is finished
+        is_writing = "is_writing.npy" in sizes and bool(
+            np.load(device_dir / "is_writing.npy")[0]
+        )
+        dropped = {
+            stream: np.load(device_dir / "{}_timestamps.npy".format(stream))[
+                : len(system_ns)
+            ]
+            == 0
+            for stream in streams
+            if "{}_timestamps.npy".format(stream) in sizes
+        }
+    else:
+        return None
+
+    stream_summaries = {
+        stream: {
+            "n_frames": int(len(stream_dropped) - stream_dropped.sum()),
+            "n_dropped": int(stream_dropped.sum()),
+            # the video, its index, and any segments or archive
+            "total_bytes": sum(
+                size for name, size in sizes.items() if name.startswith(stream)
+            ),
+        }
+        for stream, stream_dropped in dropped.items()
+    }
+    return {
+        "n_frames": int(len(system_ns)),
+        "n_dropped": sum(summary["n_dropped"] for summary in stream_summaries.values()),
+        "duration_s": float(system_ns[-1] - system_ns[0]) * 1e-9 if len(system_ns) > 1 else 0.0,
+        "total_bytes": sum(sizes.values()),
+        "is_writing": bool(is_writing),
+        "start_time": start_time,
+        "streams": stream_summaries,
+    }
+
+
+class SessionCatalog:
+    """SQLite index of sessions, with one row per session, device and stream.
+
+    Sessions are added with index_session (the RecordingController does so for
+    every session it records) or update, which only reads the directories that are
+    not in the catalog yet, or were still being written when last indexed.
+    Queries use the indexes on the start time, parent directory, duration and
+    dropped fraction, so they stay fast with tens of thousands of sessions,
+    without touching the data directory.
+
+        with SessionCatalog() as catalog:
+            catalog.update(DATA_DIR / "mouse1")
+            latest = catalog.most_recent(parent=DATA_DIR / "mouse1")[0]["path"]
+            bad = catalog.with_drops(0.01)
+
+    SQLite's locking is not reliable on every network file system. When the
+    data directory is on one, keep the catalog on a local disk (path, or the
+    KINECTACQ_CATALOG environment variable).
+
+    Args:
+        path (pathlib2.Path, optional): Catalog file. Defaults to CATALOG_PATH.
+        timeout (float, optional): Seconds to wait for another process writing to
+            the catalog. Defaults to 30.
+    """
+
+    def __init__(self, path=None, timeout=30):
+        self.path = Path(path or CATALOG_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), timeout=timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def index_session(self, session_dir, streams=STREAMS):
+        """Add a session (or update it) from the frame logs and files of its
+        device directories
+
+        Returns:
+            bool: whether the session holds any recording
+        """
+        session_dir = Path(session_dir).resolve()
+        devices = {}
+        for device_dir in sorted(p for p in session_dir.iterdir() if p.is_dir()):
+            summary = summarize_device(device_dir, streams)
+            if summary is not None:
+                devices[device_dir.name] = summary
+        if len(devices) == 0:
+            return False
+
+        started = session_time(session_dir)
+        if started is not None:
+            started_at = started.timestamp()
+        else:
+            start_times = [d["start_time"] for d in devices.values() if d["start_time"]]
+            started_at = min(start_times) if start_times else session_dir.stat().st_mtime
+        # drops are counted per stream, out of the frames of every stream
+        n_stream_frames = sum(
+            s["n_frames"] + s["n_dropped"]
+            for d in devices.values()
+            for s in d["streams"].values()
+        )
+        n_dropped = sum(d["n_dropped"] for d in devices.values())
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO sessions (path, parent, started_at, duration_s, n_devices,
+                    n_frames, n_dropped, dropped_fraction, total_bytes, is_writing,
+                    indexed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    started_at = excluded.started_at, duration_s = excluded.duration_s,
+                    n_devices = excluded.n_devices, n_frames = excluded.n_frames,
+                    n_dropped = excluded.n_dropped,
+                    dropped_fraction = excluded.dropped_fraction,
+                    total_bytes = excluded.total_bytes, is_writing = excluded.is_writing,
+                    indexed_at = excluded.indexed_at
+                """,
+                (
+                    str(session_dir),
+                    str(session_dir.parent),
+                    started_at,
+                    max(d["duration_s"] for d in devices.values()),
+                    len(devices),
+                    sum(d["n_frames"] for d in devices.values()),
+                    n_dropped,
+                    n_dropped / n_stream_frames if n_stream_frames > 0 else 0.0,
+                    sum(d["total_bytes"] for d in devices.values()),
+                    any(d["is_writing"] for d in devices.values()),
+                    time.time(),
+                ),
+            )
+            session_id = self.connection.execute(
+                "SELECT id FROM sessions WHERE path = ?", (str(session_dir),)
+            ).fetchone()[0]
+            self.connection.execute("DELETE FROM devices WHERE session_id = ?", (session_id,))
+            self.connection.execute("DELETE FROM streams WHERE session_id = ?", (session_id,))
+            self.connection.executemany(
+                "INSERT INTO devices VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        session_id,
+                        device,
+                        d["n_frames"],
+                        d["duration_s"],
+                        d["n_dropped"],
+                        d["total_bytes"],
+                        d["is_writing"],
+                    )
+                    for device, d in devices.items()
+                ],
+            )
+            self.connection.executemany(
+                "INSERT INTO streams VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, device, stream, s["n_frames"], s["n_dropped"], s["total_bytes"])
+                    for device, d in devices.items()
+                    for stream, s in d["streams"].items()
+                ],
+            )
+        return True
+
+    def update(self, parent, rescan=False, verbose=False):
+        """Index the sessions in a directory that are not in the catalog, or
+        were still being written when they were indexed. Only the directory
+        itself is listed, sessions already indexed are not read.
+
+        Args:
+            parent (pathlib2.Path): Directory holding session directories
+            rescan (bool, optional): Index every session again. Defaults to False.
+            verbose (bool, optional): Print each session indexed. Defaults to False.
+
+        Returns:
+            int: number of sessions indexed
+        """
+        parent = Path(parent).resolve()
+        done = {
+            row["path"]
+            for row in self.connection.execute(
+                "SELECT path FROM sessions WHERE parent = ? AND NOT is_writing",
+                (str(parent),),
+            )
+        }
+        n_indexed = 0
+        for path in parent.iterdir():
+            if session_time(path) is None or (not rescan and str(path) in done):
+                continue
+            if path.is_dir() and self.index_session(path):
+                n_indexed += 1
+                if verbose:
+                    print("Indexed {}".format(path))
+        return n_indexed
+
+    def sync(self, parent, verbose=False):
+        """Bring the sessions of a directory in line with it: index the ones that
+        are missing (recorded without the catalog, copied from another machine,
+        or still being recorded) and remove the deleted ones
+
+        Returns:
+            int: number of sessions indexed
+        """
+        self.remove_missing(parent)
+        return self.update(parent, verbose=verbose)
+
+    def remove_missing(self, parent=None):
+        """Remove the sessions whose directory no longer exists
+
+        Args:
+            parent (pathlib2.Path, optional): Only check the sessions in this
+                directory. Defaults to None (every session).
+
+        Returns:
+            int: number of sessions removed
+        """
+        if parent is None:
+            rows = self.connection.execute("SELECT path FROM sessions")
+        else:
+            rows = self.connection.execute(
+                "SELECT path FROM sessions WHERE parent = ?", (str(Path(parent).resolve()),)
+            )
+        missing = [(row["path"],) for row in rows if not os.path.isdir(row["path"])]
+        with self.connection:
+            self.connection.executemany("DELETE FROM sessions WHERE path = ?", missing)
+        return len(missing)
+
+    def query(self, where="1", params=(), order_by="started_at DESC", limit=None):
+        """Sessions matching an SQL condition on the sessions table
+
+        Args:
+            where (str, optional): Condition, with ? placeholders. Defaults to "1" (all).
+            params (tuple, optional): Values of the placeholders. Defaults to ().
+            order_by (str, optional): Sort order. Defaults to "started_at DESC".
+            limit (int, optional): Maximum number of sessions. Defaults to None.
+
+        Returns:
+            list: a dict per session, with the columns of the sessions table
+        """
+        sql = "SELECT * FROM sessions WHERE {} ORDER BY {}".format(where, order_by)
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+        return [dict(row) for row in self.connection.execute(sql, tuple(params))]
+
+    def most_recent(self, n=1, parent=None):
+        """The n sessions started last, in a parent directory if given. This is
+        the indexed lookup of paths.most_recent_subdirectory, without listing
+        the directory, so it only knows the sessions indexed so far (see sync).
+        """
+        if parent is None:
+            return self.query(limit=n)
+        return self.query("parent = ?", (str(Path(parent).resolve()),), limit=n)
+
+    def between(self, start=None, end=None, parent=None):
+        """Sessions started between start and end (datetime, session name, ISO
+        string or unix time), oldest first
+        """
+        conditions, params = [], []
+        for condition, value in [("started_at >= ?", start), ("started_at < ?", end)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(_timestamp(value))
+        if parent is not None:
+            conditions.append("parent = ?")
+            params.append(str(Path(parent).resolve()))
+        return self.query(" AND ".join(conditions) or "1", params, order_by="started_at")
+
+    def with_drops(self, min_fraction=0.01):
+        """Sessions with more than min_fraction of their frames dropped, worst first"""
+        return self.query(
+            "dropped_fraction > ?", (min_fraction,), order_by="dropped_fraction DESC"
+        )
+
+    def with_device(self, device):
+        """Sessions recorded with a device"""
+        return self.query(
+            "id IN (SELECT session_id FROM devices WHERE device = ?)", (device,)
+        )
+
+    def details(self, session_dir):
+        """A session, with its devices, and the streams of each device
+
+        Returns:
+            dict: the session's columns, and per device in "devices", its columns
+                and per stream in "streams", its columns. None if not indexed.
+        """
+        row = self.connection.execute(
+            "SELECT * FROM sessions WHERE path = ?", (str(Path(session_dir).resolve()),)
+        ).fetchone()
+        if row is None:
+            return None
+        session = dict(row)
+        session["devices"] = {
+            device["device"]: dict(device, streams={})
+            for device in map(
+                dict,
+                self.connection.execute(
+                    "SELECT * FROM devices WHERE session_id = ?", (session["id"],)
+                ),
+            )
+        }
+        for stream in self.connection.execute(
+            "SELECT * FROM streams WHERE session_id = ?", (session["id"],)
+        ):
+            session["devices"][stream["device"]]["streams"][stream["stream"]] = dict(stream)
+        return session
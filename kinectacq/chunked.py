@@ -0,0 +1,379 @@
+"""
+Chunked - a lossless container for 16-bit frames (e.g. depth), compressed in
+blocks of frames on a thread pool and indexed for random access
+"""
+
+import json, os, threading, zlib, numpy as np
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib2 import Path
+
+from kinectacq.frame_index import FrameIndex
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+MAGIC = b"KACQCHK1"
+FOOTER_MAGIC = b"KACQIDX1"
+# precedes every compressed chunk, so the index can be rebuilt after a crash
+CHUNK_HEADER = np.dtype(
+    [("magic", "S4"), ("n_frames", "<u4"), ("first_frame", "<u8"), ("size", "<u8")]
+)
+CHUNK_MAGIC = b"CHNK"
+INDEX_DTYPE = np.dtype(
+    [("first_frame", "<u8"), ("n_frames", "<u4"), ("offset", "<u8"), ("size", "<u8")]
+)
+# index offset and number of chunks, at the very end of a finished file
+FOOTER = np.dtype([("magic", "S8"), ("index_offset", "<u8"), ("n_chunks", "<u8")])
+
+_local = threading.local()
+
+
+def available_codecs():
+    """Codecs that can be used here, fastest first"""
+    return (
+        (["zstd"] if zstandard is not None else [])
+        + (["lz4"] if lz4_frame is not None else [])
+        + ["zlib"]
+    )
+
+
+def compress(data, codec, level=1):
+    if codec == "zstd":
+        if not hasattr(_local, "zstd"):
+            # compressors can not be shared between threads
+            _local.zstd = zstandard.ZstdCompressor(level=level)
+        return _local.zstd.compress(data)
+    elif codec == "lz4":
+        return lz4_frame.compress(data, compression_level=level)
+    elif codec == "zlib":
+        return zlib.compress(data, level)
+    raise ValueError("codec {} has not been defined".format(codec))
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        if not hasattr(_local, "zstd_decompressor"):
+            _local.zstd_decompressor = zstandard.ZstdDecompressor()
+        return _local.zstd_decompressor.decompress(data)
+    elif codec == "lz4":
+        return lz4_frame.decompress(data)
+    elif codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError("codec {} has not been defined".format(codec))
+
+
+def _shuffle(frames):
+    """Group the bytes of each value by significance, which compresses
+    16-bit images far better, since the high bytes barely change
+    """
+    itemsize = frames.dtype.itemsize
+    if itemsize == 1:
+        return frames.tobytes()
+    return np.ascontiguousarray(frames.view(np.uint8).reshape(-1, itemsize).T).tobytes()
+
+
+def _unshuffle(data, dtype, shape):
+    itemsize = dtype.itemsize
+    values = np.frombuffer(data, dtype=np.uint8)
+    if itemsize > 1:
+        values = np.ascontiguousarray(values.reshape(itemsize, -1).T)
+    return values.view(dtype).reshape(shape)
+
+
+class ChunkedWriter:
+    """Writes frames losslessly to a chunked container (.chunks).
+
+    Frames are collected in blocks of chunk_frames, and each block is
+    byte-shuffled and compressed on a thread pool (the codecs release the
+    GIL), so several blocks are compressed in parallel while new frames
+    arrive. Blocks are written in order, each with a small header, and an
+    index of every block is appended when the file is closed. Frames are
+    stored in the dtype they arrive in (int16 for depth), so 16-bit depth
+    keeps full precision: unlike the other writers, video_dtype is ignored.
+    A FrameIndex is saved next to the file, as for videos.
+
+    Select it for a stream with {"backend": "chunked"} in its
+    *_write_frames_kwargs.
+
+    Args:
+        filename (pathlib2.Path): Where the frames are saved, the suffix is
+            replaced by .chunks
+        chunk_frames (int, optional): Frames per compressed block. Defaults to 32.
+        codec (str, optional): "zstd", "lz4" or "zlib". Defaults to the fastest
+            available.
+        level (int, optional): Compression level. Defaults to 1.
+        n_threads (int, optional): Compression threads. Defaults to 4.
+        fps (float, optional): Frame rate, for the index. Defaults to 30.
+        write_frames_kwargs: Other writer settings, ignored (including video_dtype)
+    """
+
+    pipe = None
+
+    def __init__(
+        self,
+        filename,
+        chunk_frames=32,
+        codec=None,
+        level=1,
+        n_threads=4,
+        fps=30,
+        **write_frames_kwargs
+    ):
+        self.filename = Path(filename).with_suffix(".chunks")
+        self.chunk_frames = chunk_frames
+        self.codec = codec or available_codecs()[0]
+        if self.codec not in available_codecs():
+            raise ValueError("codec {} is not available".format(self.codec))
+        self.level = level
+        self.n_threads = n_threads
+        self.fps = fps
+        self.n_frames_written = 0
+        self.timestamps = array("Q")
+        self.index = []
+        self._file = None
+        self._pool = None
+        self._pending = deque()
+        self._free = []
+        self._n_buffered = 0
+
+    def _open(self, frame):
+        self.frame_shape = frame.shape
+        self.dtype = frame.dtype
+        metadata = {
+            "dtype": np.lib.format.dtype_to_descr(self.dtype),
+            "frame_shape": list(self.frame_shape),
+            "chunk_frames": self.chunk_frames,
+            "codec": self.codec,
+            "shuffle": True,
+            "fps": self.fps,
+        }
+        metadata = json.dumps(metadata).encode("utf8")
+        self._file = open(self.filename, "wb")
+        self._file.write(MAGIC + np.uint64(len(metadata)).tobytes() + metadata)
+        self._pool = ThreadPoolExecutor(self.n_threads)
+        # one block is being filled while up to two per thread are compressed
+        self._free = [
+            np.empty((self.chunk_frames,) + self.frame_shape, dtype=self.dtype)
+            for _ in range(2 * self.n_threads + 1)
+        ]
+        self._buffer = self._free.pop()
+
+    def _compress(self, buffer, n_frames):
+        return buffer, compress(_shuffle(buffer[:n_frames]), self.codec, self.level)
+
+    def _submit(self):
+        """Compress the block being filled, and start a new one"""
+        first_frame = self.n_frames_written - self._n_buffered
+        self._pending.append(
+            (
+                first_frame,
+                self._n_buffered,
+                self._pool.submit(self._compress, self._buffer, self._n_buffered),
+            )
+        )
+        self._n_buffered = 0
+        if len(self._free) == 0:
+            self._write_pending(1)
+        self._buffer = self._free.pop()
+
+    def _write_pending(self, n=None):
+        """Write out the oldest compressed blocks, in order"""
+        while len(self._pending) > 0 and (n is None or n > 0):
+            first_frame, n_frames, future = self._pending.popleft()
+            buffer, data = future.result()
+            header = np.array(
+                [(CHUNK_MAGIC, n_frames, first_frame, len(data))], dtype=CHUNK_HEADER
+            )
+            self._file.write(header.tobytes())
+            self.index.append(
+                (first_frame, n_frames, self._file.tell(), len(data))
+            )
+            self._file.write(data)
+            self._free.append(buffer)
+            if n is not None:
+                n -= 1
+
+    def write(self, frames, timestamps=None):
+        """Write a list of frames (np.array), None entries are skipped"""
+        if timestamps is None:
+            timestamps = [0] * len(frames)
+        for frame, timestamp in zip(frames, timestamps):
+            if frame is None:
+                continue
+            if self._file is None:
+                self._open(frame)
+            np.copyto(self._buffer[self._n_buffered], frame)
+            self._n_buffered += 1
+            self.n_frames_written += 1
+            self.timestamps.append(int(timestamp))
+            if self._n_buffered == self.chunk_frames:
+                self._submit()
+        # write out whatever has finished compressing, without waiting
+        while len(self._pending) > 0 and self._pending[0][2].done():
+            self._write_pending(1)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._n_buffered > 0:
+            self._submit()
+        self._write_pending()
+        self._pool.shutdown()
+        index_offset = self._file.tell()
+        self._file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        footer = np.array(
+            [(FOOTER_MAGIC, index_offset, len(self.index))], dtype=FOOTER
+        )
+        self._file.write(footer.tobytes())
+        self._file.close()
+        self._file = None
+        FrameIndex.from_recording(
+            self.n_frames_written,
+            self.fps,
+            timestamps=np.frombuffer(self.timestamps, dtype=np.uint64),
+            intra_only=True,
+        ).save(FrameIndex.path(self.filename))
+
+
+class ChunkedReader:
+    """Random access to the frames of a chunked container.
+
+    Only the blocks holding the requested frames are read and decompressed,
+    and recently used blocks are cached. Files that were not closed (e.g.
+    after a crash) are indexed by scanning the block headers.
+
+        reader = ChunkedReader("depth.chunks")
+        depth = reader[1000:2000]
+
+    Args:
+        filename (pathlib2.Path): Container file
+        cache_chunks (int, optional): Decompressed blocks kept in memory. Defaults to 8.
+        n_threads (int, optional): Threads decompressing blocks of a range
+            read in parallel. Defaults to 4.
+    """
+
+    def __init__(self, filename, cache_chunks=8, n_threads=4):
+        self.filename = Path(filename)
+        self.cache_chunks = cache_chunks
+        self._file = open(self.filename, "rb")
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a chunked container".format(filename))
+        metadata_len = int(np.frombuffer(self._file.read(8), dtype="<u8")[0])
+        self.metadata = json.loads(self._file.read(metadata_len).decode("utf8"))
+        self._data_offset = self._file.tell()
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.frame_shape = tuple(self.metadata["frame_shape"])
+        self.codec = self.metadata["codec"]
+        self.index = self._read_index()
+        # as int64, since frame numbers minus uint64 would become floats
+        self._first_frames = self.index["first_frame"].astype(np.int64)
+        self.n_frames = int(
+            (self.index["first_frame"] + self.index["n_frames"]).max()
+            if len(self.index) > 0
+            else 0
+        )
+        self._cache = OrderedDict()
+        self._pool = ThreadPoolExecutor(n_threads)
+        self._lock = threading.Lock()
+
+    def _read_index(self):
+        size = os.path.getsize(self.filename)
+        if size >= self._data_offset + FOOTER.itemsize:
+            self._file.seek(size - FOOTER.itemsize)
+            footer = np.frombuffer(self._file.read(FOOTER.itemsize), dtype=FOOTER)[0]
+            if footer["magic"] == FOOTER_MAGIC:
+                self._file.seek(int(footer["index_offset"]))
+                return np.frombuffer(
+                    self._file.read(int(footer["n_chunks"]) * INDEX_DTYPE.itemsize),
+                    dtype=INDEX_DTYPE,
+                )
+
+        # unfinished file, follow the chunk headers up to the last complete chunk
+        index = []
+        offset = self._data_offset
+        while offset + CHUNK_HEADER.itemsize <= size:
+            self._file.seek(offset)
+            header = np.frombuffer(
+                self._file.read(CHUNK_HEADER.itemsize), dtype=CHUNK_HEADER
+            )[0]
+            data_offset = offset + CHUNK_HEADER.itemsize
+            if header["magic"] != CHUNK_MAGIC or data_offset + header["size"] > size:
+                break
+            index.append(
+                (header["first_frame"], header["n_frames"], data_offset, header["size"])
+            )
+            offset = data_offset + int(header["size"])
+        return np.array(index, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return self.n_frames
+
+    @property
+    def shape(self):
+        return (self.n_frames,) + self.frame_shape
+
+    def _read_chunk(self, i):
+        """Read and decompress block i, called from the thread pool"""
+        entry = self.index[i]
+        with self._lock:
+            self._file.seek(int(entry["offset"]))
+            data = self._file.read(int(entry["size"]))
+        shape = (int(entry["n_frames"]),) + self.frame_shape
+        return _unshuffle(decompress(data, self.codec), self.dtype, shape)
+
+    def _get_chunks(self, chunks):
+        """Blocks by number, decompressing the ones not cached in parallel"""
+        missing = [i for i in chunks if i not in self._cache]
+        for i, chunk in zip(missing, self._pool.map(self._read_chunk, missing)):
+            self._cache[i] = chunk
+        result = {}
+        for i in chunks:
+            self._cache.move_to_end(i)
+            result[i] = self._cache[i]
+        while len(self._cache) > max(self.cache_chunks, len(chunks)):
+            self._cache.popitem(last=False)
+        return result
+
+    def _chunk_of(self, frames):
+        return np.searchsorted(self._first_frames, frames, side="right") - 1
+
+    def get_frames(self, frames):
+        """Frames by number, in the order given"""
+        frames = np.asarray(frames, dtype=np.int64)
+        frames = np.where(frames < 0, frames + self.n_frames, frames)
+        if np.any((frames < 0) | (frames >= self.n_frames)):
+            raise IndexError("frames out of range ({})".format(self.n_frames))
+        chunk_of = self._chunk_of(frames)
+        chunks = self._get_chunks(sorted(set(chunk_of.tolist())))
+        out = np.empty((len(frames),) + self.frame_shape, dtype=self.dtype)
+        for i, (frame, chunk) in enumerate(zip(frames, chunk_of)):
+            out[i] = chunks[chunk][frame - self._first_frames[chunk]]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.get_frames(np.arange(*key.indices(self.n_frames)))
+        if isinstance(key, (list, tuple, np.ndarray, range)):
+            return self.get_frames(key)
+        return self.get_frames([key])[0]
+
+    def close(self):
+        self._pool.shutdown()
+        self._file.close()
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
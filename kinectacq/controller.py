@@ -0,0 +1,494 @@
+"""
+Controller - starts and stops recording sessions without blocking, reports
+the state and frame counts of each device live, and stops every device
+through a shared event rather than signals
+"""
+
+import asyncio, datetime, functools, sqlite3, time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Array, Barrier, Event, Process
+from tqdm.auto import tqdm
+
+from kinectacq.acquisition import (
+    capture_from_azure,
+    default_devices,
+    is_subordinate,
+    prepare_device,
+)
+from kinectacq.catalog import SessionCatalog
+from kinectacq.resources import plan_cores, print_plan, apply_threads
+from kinectacq.shared_memory import FrameMailbox
+from kinectacq.visualization import display_previews
+
+STATES = ["starting", "recording", "finalizing", "finished", "failed"]
+# a session's cameras are free once every device is in one of these states
+RELEASED_STATES = ["finalizing", "finished", "failed"]
+
+# start_recording settings that are passed on to every capture process as is
+CAPTURE_SETTINGS = [
+    "ir_dtype",
+    "depth_dtype",
+    "depth_function",
+    "ir_function",
+    "ir_display_fcn",
+    "transport",
+    "image_queue_maxsize",
+    "image_queue_policy",
+    "writer_workers",
+    "stream_priority",
+    "telemetry",
+    "preprocess_workers",
+    "n_preprocess_workers",
+]
+
+
+class DeviceStatus:
+    """State and frame counts of a device, in shared memory that its capture
+    process writes and the controller reads, without locks or messages.
+    """
+
+    _FIELDS = ["state", "n_frames", "n_dropped", "started_ns", "updated_ns"]
+
+    def __init__(self):
+        # only the capture process writes, so no lock is needed
+        self._values = Array("q", len(self._FIELDS), lock=False)
+
+    def _get(self, field):
+        return self._values[self._FIELDS.index(field)]
+
+    def _set(self, field, value):
+        self._values[self._FIELDS.index(field)] = value
+
+    @property
+    def state(self):
+        return STATES[self._get("state")]
+
+    def set_state(self, state):
+        now = time.time_ns()
+        if state == "recording":
+            self._set("started_ns", now)
+        self._set("state", STATES.index(state))
+        self._set("updated_ns", now)
+
+    def update(self, n_frames, n_dropped):
+        """Called by the capture process after each capture"""
+        self._set("n_frames", n_frames)
+        self._set("n_dropped", n_dropped)
+        self._set("updated_ns", time.time_ns())
+
+    def as_dict(self):
+        """state, n_frames, n_dropped, elapsed_s (since recording started) and
+        fps (measured)
+        """
+        started_ns, updated_ns = self._get("started_ns"), self._get("updated_ns")
+        elapsed_s = (updated_ns - started_ns) * 1e-9 if started_ns else 0.0
+        n_frames = self._get("n_frames")
+        return {
+            "state": self.state,
+            "n_frames": n_frames,
+            "n_dropped": self._get("n_dropped"),
+            "elapsed_s": round(elapsed_s, 3),
+            "fps": round((n_frames - 1) / elapsed_s, 2) if elapsed_s > 0 else 0.0,
+        }
+
+
+class RecordingSession:
+    """The capture processes of one recording, with the event that stops them
+    and the status of each device
+
+    Args:
+        filename_prefix (pathlib2.Path): Session directory
+        recording_duration (float): Seconds to record, inf until stopped
+    """
+
+    def __init__(self, filename_prefix, recording_duration):
+        self.filename_prefix = filename_prefix
+        self.recording_duration = recording_duration
+        self.stop_event = Event()
+        self.processes = {}
+        self.statuses = {}
+        self.start_time = None
+
+    def stop(self):
+        """Ask every device to stop, without waiting"""
+        self.stop_event.set()
+
+    def state(self, device_name):
+        state = self.statuses[device_name].state
+        process = self.processes[device_name]
+        # a capture process that died before finishing never sets its state
+        if not process.is_alive() and process.exitcode is not None and state != "finished":
+            return "failed"
+        return state
+
+    def status(self):
+        """Status (DeviceStatus.as_dict) of each device, with its process' exitcode"""
+        return {
+            device_name: dict(
+                status.as_dict(),
+                state=self.state(device_name),
+                exitcode=self.processes[device_name].exitcode,
+            )
+            for device_name, status in self.statuses.items()
+        }
+
+    @property
+    def cameras_released(self):
+        return all(self.state(device_name) in RELEASED_STATES for device_name in self.processes)
+
+    @property
+    def is_alive(self):
+        return any(process.is_alive() for process in self.processes.values())
+
+    def join(self, timeout=None):
+        """Wait for every device to finish writing, all at once
+
+        Returns:
+            bool: whether every device has finished
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for process in self.processes.values():
+            process.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return not self.is_alive
+
+
+class RecordingController:
+    """Starts recording sessions from a set of devices, one after the other,
+    without blocking, and stops them through a shared event.
+
+    start returns once the capture processes are running. While recording,
+    status reports the state and frame counts of every device. stop sets the
+    session's stop event, which each capture loop checks after every capture,
+    so every device stops within a frame period, and the writers of all
+    streams of all devices then drain and finalize in parallel. A new session
+    can start as soon as the cameras of the previous one are stopped, while
+    its writers are still finishing. The preview window stays open across
+    sessions until close. Each session is added to the session catalog once
+    all of its devices have finished, from the controller alone, so devices do
+    not write to the catalog concurrently.
+
+        with RecordingController(devices, depth_function=process_depth) as controller:
+            controller.start(DATA_DIR / "mouse1" / timestamp, 600)
+            print(controller.status())
+            controller.stop()
+
+        # or from asyncio
+        await controller.record_async(trial_dir, 60)
+
+    Args:
+        devices (dict, optional): Config info of each device, see start_recording.
+            Defaults to default_devices().
+        warmup (float, optional): Seconds each device runs before its calibration
+            is saved. Defaults to 1.0.
+        warmup_once (bool, optional): Only warm up devices before the first session,
+            as they are still warm for the next ones. Defaults to True.
+        pin_cores (bool, optional): See start_recording. Defaults to False.
+        catalog (bool or pathlib2.Path, optional): Session catalog finished
+            sessions are added to, True for catalog.CATALOG_PATH, or False to
+            not add them. Defaults to True.
+        display_max_fps (int, optional): Refresh rate of the preview window.
+            Defaults to 15.
+        progress (bool, optional): Show a progress bar of the frames written by
+            each device. Defaults to False.
+        fps (float, optional): Frame rate of the devices. Defaults to 30.
+        settings: start_recording settings (see CAPTURE_SETTINGS, and
+            depth_write_frames_kwargs, ir_write_frames_kwargs and
+            color_write_frames_kwargs), passed on to each capture process
+    """
+
+    def __init__(
+        self,
+        devices=None,
+        warmup=1.0,
+        warmup_once=True,
+        pin_cores=False,
+        catalog=True,
+        display_max_fps=15,
+        progress=False,
+        fps=30,
+        **settings
+    ):
+        self.devices = default_devices() if devices is None else devices
+        self.warmup = warmup
+        self.warmup_once = warmup_once
+        self.catalog = catalog
+        self.display_max_fps = display_max_fps
+        self.progress = progress
+        self.fps = fps
+        unknown = set(settings) - set(CAPTURE_SETTINGS) - {
+            "{}_write_frames_kwargs".format(stream) for stream in ["depth", "ir", "color"]
+        }
+        if unknown:
+            raise TypeError("unknown settings: {}".format(sorted(unknown)))
+        self.settings = settings
+        self.session = None
+        self.sessions = []
+        self.subordinates = [
+            device_name
+            for device_name in self.devices
+            if is_subordinate(self.devices[device_name])
+        ]
+
+        # give each capture process, writer and encoder its own cores
+        self.core_plans = {device_name: None for device_name in self.devices}
+        if pin_cores:
+            # the preprocessing pool of each device gets cores of its own
+            inline = settings.get("preprocess_workers", "thread") == "inline"
+            self.core_plans = plan_cores(
+                {
+                    device_name: self._streams(device_name)
+                    for device_name in self.devices
+                },
+                n_preprocess=0 if inline else settings.get("n_preprocess_workers", 2),
+            )
+            print_plan(self.core_plans)
+
+        # a single window shows the newest frames of all devices that display frames
+        self.mailboxes = {
+            (device_name, stream): FrameMailbox()
+            for device_name in self.devices
+            if self.devices[device_name]["process_kwargs"]["display_frames"]
+            for stream in self._streams(device_name)
+        }
+        self.display_stop = None
+        self.display_process = None
+
+    def _streams(self, device_name):
+        save_color = self.devices[device_name]["process_kwargs"]["save_color"]
+        return ["ir", "depth"] + (["color"] if save_color else [])
+
+    def _write_frames_kwargs(self, device_name, stream):
+        kwargs = self.settings.get("{}_write_frames_kwargs".format(stream), {})
+        plan = self.core_plans[device_name]
+        if plan is not None and stream in plan["streams"]:
+            kwargs = apply_threads(kwargs, plan["streams"][stream]["threads"])
+        return kwargs
+
+    def _index(self, sessions):
+        """Add sessions whose devices have all finished to the session catalog"""
+        if not self.catalog or len(sessions) == 0:
+            return
+        try:
+            with SessionCatalog(None if self.catalog is True else self.catalog) as catalog:
+                for session in sessions:
+                    catalog.index_session(session.filename_prefix)
+        except (sqlite3.Error, OSError) as error:
+            print("Could not add sessions to the catalog: {}".format(error))
+
+    def _start_display(self):
+        if len(self.mailboxes) > 0 and self.display_process is None:
+            self.display_stop = Event()
+            self.display_process = Process(
+                target=display_previews,
+                args=(self.mailboxes, self.display_stop),
+                kwargs={"max_fps": self.display_max_fps},
+            )
+            self.display_process.start()
+
+    @property
+    def is_recording(self):
+        """Whether the current session's cameras are still capturing"""
+        return self.session is not None and not self.session.cameras_released
+
+    def start(self, filename_prefix, recording_duration=None, timeout=60):
+        """Open, warm up and start every device, and return once their capture
+        processes are running.
+
+        Args:
+            filename_prefix (pathlib2.Path): Session directory, holding a directory
+                per device
+            recording_duration (float, optional): Seconds to record. Defaults to
+                None (until stop).
+            timeout (float, optional): Seconds to wait for the cameras of the
+                previous session to stop. Defaults to 60.
+
+        Returns:
+            RecordingSession: the session started
+        """
+        previous = self.session
+        if previous is not None and not previous.cameras_released:
+            if (
+                not previous.stop_event.is_set()
+                and time.time() - previous.start_time < previous.recording_duration
+            ):
+                raise RuntimeError("a session is still recording, stop it first")
+            deadline = time.monotonic() + timeout
+            while not previous.cameras_released:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("the previous session's cameras did not stop")
+                time.sleep(0.01)
+        # catalog and forget sessions that have finished writing
+        self._index([session for session in self.sessions if not session.is_alive])
+        self.sessions = [session for session in self.sessions if session.is_alive]
+        self._start_display()
+
+        if recording_duration is None:
+            recording_duration = float("inf")
+        session = RecordingSession(filename_prefix, recording_duration)
+        warmup = 0 if self.warmup_once and previous is not None else self.warmup
+
+        # open every device, let it warm up and save its calibration, concurrently
+        with ThreadPoolExecutor(len(self.devices)) as pool:
+            prepared = {
+                device_name: pool.submit(
+                    prepare_device,
+                    self.devices[device_name],
+                    filename_prefix / device_name,
+                    warmup=warmup,
+                )
+                for device_name in self.devices
+            }
+            prepared = {
+                device_name: future.result() for device_name, future in prepared.items()
+            }
+
+        # subordinates start their cameras before the master, and every device
+        #   waits at the barrier so that capture begins when all of them are ready
+        ready_events = {device_name: Event() for device_name in self.devices}
+        start_barrier = Barrier(len(self.devices))
+
+        for device_name in self.devices:
+            k4a_obj, startup = prepared[device_name]
+            print(
+                "Startup ({}): opened in {}s, calibration saved in {}s".format(
+                    device_name, startup["open_s"], startup["calibration_s"]
+                )
+            )
+            process_kwargs = self.devices[device_name]["process_kwargs"]
+            session.statuses[device_name] = DeviceStatus()
+
+            # create a progress bar for monitoring frame writing
+            pbar_device = None
+            if self.progress:
+                pbar_device = tqdm(
+                    total=None
+                    if recording_duration == float("inf")
+                    else int(self.fps * recording_duration),
+                    desc="{} (frames written)".format(device_name),
+                )
+
+            # create a subprocess to run acqusition with that camera
+            session.processes[device_name] = Process(
+                name=device_name,
+                target=capture_from_azure,
+                args=(k4a_obj, filename_prefix / device_name, recording_duration),
+                kwargs=dict(
+                    {
+                        setting: self.settings[setting]
+                        for setting in CAPTURE_SETTINGS
+                        if setting in self.settings
+                    },
+                    display_frames=process_kwargs["display_frames"],
+                    display_time=process_kwargs["display_time"],
+                    save_color=process_kwargs["save_color"],
+                    depth_write_frames_kwargs=self._write_frames_kwargs(device_name, "depth"),
+                    ir_write_frames_kwargs=self._write_frames_kwargs(device_name, "ir"),
+                    color_write_frames_kwargs=self._write_frames_kwargs(device_name, "color"),
+                    pbar_device=pbar_device,
+                    core_plan=self.core_plans[device_name],
+                    ready_event=ready_events[device_name],
+                    wait_for=tuple(
+                        ready_events[subordinate] for subordinate in self.subordinates
+                    )
+                    if device_name not in self.subordinates
+                    else (),
+                    start_barrier=start_barrier,
+                    display_mailboxes={
+                        stream: mailbox
+                        for (device, stream), mailbox in self.mailboxes.items()
+                        if device == device_name
+                    }
+                    or None,
+                    stop_event=session.stop_event,
+                    status=session.statuses[device_name],
+                ),
+            )
+
+        for device_name in sorted(
+            session.processes, key=lambda device_name: device_name not in self.subordinates
+        ):
+            session.processes[device_name].start()
+        session.start_time = time.time()
+        self.session = session
+        self.sessions.append(session)
+        return session
+
+    def status(self):
+        """Status of each device of the current session (see DeviceStatus.as_dict),
+        or {} if none was started
+        """
+        return {} if self.session is None else self.session.status()
+
+    def stop(self):
+        """Stop the current session's devices, without waiting for them"""
+        if self.session is not None:
+            self.session.stop()
+
+    def wait(self, timeout=None):
+        """Wait for the devices of every session to finish writing
+
+        Returns:
+            bool: whether every device has finished
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for session in self.sessions:
+            session.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        finished = not any(session.is_alive for session in self.sessions)
+        if finished and len(self.sessions) > 0:
+            print("Finished recording: {}".format(datetime.datetime.now()))
+            self._index(self.sessions)
+            self.sessions = []
+        return finished
+
+    def close(self, timeout=None):
+        """Stop recording, wait for the writers and close the preview window"""
+        self.stop()
+        self.wait(timeout)
+        if self.display_process is not None:
+            self.display_stop.set()
+            self.display_process.join()
+            self.display_process = None
+        # devices still writing keep their mapping of the mailboxes
+        for mailbox in self.mailboxes.values():
+            mailbox.close()
+        self.mailboxes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def start_async(self, filename_prefix, recording_duration=None, timeout=60):
+        """start, run in a thread so that the event loop keeps running"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.start, filename_prefix, recording_duration, timeout)
+        )
+
+    async def wait_async(self, poll_interval=0.05):
+        """Wait for the devices of every session to finish writing"""
+        while not self.wait(timeout=0):
+            await asyncio.sleep(poll_interval)
+
+    async def stop_async(self, wait=True, poll_interval=0.01):
+        """Stop the current session, and wait until its cameras are stopped (or,
+        if wait, until its writers are done)
+        """
+        self.stop()
+        while self.is_recording:
+            await asyncio.sleep(poll_interval)
+        if wait:
+            await self.wait_async()
+
+    async def record_async(self, filename_prefix, recording_duration, poll_interval=0.05):
+        """Record a session of recording_duration, returning as soon as its cameras
+        are stopped, so that the next session can start while it is written
+
+        Returns:
+            dict: status of each device at the end of the recording
+        """
+        session = await self.start_async(filename_prefix, recording_duration)
+        while not session.cameras_released:
+            await asyncio.sleep(poll_interval)
+        return session.status()
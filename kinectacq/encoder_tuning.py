@@ -0,0 +1,406 @@
+"""
+Encoder tuning - measures encoder settings on this host, and picks the
+smallest output that keeps up with the cameras
+
+    python -m kinectacq.encoder_tuning --n-cameras 4 --output profile.json
+"""
+
+import itertools, json, os, platform, tempfile, time, click, numpy as np
+from pathlib2 import Path
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where CPU use is not measured
+    resource = None
+
+from kinectacq.range_mapping import RangeMap
+from kinectacq.segments import closed_segments
+from kinectacq.simulation import SimulatedK4A
+from kinectacq.video_io import FrameWriter, _pixel_format
+from kinectacq.video_reader import VideoReader
+
+DEFAULT_GRID = {
+    "codec": ["ffv1", "h264"],
+    "slices": [4, 12, 24],
+    "threads": [1, 2, 4, 6],
+    "crf": [0, 14, 22],
+}
+# pixel formats tried per stream, from the most to the least precise
+DEFAULT_VIDEO_DTYPES = {
+    "depth": ["uint16", "uint8"],
+    "ir": ["uint16", "uint8"],
+    "color": ["uint8"],
+}
+
+
+def candidate_settings(grid=DEFAULT_GRID):
+    """Encoder settings for every combination in grid. crf only matters for
+    h264, so ffv1 is tried once per slices and threads.
+    """
+    candidates = []
+    for codec, slices, threads in itertools.product(
+        grid["codec"], grid["slices"], grid["threads"]
+    ):
+        for crf in grid["crf"] if codec != "ffv1" else grid["crf"][:1]:
+            candidates.append(
+                {"codec": codec, "slices": slices, "threads": threads, "crf": crf}
+            )
+    return candidates
+
+
+def synthetic_frames(n_frames=150, streams=("depth", "ir"), **simulation_kwargs):
+    """Frames of a SimulatedK4A, per stream"""
+    k4a = SimulatedK4A(fps=0, **simulation_kwargs)
+    k4a.start()
+    captures = [k4a.get_capture() for _ in range(n_frames)]
+    k4a.stop()
+    return {
+        stream: np.stack([getattr(capture, stream) for capture in captures])
+        for stream in streams
+    }
+
+
+def recorded_frames(device_dir, n_frames=150, streams=("depth", "ir")):
+    """The first frames of each stream recorded by a device, from its video, or
+    from its first closed segments if it was recorded in segments
+    """
+    frames = {}
+    for stream in streams:
+        video = Path(device_dir) / "{}.avi".format(stream)
+        videos = [video] if video.exists() else closed_segments(video)
+        if len(videos) == 0:
+            raise FileNotFoundError(
+                "no {} video or closed segments in {}".format(stream, device_dir)
+            )
+        parts, n_read = [], 0
+        for filename in videos:
+            with VideoReader(filename) as reader:
+                parts.append(reader[: min(n_frames - n_read, len(reader))])
+            n_read += len(parts[-1])
+            if n_read >= n_frames:
+                break
+        frames[stream] = np.concatenate(parts)
+    return frames
+
+
+def fit_range_map(frames, percentiles=(0.5, 99.5)):
+    """RangeMap converting 16-bit frames to 8-bit over the range of their valid
+    (non-zero) values, as the depth_function or ir_function of a recording
+    would, so that 8-bit encoders are measured on what they would encode
+    """
+    if frames.dtype == np.int16:
+        frames = frames.view(np.uint16)
+    valid = frames[frames > 0]
+    if valid.size == 0:
+        return RangeMap()
+    low, high = (int(value) for value in np.percentile(valid, percentiles))
+    return RangeMap(low, max(high, low + 1))
+
+
+def _range_map_settings(range_map):
+    """JSON settings of a RangeMap, from which load_profile recreates it"""
+    return {key: value for key, value in range_map.settings.items() if key != "dtype"}
+
+
+def _children_cpu_seconds():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure_encoder(frames, settings, video_dtype, filename, fps=30):
+    """Encode frames with FrameWriter and measure how fast and how small.
+
+    Args:
+        frames (np.array): Frames to encode
+        settings (dict): Encoder settings (write_frames kwargs)
+        video_dtype (str): dtype of the video, "uint8" or "uint16"
+        filename (pathlib2.Path): Where the test video is written
+        fps (int, optional): Frame rate of the video. Defaults to 30.
+
+    Returns:
+        dict: encode_fps, cpu_percent (of one core, while encoding) and
+            cpu_ms_per_frame (None if unknown), and bytes_per_frame
+    """
+    video_dtype = np.dtype(video_dtype).type
+    pixel_format = "rgb24" if frames.ndim == 4 else _pixel_format(video_dtype)
+    writer = FrameWriter(
+        filename,
+        video_dtype=video_dtype,
+        pixel_format=pixel_format,
+        fps=fps,
+        slicecrc=1,
+        **settings
+    )
+    cpu_start = _children_cpu_seconds()
+    t0 = time.perf_counter()
+    for start in range(0, len(frames), writer.max_batch):
+        writer.write(list(frames[start : start + writer.max_batch]))
+    writer.close()
+    elapsed = time.perf_counter() - t0
+    cpu_seconds = None if cpu_start is None else _children_cpu_seconds() - cpu_start
+    return {
+        "encode_fps": round(len(frames) / elapsed, 1),
+        "cpu_percent": None if cpu_seconds is None else round(100 * cpu_seconds / elapsed, 1),
+        "cpu_ms_per_frame": None
+        if cpu_seconds is None
+        else round(1000 * cpu_seconds / len(frames), 3),
+        "bytes_per_frame": int(os.path.getsize(filename) / len(frames)),
+    }
+
+
+def _cpu_percent(choice, fps, n_cameras):
+    """CPU needed to encode the chosen settings of every stream of every camera
+    (percent of one core)
+    """
+    return (
+        sum(result["cpu_ms_per_frame"] or 0 for result in choice.values())
+        * fps
+        * n_cameras
+        / 10
+    )
+
+
+def select_profile(results, fps=30, n_cameras=1, headroom=1.5, cpu_budget=None):
+    """Pick the settings of each stream with the smallest output that sustains
+    n_cameras at fps.
+
+    A setting is considered if a single encoder runs headroom times faster
+    than fps. Each stream keeps its most precise pixel format with such a
+    setting, and starts from the one with the smallest output. While all
+    encoders together need more CPU than cpu_budget, the stream change that
+    saves the most CPU per byte added is made.
+
+    Args:
+        results (dict): Results of measure_encoder (with settings and
+            video_dtype) per stream
+        fps (int, optional): Frame rate of the cameras. Defaults to 30.
+        n_cameras (int, optional): Cameras recorded at once. Defaults to 1.
+        headroom (float, optional): Speed above fps an encoder needs. Defaults to 1.5.
+        cpu_budget (float, optional): CPU (percent of one core) the encoders can use.
+            Defaults to 75% of every core.
+
+    Returns:
+        dict: chosen result per stream
+        bool: whether the choice fits within cpu_budget
+    """
+    if cpu_budget is None:
+        cpu_budget = 75 * (os.cpu_count() or 1)
+    options = {}
+    for stream, stream_results in results.items():
+        fast = [r for r in stream_results if r["encode_fps"] >= fps * headroom]
+        if len(fast) == 0:
+            raise ValueError("no encoder setting keeps up with {} at {} fps".format(stream, fps))
+        precise = [r for r in fast if r["video_dtype"] == fast[0]["video_dtype"]]
+        options[stream] = sorted(precise, key=lambda r: r["bytes_per_frame"])
+
+    choice = {stream: stream_options[0] for stream, stream_options in options.items()}
+    while _cpu_percent(choice, fps, n_cameras) > cpu_budget:
+        changes = []
+        for stream, stream_options in options.items():
+            current = choice[stream]
+            for option in stream_options:
+                saved = (current["cpu_ms_per_frame"] or 0) - (option["cpu_ms_per_frame"] or 0)
+                if saved > 0:
+                    added = option["bytes_per_frame"] - current["bytes_per_frame"]
+                    changes.append((added / saved, stream, option))
+        if len(changes) == 0:
+            return choice, False
+        _, stream, option = min(changes, key=lambda change: change[0])
+        choice[stream] = option
+    return choice, True
+
+
+def tune_encoders(
+    output=None,
+    frames=None,
+    source=None,
+    streams=("depth", "ir"),
+    n_frames=150,
+    fps=30,
+    n_cameras=1,
+    grid=DEFAULT_GRID,
+    video_dtypes=DEFAULT_VIDEO_DTYPES,
+    range_maps=None,
+    headroom=1.5,
+    cpu_budget=None,
+    verbose=True,
+):
+    """Measure every candidate encoder setting for each stream, and save the
+    smallest-output settings that sustain n_cameras at fps as a profile.
+
+        profile = tune_encoders("encoder_profile.json", n_cameras=4)
+        start_recording(filename_prefix, recording_duration, **load_profile("encoder_profile.json"))
+
+    Args:
+        output (pathlib2.Path, optional): Where the profile (JSON) is saved. Defaults
+            to None (not saved).
+        frames (dict, optional): Frames (np.array) to encode per stream. Defaults to
+            the frames of source, or synthetic frames.
+        source (pathlib2.Path, optional): Device directory of a recording to take
+            frames from, recorded in one video or in segments. Defaults to None.
+        streams (tuple, optional): Streams to tune. Defaults to ("depth", "ir").
+        n_frames (int, optional): Frames encoded per setting. Defaults to 150.
+        fps (int, optional): Frame rate of the cameras. Defaults to 30.
+        n_cameras (int, optional): Cameras recorded at once. Defaults to 1.
+        grid (dict, optional): codec, slices, threads and crf values to combine.
+            Defaults to DEFAULT_GRID.
+        video_dtypes (dict, optional): Pixel formats tried per stream, most precise
+            first. Defaults to DEFAULT_VIDEO_DTYPES.
+        range_maps (dict, optional): RangeMap per stream, converting 16-bit frames
+            for the uint8 candidates. It is saved in the profile, and used as the
+            stream's depth_function or ir_function by load_profile. Defaults to
+            fit_range_map of each stream's frames.
+        headroom (float, optional): See select_profile. Defaults to 1.5.
+        cpu_budget (float, optional): See select_profile. Defaults to None.
+        verbose (bool, optional): Print each measurement. Defaults to True.
+
+    Returns:
+        dict: profile, with the write_frames kwargs and dtype of each stream, and
+            every measurement
+    """
+    if frames is None:
+        if source is not None:
+            frames = recorded_frames(source, n_frames, streams)
+        else:
+            frames = synthetic_frames(n_frames, streams)
+    # 16-bit depth and IR are range mapped before 8-bit encoding, as when recording
+    range_maps = dict(range_maps or {})
+    for stream in streams:
+        if frames[stream].ndim == 3 and frames[stream].dtype != np.uint8:
+            range_maps.setdefault(stream, fit_range_map(frames[stream]))
+        else:
+            range_maps[stream] = None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for stream in streams:
+            results[stream] = []
+            for video_dtype in video_dtypes[stream]:
+                stream_frames = frames[stream]
+                if video_dtype == "uint8" and range_maps[stream] is not None:
+                    stream_frames = range_maps[stream](stream_frames)
+                for settings in candidate_settings(grid):
+                    # h264 has no 16-bit grayscale
+                    if video_dtype == "uint16" and settings["codec"] != "ffv1":
+                        continue
+                    result = measure_encoder(
+                        stream_frames,
+                        settings,
+                        video_dtype,
+                        Path(tmp) / "{}.avi".format(stream),
+                        fps=fps,
+                    )
+                    result.update(settings=settings, video_dtype=video_dtype)
+                    results[stream].append(result)
+                    if verbose:
+                        print(
+                            "{:<6} {:<6} {} -> {} fps, {}% cpu, {} bytes/frame".format(
+                                stream,
+                                video_dtype,
+                                settings,
+                                result["encode_fps"],
+                                result["cpu_percent"],
+                                result["bytes_per_frame"],
+                            )
+                        )
+
+    choice, sustainable = select_profile(
+        results, fps=fps, n_cameras=n_cameras, headroom=headroom, cpu_budget=cpu_budget
+    )
+    profile = {
+        "host": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "fps": fps,
+        "n_cameras": n_cameras,
+        "sustainable": sustainable,
+        "cpu_percent": round(_cpu_percent(choice, fps, n_cameras), 1),
+        "streams": {
+            stream: {
+                "write_frames_kwargs": dict(
+                    result["settings"], fps=fps, slicecrc=1, frame_size=None, get_cmd=False
+                ),
+                "video_dtype": result["video_dtype"],
+                "range_map": _range_map_settings(range_maps[stream])
+                if result["video_dtype"] == "uint8" and range_maps[stream] is not None
+                else None,
+                "encode_fps": result["encode_fps"],
+                "bytes_per_frame": result["bytes_per_frame"],
+            }
+            for stream, result in choice.items()
+        },
+        "results": results,
+    }
+    if verbose:
+        print(
+            "Selected ({}sustainable for {} cameras):".format(
+                "" if sustainable else "not ", n_cameras
+            )
+        )
+        for stream, stream_profile in profile["streams"].items():
+            print("  {:<6} {}".format(stream, stream_profile))
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(profile, f, indent=2)
+    return profile
+
+
+def load_profile(path, depth_function=None, ir_function=None):
+    """start_recording kwargs (writer settings, dtypes, and the range mapping of
+    8-bit depth and IR) from a saved profile
+
+    Args:
+        path (pathlib2.Path): Profile saved by tune_encoders
+        depth_function, ir_function (function, optional): Used instead of the
+            profile's range mapping. Defaults to None.
+
+    Returns:
+        dict: start_recording kwargs
+    """
+    with open(path) as f:
+        profile = json.load(f)
+    functions = {"depth": depth_function, "ir": ir_function}
+    kwargs = {}
+    for stream, stream_profile in profile["streams"].items():
+        kwargs["{}_write_frames_kwargs".format(stream)] = stream_profile["write_frames_kwargs"]
+        if stream not in functions:
+            continue
+        video_dtype = np.dtype(stream_profile["video_dtype"]).type
+        kwargs["{}_dtype".format(stream)] = video_dtype
+        function = functions[stream]
+        if function is None and stream_profile.get("range_map") is not None:
+            function = RangeMap(**stream_profile["range_map"])
+        # 16-bit frames cast to 8 bits would wrap around
+        if function is None and video_dtype == np.uint8:
+            raise ValueError(
+                "{} is 8-bit in {} but has no range mapping, pass {}_function".format(
+                    stream, path, stream
+                )
+            )
+        if function is not None:
+            kwargs["{}_function".format(stream)] = function
+    return kwargs
+
+
+@click.command()
+@click.option("--output", default="encoder_profile.json", help="Where the profile is saved")
+@click.option("--source", default=None, help="Device directory of a recording to take frames from")
+@click.option("--n-cameras", default=1, help="Cameras recorded at once")
+@click.option("--fps", default=30, help="Frame rate of the cameras")
+@click.option("--n-frames", default=150, help="Frames encoded per setting")
+@click.option("--color/--no-color", default=False, help="Also tune the color stream")
+def main(output, source, n_cameras, fps, n_frames, color):
+    tune_encoders(
+        output,
+        source=source,
+        streams=("depth", "ir", "color") if color else ("depth", "ir"),
+        n_frames=n_frames,
+        fps=fps,
+        n_cameras=n_cameras,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Frame index - presentation time, keyframe flag and device timestamp of each
+frame of a video, saved in a sidecar file next to it
+"""
+
+import os, subprocess, numpy as np
+from pathlib2 import Path
+
+
+def build_frame_index(filename, fps=None):
+    """Presentation time and keyframe flag of every frame, from a single pass
+    over the packets of the video (without decoding it).
+
+    Args:
+        filename (pathlib2.Path): Video file
+        fps (float, optional): Used for packets without a timestamp. Defaults to None.
+
+    Returns:
+        np.array: presentation time of each frame (s), in display order
+        np.array: whether each frame is a keyframe
+    """
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,dts_time,flags",
+        "-of",
+        "csv=p=0",
+        str(filename),
+    ]
+    out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode != 0:
+        raise IOError("could not index {}: {}".format(filename, out.stderr.decode()))
+    pts, keyframe = [], []
+    for i, line in enumerate(out.stdout.decode().splitlines()):
+        pts_time, dts_time, flags = (line.split(",") + ["", "", ""])[:3]
+        for value in [pts_time, dts_time]:
+            if value not in ["", "N/A"]:
+                pts.append(float(value))
+                break
+        else:
+            pts.append(i / fps if fps else float(i))
+        keyframe.append("K" in flags)
+    order = np.argsort(pts, kind="stable")
+    return np.array(pts)[order], np.array(keyframe)[order]
+
+
+class FrameIndex:
+    """Presentation time, keyframe flag and device timestamp of each frame of
+    a video, saved next to it ({video}.index.npz).
+
+    FrameWriter saves the index of each video it records, so readers never
+    need to probe the video. For older recordings, the index is built once
+    from the video's packets, without device timestamps, and saved.
+
+    Args:
+        pts_time (np.array): Presentation time of each frame (s)
+        keyframe (np.array): Whether each frame is a keyframe
+        timestamps (np.array, optional): Device timestamp of each frame (usec),
+            0 where unknown. Defaults to None (unknown).
+    """
+
+    def __init__(self, pts_time, keyframe, timestamps=None):
+        self.pts_time = np.asarray(pts_time, dtype=np.float64)
+        self.keyframe = np.asarray(keyframe, dtype=bool)
+        if timestamps is None:
+            timestamps = np.zeros(len(self.pts_time), dtype=np.uint64)
+        self.timestamps = np.asarray(timestamps, dtype=np.uint64)
+
+    @classmethod
+    def from_recording(cls, n_frames, fps, timestamps=None, intra_only=False):
+        """Index of a video written at a constant frame rate
+
+        Args:
+            n_frames (int): Frames in the video
+            fps (float): Frame rate the video was written with
+            timestamps (np.array, optional): Device timestamp of each frame (usec)
+            intra_only (bool, optional): Whether every frame is a keyframe (e.g.
+                ffv1), otherwise only the first is known to be. Defaults to False.
+        """
+        keyframe = np.full(n_frames, intra_only, dtype=bool)
+        keyframe[:1] = True
+        return cls(np.arange(n_frames) / fps, keyframe, timestamps)
+
+    def __len__(self):
+        return len(self.pts_time)
+
+    @staticmethod
+    def path(filename):
+        filename = Path(filename)
+        return filename.parent / (filename.name + ".index.npz")
+
+    @classmethod
+    def load(cls, filename, fps=None, build=True):
+        """Load the index of a video, building and saving it if it is missing
+        or older than the video
+
+        Args:
+            filename (pathlib2.Path): Video file
+            fps (float, optional): Frame rate, for packets without timestamps
+            build (bool, optional): Whether to build a missing index. Defaults to True.
+
+        Returns:
+            FrameIndex: the index, or None if it is missing and build is False
+        """
+        path = cls.path(filename)
+        if path.exists() and os.path.getmtime(path) >= os.path.getmtime(filename):
+            with np.load(path) as index:
+                return cls(
+                    index["pts_time"],
+                    index["keyframe"],
+                    index["timestamps"] if "timestamps" in index else None,
+                )
+        if not build:
+            return None
+        index = cls(*build_frame_index(filename, fps=fps))
+        try:
+            index.save(path)
+        except OSError:
+            # read-only directory, the index is rebuilt next time
+            pass
+        return index
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                pts_time=self.pts_time,
+                keyframe=self.keyframe,
+                timestamps=self.timestamps,
+            )
+
+    def keyframe_before(self, frame):
+        """The last keyframe at or before frame, where decoding to it starts"""
+        keyframes = np.flatnonzero(self.keyframe[: frame + 1])
+        return int(keyframes[-1]) if len(keyframes) > 0 else 0
+
+    def seek_time(self, frame):
+        """Time to seek to for decoding to start exactly at frame, a keyframe
+        (see keyframe_before). ffmpeg does not drop the frames before the seek
+        time of every video (e.g. h264 in AVI), so seeking elsewhere than a
+        keyframe starts at the keyframe before it.
+        """
+        if frame == 0:
+            return 0.0
+        # ffmpeg rounds to the nearest frame, a quarter of a frame early stays
+        #   clear of the previous one
+        previous = self.pts_time[frame - 1]
+        return self.pts_time[frame] - (self.pts_time[frame] - previous) / 4
@@ -0,0 +1,181 @@
+"""
+Frame log - an append-only, crash-safe binary log of per-frame timestamps
+and drops, readable while recording
+"""
+
+import json, os, time, numpy as np
+from pathlib2 import Path
+
+MAGIC = b"KACQFLG1"
+# magic, is_writing flag, metadata length
+_PREAMBLE = np.dtype([("magic", "S8"), ("is_writing", "<u8"), ("metadata_len", "<u8")])
+
+# kinds of record. Drops are appended as separate records, since a frame
+#   can be dropped from a queue long after its record has been written
+FRAME = 0
+DROPPED = 1
+
+
+def record_dtype(streams):
+    """Structured dtype of one record of a log with these streams"""
+    fields = [("kind", "<u4"), ("frame", "<i8"), ("system_ns", "<u8")]
+    fields += [("{}_timestamp_usec".format(stream), "<u8") for stream in streams]
+    fields += [("{}_dropped".format(stream), "?") for stream in streams]
+    return np.dtype(fields, align=True)
+
+
+class FrameLog:
+    """Appends one fixed-size record per frame (frame index, system time and
+    device timestamp of each stream) to a binary file.
+
+    Records are collected in a pre-allocated chunk and written out whenever
+    it fills up, so memory use is constant however long the recording is,
+    and at most one chunk is lost if the process dies. The file starts with
+    a small header holding an `is_writing` flag (replacing the is_writing.npy
+    marker) and JSON metadata, followed by the records, so it can be read at
+    any time with `load_frame_log`.
+
+    Args:
+        path (pathlib2.Path): Log file, overwritten if it exists
+        streams (list): Stream names, e.g. ["ir", "depth", "color"]
+        metadata (dict, optional): Saved in the header (e.g. samplerate). Defaults to {}.
+        chunk_size (int, optional): Records written to disk at once. Defaults to 30.
+        fsync (bool, optional): Whether each chunk is also synced to disk, to
+            survive a power failure and not only a crash. Defaults to False.
+    """
+
+    def __init__(self, path, streams, metadata={}, chunk_size=30, fsync=False):
+        self.path = Path(path)
+        self.streams = list(streams)
+        self.dtype = record_dtype(self.streams)
+        self.chunk = np.zeros(chunk_size, dtype=self.dtype)
+        self._blank = np.zeros((), dtype=self.dtype)
+        self.fsync = fsync
+        self.n_frames = 0
+        self.first_system_ns = None
+        self.last_system_ns = None
+        self._n_chunk = 0
+
+        metadata = dict(
+            metadata, streams=self.streams, start_time=time.time(), version=1
+        )
+        metadata = json.dumps(metadata, default=str).encode("utf8")
+        # pad the metadata so that records are aligned
+        metadata += b" " * (-(len(metadata) + _PREAMBLE.itemsize) % 8)
+        preamble = np.array([(MAGIC, 1, len(metadata))], dtype=_PREAMBLE)
+        self._file = open(self.path, "w+b")
+        self._file.write(preamble.tobytes() + metadata)
+        self._file.flush()
+
+    def append(self, system_ns, timestamps, dropped={}):
+        """Log a frame.
+
+        Args:
+            system_ns (int): Host time the frame was captured (time.time_ns)
+            timestamps (dict): Device timestamp (usec) per stream
+            dropped (dict, optional): Whether each stream's image was missing
+                from the capture. Defaults to {}.
+        """
+        record = self.chunk[self._n_chunk]
+        record["kind"] = FRAME
+        record["frame"] = self.n_frames
+        record["system_ns"] = system_ns
+        for stream in self.streams:
+            record["{}_timestamp_usec".format(stream)] = timestamps.get(stream, 0)
+            record["{}_dropped".format(stream)] = dropped.get(stream, False)
+        if self.first_system_ns is None:
+            self.first_system_ns = system_ns
+        self.last_system_ns = system_ns
+        self.n_frames += 1
+        self._next()
+
+    def mark_dropped(self, stream, timestamps):
+        """Log frames of a stream that were dropped after being captured (e.g.
+        by a full queue), identified by their device timestamps (usec)
+        """
+        for timestamp in timestamps:
+            self.chunk[self._n_chunk] = self._blank
+            record = self.chunk[self._n_chunk]
+            record["kind"] = DROPPED
+            record["frame"] = -1
+            record["{}_timestamp_usec".format(stream)] = timestamp
+            record["{}_dropped".format(stream)] = True
+            self._next()
+
+    def _next(self):
+        self._n_chunk += 1
+        if self._n_chunk == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        """Write the records collected so far to disk"""
+        if self._n_chunk > 0:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(memoryview(self.chunk[: self._n_chunk]).cast("B"))
+            self._n_chunk = 0
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _set_writing(self, is_writing):
+        self._file.seek(_PREAMBLE.fields["is_writing"][1])
+        self._file.write(np.uint64(is_writing).tobytes())
+
+    def close(self):
+        """Write the remaining records, and mark the log as finished"""
+        if self._file.closed:
+            return
+        self.flush()
+        self._set_writing(False)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def _read_header(path):
+    with open(path, "rb") as f:
+        preamble = np.frombuffer(f.read(_PREAMBLE.itemsize), dtype=_PREAMBLE)[0]
+        if preamble["magic"] != MAGIC:
+            raise ValueError("{} is not a frame log".format(path))
+        metadata = json.loads(f.read(int(preamble["metadata_len"])).decode("utf8"))
+    metadata["is_writing"] = bool(preamble["is_writing"])
+    offset = _PREAMBLE.itemsize + int(preamble["metadata_len"])
+    return metadata, offset
+
+
+def load_frame_log(path):
+    """Read a frame log, also while it is being written, or after a crash.
+
+    Drops logged after the frame are applied to the frame's dropped flags,
+    and a partially written last record is ignored.
+
+    Args:
+        path (pathlib2.Path): Log file
+
+    Returns:
+        np.array: one record per frame, with fields frame, system_ns, and
+            {stream}_timestamp_usec and {stream}_dropped for each stream
+        dict: metadata, including streams and whether the log is still being
+            written (is_writing)
+    """
+    metadata, offset = _read_header(path)
+    dtype = record_dtype(metadata["streams"])
+    n_records = (os.path.getsize(path) - offset) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype), metadata
+    records = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(n_records,))
+    frames = np.array(records[records["kind"] == FRAME])
+    drops = records[records["kind"] == DROPPED]
+    for stream in metadata["streams"]:
+        timestamp, flag = "{}_timestamp_usec".format(stream), "{}_dropped".format(stream)
+        dropped = drops[timestamp][drops[flag]]
+        if len(dropped) > 0:
+            frames[flag] |= np.isin(frames[timestamp], dropped)
+    del records
+    return frames, metadata
+
+
+def is_writing(path):
+    """Whether a frame log is still being written"""
+    metadata, _ = _read_header(path)
+    return metadata["is_writing"]
@@ -1,11 +1,13 @@
 from pathlib2 import Path
 import pathlib2
 import os
+import sqlite3
 from datetime import datetime
-import numpy as np
 
 PROJECT_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = PROJECT_DIR / "data"
+# name of each session directory, the time the session was started
+SESSION_FORMAT = "%Y-%m-%d_%H-%M-%S"
 
 
 def ensure_dir(file_path):
@@ -29,18 +31,61 @@ def ensure_dir(file_path):
             file_path.mkdir(parents=True, exist_ok=True)
 
 
-def most_recent_subdirectory(dataset_loc):
-    """eturn the subdirectory that has been generated most
+def session_time(path):
+    """Time a session was started, from its name, or None if it is not named
+    with the "%Y-%m-%d_%H-%M-%S" time scheme
+    """
+    try:
+        return datetime.strptime(Path(path).name, SESSION_FORMAT)
+    except ValueError:
+        return None
+
+
+def is_session(path):
+    """Whether a directory is named with the "%Y-%m-%d_%H-%M-%S" time scheme"""
+    return session_time(path) is not None and Path(path).is_dir()
+
+
+def most_recent_subdirectory(dataset_loc, catalog=False):
+    """Return the subdirectory that has been generated most
     recently with the "%Y-%m-%d_%H-%M-%S" time scheme.
 
+    The directory is listed and only the folder names are parsed, folders
+    that are not named with the time scheme are ignored. To find sessions
+    without listing the directory (e.g. on network storage), use the indexed
+    catalog.SessionCatalog.most_recent instead. If catalog is given, the
+    catalog is also brought in line with the listing (see SessionCatalog.sync)
+    when its most recent session differs.
+
     Args:
         dataset_loc (pathlib2.Path): Path to directory of folders
+        catalog (bool or pathlib2.Path, optional): Session catalog to sync,
+            True for catalog.CATALOG_PATH. Defaults to False (none).
 
     Returns:
-        [type]: [description]
+        pathlib2.Path: the most recent session directory
     """
-    subdir_list = list((dataset_loc).iterdir())
-    directory_dates = [
-        datetime.strptime(i.name, "%Y-%m-%d_%H-%M-%S") for i in subdir_list
-    ]
-    return subdir_list[np.argsort(directory_dates)[-1]]
+    sessions = sorted(
+        (
+            (session_time(path), path)
+            for path in Path(dataset_loc).iterdir()
+            if session_time(path) is not None
+        ),
+        reverse=True,
+    )
+    # only the newest candidates are checked to be directories
+    newest = next((path for _, path in sessions if path.is_dir()), None)
+    if newest is None:
+        raise FileNotFoundError("no session directories in {}".format(dataset_loc))
+
+    if catalog:
+        from kinectacq.catalog import SessionCatalog
+
+        try:
+            with SessionCatalog(None if catalog is True else catalog) as session_catalog:
+                cataloged = session_catalog.most_recent(parent=dataset_loc)
+                if len(cataloged) == 0 or cataloged[0]["path"] != str(newest.resolve()):
+                    session_catalog.sync(dataset_loc)
+        except (sqlite3.Error, OSError) as error:
+            print("Could not update the session catalog: {}".format(error))
+    return newest
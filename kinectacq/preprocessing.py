@@ -0,0 +1,185 @@
+"""
+Preprocessing - runs depth_function, ir_function and color_function on a pool
+of workers between the capture loop and the writers
+"""
+
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from queue import Queue
+
+from kinectacq.telemetry import Histogram, print_summary
+from kinectacq.resources import set_affinity
+
+PREPROCESS_WORKERS = ["inline", "thread", "process"]
+
+# set in each worker process, so that functions are only pickled once
+_process_functions = None
+
+
+def apply_functions(functions, frames):
+    """Cast each stream's frame (if it is not of dtype already) and run its
+    function on it.
+
+    Args:
+        functions (dict): (dtype, function or None) per stream
+        frames (dict): Frame (np.array, or None if dropped) per stream
+
+    Returns:
+        dict: processed frame per stream
+        dict: duration of each function (us)
+    """
+    durations = {}
+    for stream, frame in frames.items():
+        if frame is None or stream not in functions:
+            continue
+        dtype, function = functions[stream]
+        frame = frame.astype(dtype, copy=False)
+        if function is not None:
+            t0 = time.perf_counter_ns()
+            frame = function(frame)
+            durations["{}_function".format(stream)] = (time.perf_counter_ns() - t0) / 1000
+        frames[stream] = frame
+    return frames, durations
+
+
+def _init_process(functions, cores=None):
+    global _process_functions
+    _process_functions = functions
+    if cores is not None:
+        set_affinity(cores)
+
+
+def _apply_in_process(frames):
+    return apply_functions(_process_functions, frames)
+
+
+class PreprocessStage:
+    """Preprocesses captured frames on a pool of threads or processes, and
+    hands them on in the order they were captured.
+
+    The capture loop only calls `put`, which returns as soon as the frames
+    are submitted. A dispatcher thread waits for each result in order and
+    passes it to `deliver` (e.g. putting it on the writer queues). At most
+    max_pending captures are in flight; beyond that `put` waits, which holds
+    back the capture loop like a full queue would.
+
+    The time each function takes is kept per stream, reported on close and,
+    if a Telemetry is given, recorded as a stage ("depth_function", ...).
+
+    Args:
+        functions (dict): (dtype, function or None) per stream. Frames are cast
+            to dtype, then passed through function.
+        deliver (function): Called with (frames, timestamps) for each capture,
+            in order, from the dispatcher thread (or inline)
+        workers (str, optional): "thread", "process" (functions and frames must
+            be picklable) or "inline" (in the capture loop). Defaults to "thread".
+        n_workers (int, optional): Size of the pool. Defaults to 2.
+        max_pending (int, optional): Captures in flight. Defaults to 4 * n_workers.
+        telemetry (Telemetry, optional): Where function timings are recorded.
+            Defaults to None.
+        name (str, optional): Name used when reporting. Defaults to "preprocess".
+        cores (list, optional): CPU cores the workers and dispatcher are pinned
+            to, whatever the affinity of the capture loop. Defaults to None
+            (inherited).
+    """
+
+    def __init__(
+        self,
+        functions,
+        deliver,
+        workers="thread",
+        n_workers=2,
+        max_pending=None,
+        telemetry=None,
+        name="preprocess",
+        cores=None,
+    ):
+        if workers not in PREPROCESS_WORKERS:
+            raise ValueError("preprocess workers {} has not been defined".format(workers))
+        self.functions = functions
+        self.deliver = deliver
+        self.workers = workers
+        self.telemetry = telemetry
+        self.name = name
+        self.timings = {}
+        self.error = None
+        self.start_time = time.time()
+        self.cores = cores
+
+        if workers == "inline":
+            return
+        if workers == "thread":
+            self._pool = ThreadPoolExecutor(
+                n_workers,
+                initializer=None if cores is None else set_affinity,
+                initargs=() if cores is None else (cores,),
+            )
+        else:
+            self._pool = ProcessPoolExecutor(
+                n_workers, initializer=_init_process, initargs=(functions, cores)
+            )
+        self._pending = Queue(maxsize=max_pending or 4 * n_workers)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def put(self, frames, timestamps):
+        """Preprocess the frames of a capture.
+
+        Args:
+            frames (dict): Frame (np.array, or None if dropped) per stream
+            timestamps (dict): Device timestamp (usec) per stream
+        """
+        if self.error is not None:
+            raise self.error
+        if self.workers == "inline":
+            self._deliver(apply_functions(self.functions, frames), timestamps)
+        elif self.workers == "thread":
+            self._pending.put(
+                (self._pool.submit(apply_functions, self.functions, frames), timestamps)
+            )
+        else:
+            self._pending.put((self._pool.submit(_apply_in_process, frames), timestamps))
+
+    def _deliver(self, result, timestamps):
+        frames, durations = result
+        for function, duration_us in durations.items():
+            if function not in self.timings:
+                self.timings[function] = Histogram()
+            self.timings[function].add(duration_us)
+            if self.telemetry is not None:
+                self.telemetry.record_duration(function, duration_us)
+        self.deliver(frames, timestamps)
+
+    def _dispatch(self):
+        if self.cores is not None:
+            set_affinity(self.cores)
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            future, timestamps = item
+            try:
+                self._deliver(future.result(), timestamps)
+            except Exception as error:
+                # raised in the capture loop on the next put
+                self.error = error
+                print("{}: {!r}".format(self.name, error))
+
+    def close(self, verbose=True):
+        """Wait for the frames in flight to be delivered, and report timings"""
+        if self.workers != "inline":
+            self._pending.put(None)
+            self._dispatcher.join()
+            self._pool.shutdown()
+        if verbose and len(self.timings) > 0:
+            print_summary(
+                self.name,
+                {
+                    "duration_s": round(time.time() - self.start_time, 3),
+                    "stages": {
+                        function: histogram.summary()
+                        for function, histogram in self.timings.items()
+                    },
+                    "counters": {},
+                },
+            )
@@ -0,0 +1,297 @@
+"""
+Queues - bounded frame queues with a policy for when they are full
+"""
+
+import pickle, tempfile, numpy as np
+from collections import deque
+from pathlib2 import Path
+from queue import Empty, Full
+
+from kinectacq.paths import ensure_dir
+
+QUEUE_POLICIES = ["block", "drop_oldest", "drop_newest", "spill"]
+
+
+class _Spilled:
+    """Placeholder passed through the queue for frames written to disk"""
+
+    def __init__(self, path):
+        self.path = path
+
+
+class FrameQueue:
+    """Wraps a multiprocessing.Queue (or FrameRingBuffer) with a policy for
+    what happens to new frames when the queue is full.
+
+    Policies:
+        block: wait until the consumer has made room
+        drop_oldest: discard the oldest queued frame to make room
+        drop_newest: discard the frame being put
+        spill: write the frame to disk, and pass the consumer a reference to it
+            once the queue has room again. Frames stay in order.
+
+    Every frame that is discarded is recorded with its device timestamp in
+    `dropped_timestamps`. Accounting happens in the producer process, so
+    the counts are only valid there.
+
+    Args:
+        queue (multiprocessing.Queue or FrameRingBuffer): The underlying queue.
+            Bound it with `Queue(maxsize=...)`.
+        policy (str, optional): One of QUEUE_POLICIES. Defaults to "block".
+        spill_dir (pathlib2.Path, optional): Where to spill frames to. Defaults
+            to a temporary directory.
+        name (str, optional): Name used when reporting. Defaults to "queue".
+        maxsize (int, optional): Size the underlying queue was bounded to, used
+            to report how full it is. Defaults to the number of slots of a
+            FrameRingBuffer, otherwise 0 (unbounded).
+    """
+
+    def __init__(self, queue, policy="block", spill_dir=None, name="queue", maxsize=None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("queue policy {} has not been defined".format(policy))
+        self.in_place = getattr(queue, "in_place", False)
+        if self.in_place and policy not in ["block", "drop_newest"]:
+            raise ValueError(
+                "queue policy {} is not supported for in place buffers".format(policy)
+            )
+        self.queue = queue
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.name = name
+        self.maxsize = getattr(queue, "n_slots", 0) if maxsize is None else maxsize
+        self.dropped_timestamps = []
+        self.n_put = 0
+        self.n_spilled = 0
+        self.last_timestamp = 0
+        self._spilled = deque()
+
+    def _pack(self, item, timestamp):
+        # ring buffers keep their own per-slot header, queues carry the timestamp
+        return item if self.in_place else (timestamp, item)
+
+    def qsize(self):
+        """Approximate number of frames waiting for the consumer, including spilled"""
+        try:
+            return self.queue.qsize() + len(self._spilled)
+        except NotImplementedError:
+            # qsize is not implemented for multiprocessing queues on macOS
+            return len(self._spilled)
+
+    def fill(self):
+        """Fraction of the queue that is in use, 0 for unbounded queues"""
+        if self.maxsize <= 0:
+            return 0.0
+        return min(self.qsize() / self.maxsize, 1.0)
+
+    @property
+    def n_dropped(self):
+        return len(self.dropped_timestamps)
+
+    def drop(self, timestamp=0):
+        """Record a frame as dropped without putting it on the queue"""
+        self.n_put += 1
+        self.dropped_timestamps.append(timestamp)
+
+    def put(self, item, timestamp=0, **put_kwargs):
+        """Put a frame tuple on the queue, following the queue policy.
+
+        Args:
+            item (tuple): Frames to pass to the consumer. An empty tuple, which
+                marks the end of the recording, is never dropped.
+            timestamp (int, optional): Device timestamp of the frames (usec),
+                used to record drops. Defaults to 0.
+            put_kwargs: Passed on to the underlying put (e.g. timestamps for
+                a FrameRingBuffer)
+
+        Returns:
+            bool: Whether the item reached the consumer (or was spilled)
+        """
+        if len(item) == 0:
+            self._flush_spilled(block=True)
+            self.queue.put(self._pack(item, timestamp), **put_kwargs)
+            return True
+
+        self.n_put += 1
+
+        if self.policy == "block":
+            self.queue.put(self._pack(item, timestamp), **put_kwargs)
+            return True
+
+        if self.policy == "spill":
+            self._flush_spilled(block=False)
+            if len(self._spilled) == 0:
+                try:
+                    self.queue.put(self._pack(item, timestamp), block=False)
+                    return True
+                except Full:
+                    pass
+            self._spill(item, timestamp)
+            return True
+
+        try:
+            self.queue.put(self._pack(item, timestamp), block=False, **put_kwargs)
+            return True
+        except Full:
+            pass
+
+        if self.policy == "drop_newest":
+            self.dropped_timestamps.append(timestamp)
+            return False
+
+        # drop_oldest: take the frame at the front off to make room, and retry
+        #   once. If the queue is still full (e.g. another producer took the
+        #   room, or the consumer holds the last frame), the new frame is dropped
+        try:
+            old_timestamp, old_item = self.queue.get(block=False)
+            if isinstance(old_item, _Spilled):
+                Path(old_item.path).unlink()
+            self.dropped_timestamps.append(old_timestamp)
+        except Empty:
+            pass
+        try:
+            self.queue.put(self._pack(item, timestamp), block=False, **put_kwargs)
+            return True
+        except Full:
+            self.dropped_timestamps.append(timestamp)
+            return False
+
+    def _spill(self, item, timestamp):
+        if self.spill_dir is None:
+            self.spill_dir = Path(tempfile.mkdtemp(prefix="kinectacq_spill_"))
+        ensure_dir(self.spill_dir)
+        path = self.spill_dir / "{:08d}.pickle".format(self.n_put)
+        with open(path, "wb") as f:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled.append((timestamp, _Spilled(str(path))))
+        self.n_spilled += 1
+
+    def _flush_spilled(self, block=False):
+        """Pass references to spilled frames on to the consumer, in order"""
+        while len(self._spilled) > 0:
+            try:
+                self.queue.put(self._spilled[0], block=block)
+            except Full:
+                return
+            self._spilled.popleft()
+
+    def get(self, **get_kwargs):
+        """Get the next frame tuple, reading it back from disk if it was spilled.
+        Its device timestamp is kept in `last_timestamp`.
+        """
+        if self.in_place:
+            item, _, timestamps = self.queue.get(with_header=True, **get_kwargs)
+            self.last_timestamp = int(timestamps[0])
+            return item
+        self.last_timestamp, item = self.queue.get(**get_kwargs)
+        if isinstance(item, _Spilled):
+            with open(item.path, "rb") as f:
+                spilled = pickle.load(f)
+            Path(item.path).unlink()
+            return spilled
+        return item
+
+    def release(self, n=1):
+        if self.in_place:
+            self.queue.release(n)
+
+    def close(self):
+        if hasattr(self.queue, "close"):
+            self.queue.close()
+
+    def report(self):
+        """Print how many frames were dropped or spilled, if any"""
+        if self.n_dropped > 0 or self.n_spilled > 0:
+            print(
+                "{}: dropped {} of {} frames, spilled {} to disk".format(
+                    self.name, self.n_dropped, self.n_put, self.n_spilled
+                )
+            )
+
+
+class StreamRouter:
+    """Routes the frames of each capture to one FrameQueue per stream, so that
+    every stream can be drained by its own writer.
+
+    When the writers fall behind, the least important streams are shed first:
+    the fullest queue sets the load, and a stream is dropped while the load is
+    above its threshold. The most important stream is never shed, and only
+    follows its own queue policy. With the default shed_fraction of 0.5 and
+    three streams, the least important stream is shed once any queue is half
+    full, and the next once any queue is three quarters full.
+
+    Args:
+        priority (list): Stream names, from most to least important
+        shed_fraction (float, optional): Load at which the least important
+            stream is shed. Defaults to 0.5.
+    """
+
+    def __init__(self, priority=("depth", "ir", "color"), shed_fraction=0.5):
+        self.priority = list(priority)
+        self.shed_fraction = shed_fraction
+        self.queues = {}
+        self._n_reported = {}
+
+    def add(self, stream, stream_queue):
+        """Add the FrameQueue for a stream"""
+        if stream not in self.priority:
+            self.priority.append(stream)
+        self.queues[stream] = stream_queue
+        self._n_reported[stream] = 0
+
+    def threshold(self, stream):
+        """Load above which frames from this stream are dropped"""
+        ranked = [name for name in self.priority if name in self.queues]
+        rank = ranked.index(stream)
+        if rank == 0:
+            return np.inf
+        n_shed = len(ranked) - 1
+        return self.shed_fraction + (1 - self.shed_fraction) * (n_shed - rank) / n_shed
+
+    def load(self):
+        """Fill of the fullest bounded queue"""
+        return max([queue.fill() for queue in self.queues.values()] + [0.0])
+
+    def put(self, frames, timestamps):
+        """Put each stream's frame on its queue.
+
+        Args:
+            frames (dict): Frame (np.array, or None if dropped by the device) per stream
+            timestamps (dict): Device timestamp (usec) per stream
+        """
+        load = self.load()
+        for stream, frame in frames.items():
+            if frame is None or stream not in self.queues:
+                continue
+            stream_queue = self.queues[stream]
+            if load > self.threshold(stream):
+                stream_queue.drop(timestamps[stream])
+                continue
+            put_kwargs = {"timestamps": [timestamps[stream]]} if stream_queue.in_place else {}
+            stream_queue.put((frame,), timestamp=timestamps[stream], **put_kwargs)
+
+    def close(self):
+        """Tell every writer that the recording has ended"""
+        for stream_queue in self.queues.values():
+            stream_queue.put(tuple())
+
+    def pop_dropped(self):
+        """Device timestamps of the frames of each stream dropped since the last call
+
+        Returns:
+            dict: list of timestamps (usec) per stream, for streams with new drops
+        """
+        dropped = {}
+        for stream, stream_queue in self.queues.items():
+            n_dropped = stream_queue.n_dropped
+            if n_dropped > self._n_reported[stream]:
+                dropped[stream] = stream_queue.dropped_timestamps[
+                    self._n_reported[stream] : n_dropped
+                ]
+                self._n_reported[stream] = n_dropped
+        return dropped
+
+    def report(self):
+        """Print the number of dropped frames of each stream"""
+        for stream_queue in self.queues.values():
+            stream_queue.report()
+
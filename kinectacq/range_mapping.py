@@ -0,0 +1,102 @@
+"""
+Range mapping - lookup table kernels converting 16-bit depth and IR to 8-bit,
+for use as depth_function, ir_function or ir_display_fcn
+"""
+
+import numpy as np
+
+RANGE_MAPPINGS = ["linear", "window", "gamma"]
+
+
+def make_lut(
+    low=0, high=65535, mapping="linear", gamma=1.0, invert=False, dtype=np.uint8
+):
+    """Lookup table mapping every 16-bit value to the output range of dtype.
+
+    Values in [low, high] are scaled to [0, max of dtype]. Outside of it,
+    "linear" and "gamma" clip to the ends of the range, while "window" maps
+    them to 0 (e.g. to blank everything outside of the arena).
+
+    Args:
+        low (int, optional): Value mapped to 0. Defaults to 0.
+        high (int, optional): Value mapped to the max of dtype. Defaults to 65535.
+        mapping (str, optional): "linear", "window" or "gamma". Defaults to "linear".
+        gamma (float, optional): Exponent of the "gamma" mapping, < 1 brightens
+            dark values. Defaults to 1.0.
+        invert (bool, optional): Whether high values map to 0 instead (e.g. so that
+            near is bright in depth). Defaults to False.
+        dtype (np.dtype, optional): Integer dtype of the output. Defaults to np.uint8.
+
+    Returns:
+        np.array: 65536 values of dtype
+    """
+    if mapping not in RANGE_MAPPINGS:
+        raise ValueError("mapping {} has not been defined".format(mapping))
+    if high <= low:
+        raise ValueError("high ({}) must be greater than low ({})".format(high, low))
+    values = np.arange(65536, dtype=np.float64)
+    scaled = np.clip((values - low) / (high - low), 0, 1)
+    if mapping == "gamma":
+        scaled = scaled ** gamma
+    if invert:
+        scaled = 1 - scaled
+    lut = np.round(scaled * np.iinfo(dtype).max).astype(dtype)
+    if mapping == "window":
+        lut[(values < low) | (values > high)] = 0
+    return lut
+
+
+class RangeMap:
+    """Converts a frame with a precomputed lookup table, optionally
+    downsampling it first, in a single pass over the output pixels.
+
+    Takes uint8 or uint16 frames, or int16 frames (depth after the cast in
+    capture_from_azure), which are read back as the original uint16. Unlike
+    a function written with a lambda, a RangeMap can be pickled, so it also
+    works with preprocess_workers="process".
+
+        ir_function = RangeMap(0, 1000, mapping="gamma", gamma=0.5)
+        depth_function = RangeMap(400, 800, mapping="window", invert=True)
+
+    Args:
+        low, high, mapping, gamma, invert, dtype: See make_lut
+        downsample (int, optional): Keep every nth pixel along each axis.
+            Defaults to 1.
+    """
+
+    def __init__(
+        self,
+        low=0,
+        high=65535,
+        mapping="linear",
+        gamma=1.0,
+        invert=False,
+        dtype=np.uint8,
+        downsample=1,
+    ):
+        self.settings = dict(
+            low=low, high=high, mapping=mapping, gamma=gamma, invert=invert, dtype=dtype
+        )
+        self.downsample = downsample
+        self.lut = make_lut(**self.settings)
+
+    def __call__(self, frame):
+        if self.downsample > 1:
+            frame = frame[:: self.downsample, :: self.downsample]
+        if frame.dtype == np.int16:
+            frame = frame.view(np.uint16)
+        return self.lut[frame]
+
+    def downsampled(self, downsample):
+        """The same mapping, with downsampling, sharing the lookup table"""
+        range_map = RangeMap.__new__(RangeMap)
+        range_map.settings = self.settings
+        range_map.lut = self.lut
+        range_map.downsample = self.downsample * downsample
+        return range_map
+
+    def __repr__(self):
+        return "RangeMap({}, downsample={})".format(
+            ", ".join("{}={}".format(key, value) for key, value in self.settings.items()),
+            self.downsample,
+        )
@@ -0,0 +1,145 @@
+"""
+Resources - plans which CPU cores the capture, writer and encoder of each
+device and stream run on, and pins processes to them
+"""
+
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# relative encoding cost of each stream, used to share out the cores
+STREAM_WEIGHTS = {"depth": 1.0, "ir": 1.0, "color": 2.0}
+
+
+def available_cores():
+    """Cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    if psutil is not None:
+        return sorted(psutil.Process().cpu_affinity())
+    return list(range(os.cpu_count() or 1))
+
+
+def set_affinity(cores):
+    """Pin the calling thread (on Linux, or the process elsewhere) to cores.
+    Threads and processes started afterwards (e.g. ffmpeg) inherit it.
+
+    Returns:
+        bool: Whether the affinity could be set
+    """
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+            return True
+        if psutil is not None:
+            psutil.Process().cpu_affinity(list(cores))
+            return True
+    except (OSError, ValueError) as error:
+        print("Could not set CPU affinity to {}: {}".format(list(cores), error))
+    return False
+
+
+def plan_cores(device_streams, cores=None, reserved=1, n_preprocess=0):
+    """Assign a set of cores to the capture process of each device, to its
+    preprocessing workers, and to the writer and encoder of each of its
+    streams.
+
+    The first `reserved` cores are left to the main process, the display and
+    the OS. Each capture process gets a core of its own, and each device
+    n_preprocess cores for its preprocessing pool. The rest are shared out
+    between the streams by STREAM_WEIGHTS, each getting at least one. A
+    writer and its encoder share a core set, and the encoder uses as many
+    threads as the set has cores. With fewer cores than that, sets are
+    assigned round robin and overlap, and preprocessing workers share the
+    cores of the writers.
+
+    Args:
+        device_streams (dict): Streams (list) recorded by each device
+        cores (list, optional): Cores to plan for. Defaults to available_cores().
+        reserved (int, optional): Cores kept free. Defaults to 1.
+        n_preprocess (int, optional): Cores reserved for the preprocessing pool
+            of each device, 0 if preprocessing runs in the capture loop.
+            Defaults to 0.
+
+    Returns:
+        dict: per device, the cores of the "capture" loop and of the
+            "preprocess" pool, and per stream in "streams", the "cores" and
+            encoder "threads"
+    """
+    cores = available_cores() if cores is None else list(cores)
+    free = cores[reserved:] if len(cores) > reserved else cores
+    n_devices = len(device_streams)
+
+    # one core per capture process, if there is room for the writers too
+    n_streams = sum(len(streams) for streams in device_streams.values())
+    if len(free) >= n_devices + n_streams:
+        capture_cores, free = free[:n_devices], free[n_devices:]
+    else:
+        capture_cores = free[:n_devices] or free
+
+    # the preprocessing pools get cores of their own, if the writers still do
+    n_preprocess_cores = n_devices * n_preprocess
+    if n_preprocess > 0 and len(free) >= n_preprocess_cores + n_streams:
+        preprocess_cores = [
+            free[i * n_preprocess : (i + 1) * n_preprocess] for i in range(n_devices)
+        ]
+        free = free[n_preprocess_cores:]
+    else:
+        preprocess_cores = [list(free)] * n_devices
+
+    streams = [
+        (device, stream)
+        for device in device_streams
+        for stream in device_streams[device]
+    ]
+    weights = [STREAM_WEIGHTS.get(stream, 1.0) for _, stream in streams]
+    # every stream gets a core, the remainder goes to the highest weight per core
+    counts = [1] * len(streams)
+    for _ in range(max(len(free) - len(streams), 0)):
+        i = max(range(len(streams)), key=lambda i: weights[i] / (counts[i] + 1))
+        counts[i] += 1
+
+    plan = {}
+    position = 0
+    for i, device in enumerate(device_streams):
+        plan[device] = {
+            "capture": [capture_cores[i % len(capture_cores)]],
+            "preprocess": preprocess_cores[i],
+            "streams": {},
+        }
+    for (device, stream), count in zip(streams, counts):
+        stream_cores = [free[(position + j) % len(free)] for j in range(count)]
+        position += count
+        plan[device]["streams"][stream] = {
+            "cores": sorted(set(stream_cores)),
+            "threads": len(set(stream_cores)),
+        }
+    return plan
+
+
+def print_plan(plan):
+    """Print the cores planned for each device and stream"""
+    lines = ["CPU plan ({} cores available):".format(len(available_cores()))]
+    for device, device_plan in plan.items():
+        lines.append("  {:<12} capture cores {}".format(device, device_plan["capture"]))
+        lines.append("  {:<12} preprocess cores {}".format("", device_plan["preprocess"]))
+        for stream, stream_plan in device_plan["streams"].items():
+            lines.append(
+                "  {:<12} {:<6} cores {} ({} encoder threads)".format(
+                    "", stream, stream_plan["cores"], stream_plan["threads"]
+                )
+            )
+    print("\n".join(lines))
+
+
+def apply_threads(write_frames_kwargs, threads):
+    """Writer settings with the number of encoder threads replaced"""
+    backend = write_frames_kwargs.get("backend", "ffmpeg")
+    if backend == "ffmpeg":
+        return dict(write_frames_kwargs, threads=threads)
+    if backend == "chunked":
+        return dict(write_frames_kwargs, n_threads=threads)
+    return write_frames_kwargs
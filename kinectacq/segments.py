@@ -0,0 +1,169 @@
+"""
+Segments - the manifest of a stream recorded in segments, joining segments
+without re-encoding, and processing segments as soon as they are closed
+"""
+
+import json, os, subprocess, tempfile, time, numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib2 import Path
+
+from kinectacq.frame_index import FrameIndex
+
+
+def manifest_path(filename):
+    """Manifest of a stream recorded in segments ({stem}.segments.json)"""
+    filename = Path(filename)
+    return filename.parent / (filename.stem + ".segments.json")
+
+
+def save_manifest(filename, manifest):
+    """Save the manifest of a stream, replacing the previous one at once so
+    that readers never see it half written
+    """
+    path = manifest_path(filename)
+    tmp = path.parent / (path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def load_manifest(filename):
+    """Manifest of a stream, or None if it was not recorded in segments
+
+    Args:
+        filename (pathlib2.Path): The stream's video (e.g. depth.avi), or its manifest
+
+    Returns:
+        dict: video, fps, segment_frames, finished, and per segment in "segments",
+            its filename, first_frame, n_frames, first and last timestamp_usec,
+            and whether it is closed
+    """
+    filename = Path(filename)
+    path = filename if filename.name.endswith(".segments.json") else manifest_path(filename)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def closed_segments(filename):
+    """Videos of the segments of a stream that are finished, with their index saved"""
+    manifest = load_manifest(filename)
+    if manifest is None:
+        return []
+    directory = manifest_path(filename).parent
+    return [
+        directory / segment["filename"]
+        for segment in manifest["segments"]
+        if segment["closed"]
+    ]
+
+
+def concatenate_segments(filename, output=None, remove=False):
+    """Join the segments of a stream into one video, without re-encoding, and
+    save its FrameIndex.
+
+    Args:
+        filename (pathlib2.Path): The stream's video (e.g. depth.avi)
+        output (pathlib2.Path, optional): Joined video. Defaults to filename.
+        remove (bool, optional): Delete the segments and manifest once joined.
+            Defaults to False.
+
+    Returns:
+        pathlib2.Path: the joined video
+    """
+    filename = Path(filename)
+    output = filename if output is None else Path(output)
+    manifest = load_manifest(filename)
+    if manifest is None:
+        raise FileNotFoundError("no segment manifest for {}".format(filename))
+    segments = closed_segments(filename)
+    if len(segments) < len(manifest["segments"]):
+        raise ValueError(
+            "{} has segments that are not closed yet".format(filename.name)
+        )
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        for segment in segments:
+            # single quotes are escaped as '\'' in concat lists
+            f.write("file '{}'\n".format(str(segment.absolute()).replace("'", "'\\''")))
+        list_file = f.name
+    try:
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_file,
+            "-c",
+            "copy",
+            str(output),
+        ]
+        out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if out.returncode != 0:
+            raise IOError(
+                "could not join {}: {}".format(filename.name, out.stderr.decode())
+            )
+    finally:
+        os.remove(list_file)
+
+    # the segments' indexes, one after the other
+    indexes = [FrameIndex.load(segment, fps=manifest["fps"]) for segment in segments]
+    pts_time, offset = [], 0.0
+    for index in indexes:
+        pts_time.append(index.pts_time + offset)
+        if len(index) > 0:
+            offset += index.pts_time[-1] + 1 / manifest["fps"]
+    FrameIndex(
+        np.concatenate(pts_time),
+        np.concatenate([index.keyframe for index in indexes]),
+        np.concatenate([index.timestamps for index in indexes]),
+    ).save(FrameIndex.path(output))
+
+    if remove:
+        for segment in segments:
+            os.remove(segment)
+            os.remove(FrameIndex.path(segment))
+        os.remove(manifest_path(filename))
+    return output
+
+
+def process_segments(filename, function, n_workers=4, poll_interval=1.0, timeout=None):
+    """Run function on each segment of a stream in a pool of processes, as soon
+    as the segment is closed, until the recording is finished.
+
+        results = process_segments(device_dir / "depth.avi", extract_features)
+
+    Args:
+        filename (pathlib2.Path): The stream's video (e.g. depth.avi)
+        function (callable): Called with the path of a segment's video, must be
+            picklable (defined at the top level of a module)
+        n_workers (int, optional): Segments processed at once. Defaults to 4.
+        poll_interval (float, optional): Seconds between manifest checks. Defaults to 1.0.
+        timeout (float, optional): Seconds to wait for the recording to finish.
+            Defaults to None (no limit).
+
+    Returns:
+        list: result of function for each segment, in order
+    """
+    start = time.monotonic()
+    futures = {}
+    with ProcessPoolExecutor(n_workers) as executor:
+        while True:
+            manifest = load_manifest(filename)
+            for segment in closed_segments(filename):
+                if segment not in futures:
+                    futures[segment] = executor.submit(function, str(segment))
+            if manifest is not None and manifest["finished"]:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(
+                    "{} was not finished after {} s".format(filename, timeout)
+                )
+            time.sleep(poll_interval)
+        return [future.result() for future in futures.values()]
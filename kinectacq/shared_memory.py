@@ -0,0 +1,297 @@
+"""
+Shared memory - a ring buffer for passing frames between processes
+without pickling them through a pipe, and a mailbox for the newest frame
+"""
+
+import os, numpy as np
+from queue import Empty, Full
+from multiprocessing import Semaphore
+from multiprocessing.shared_memory import SharedMemory
+
+# sequence number marking the end of a recording
+END_OF_STREAM = -1
+
+
+class FrameRingBuffer:
+    """A pre-allocated ring of fixed-size frame slots in shared memory.
+
+    Each stream (e.g. ir, depth, color) gets one shared memory block holding
+    `n_slots` frames, and a shared header stores a sequence number, a
+    timestamp and a valid flag for every stream in each slot. The producer
+    copies each frame into the next free slot once, and the consumer reads
+    it in place and hands the slot back with `release`.
+
+    The buffer mimics the put/get interface of `multiprocessing.Queue`, so
+    that the `write_stream` workers can read from either. It supports
+    exactly one producer and one consumer process. Like a queue, `put`
+    raises `queue.Full` and `get` raises `queue.Empty` when they cannot
+    complete in time.
+
+    Args:
+        template (tuple): Frames (np.array) giving the shape and dtype of each stream
+        n_slots (int, optional): Number of frames the ring can hold. Defaults to 64.
+    """
+
+    # frames returned by get are views that must be handed back with release
+    in_place = True
+
+    def __init__(self, template, n_slots=64):
+        self.n_slots = n_slots
+        self.shapes = [np.shape(frame) for frame in template]
+        self.dtypes = [np.dtype(frame.dtype).str for frame in template]
+        self.n_streams = len(template)
+
+        self._frame_shm = [
+            SharedMemory(
+                create=True,
+                size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1) * n_slots,
+            )
+            for shape, dtype in zip(self.shapes, self.dtypes)
+        ]
+        # the header is followed by two counters: frames written, frames read
+        self._header_shm = SharedMemory(
+            create=True, size=self._header_dtype().itemsize * n_slots + 16
+        )
+
+        # free slots start full, filled slots start empty
+        self._free = Semaphore(n_slots)
+        self._filled = Semaphore(0)
+        # only the creating process frees the blocks, not processes forked from it
+        self._owner = os.getpid()
+        self._attach()
+        self.header["seq"] = END_OF_STREAM
+        self.counters[:] = 0
+
+    def _header_dtype(self):
+        return np.dtype(
+            [
+                ("seq", np.int64),
+                ("timestamp", np.uint64, (self.n_streams,)),
+                ("valid", np.bool_, (self.n_streams,)),
+            ]
+        )
+
+    def _attach(self):
+        """Create numpy views onto the shared memory blocks"""
+        self.slots = [
+            np.ndarray((self.n_slots,) + tuple(shape), dtype=dtype, buffer=shm.buf)
+            for shape, dtype, shm in zip(self.shapes, self.dtypes, self._frame_shm)
+        ]
+        self.header = np.ndarray(
+            self.n_slots, dtype=self._header_dtype(), buffer=self._header_shm.buf
+        )
+        self.counters = np.ndarray(
+            2,
+            dtype=np.int64,
+            buffer=self._header_shm.buf,
+            offset=self._header_dtype().itemsize * self.n_slots,
+        )
+        self._write_index = 0
+        self._read_index = 0
+        self._n_held = 0
+
+    def __getstate__(self):
+        return {
+            "n_slots": self.n_slots,
+            "shapes": self.shapes,
+            "dtypes": self.dtypes,
+            "n_streams": self.n_streams,
+            "frame_names": [shm.name for shm in self._frame_shm],
+            "header_name": self._header_shm.name,
+            "free": self._free,
+            "filled": self._filled,
+        }
+
+    def __setstate__(self, state):
+        self.n_slots = state["n_slots"]
+        self.shapes = state["shapes"]
+        self.dtypes = state["dtypes"]
+        self.n_streams = state["n_streams"]
+        self._frame_shm = [SharedMemory(name=name) for name in state["frame_names"]]
+        self._header_shm = SharedMemory(name=state["header_name"])
+        self._free = state["free"]
+        self._filled = state["filled"]
+        self._owner = None
+        self._attach()
+
+    def qsize(self):
+        """Number of frames written but not yet read"""
+        return int(self.counters[0] - self.counters[1])
+
+    def put(self, frames, block=True, timeout=None, timestamps=None):
+        """Copy a tuple of frames into the next free slot.
+
+        Args:
+            frames (tuple): One np.array (or None, if dropped) per stream.
+                An empty tuple marks the end of the recording.
+            block (bool, optional): Wait for a free slot. Defaults to True.
+            timeout (float, optional): Seconds to wait for a free slot. Defaults to None.
+            timestamps (tuple, optional): Device timestamp per stream. Defaults to None.
+        """
+        if not self._free.acquire(block, timeout):
+            raise Full
+        slot = self._write_index % self.n_slots
+        header = self.header[slot]
+        if len(frames) == 0:
+            header["seq"] = END_OF_STREAM
+        else:
+            for i, frame in enumerate(frames):
+                header["valid"][i] = frame is not None
+                if frame is not None:
+                    np.copyto(self.slots[i][slot], frame, casting="unsafe")
+            header["timestamp"] = timestamps if timestamps is not None else 0
+            header["seq"] = self._write_index
+        self._write_index += 1
+        self.counters[0] = self._write_index
+        self._filled.release()
+
+    def get(self, block=True, timeout=None, with_header=False):
+        """Return views onto the oldest unread slot.
+
+        The returned arrays point into shared memory and stay valid until
+        `release` is called for the slot.
+
+        Args:
+            block (bool, optional): Wait for a filled slot. Defaults to True.
+            timeout (float, optional): Seconds to wait. Defaults to None.
+            with_header (bool, optional): Also return the sequence number and
+                timestamps of the slot. Defaults to False.
+
+        Returns:
+            tuple: frames (None for dropped frames), or an empty tuple at the end
+                of the recording. If with_header, (frames, seq, timestamps).
+        """
+        if not self._filled.acquire(block, timeout):
+            raise Empty
+        slot = self._read_index % self.n_slots
+        self._read_index += 1
+        self.counters[1] = self._read_index
+        self._n_held += 1
+        header = self.header[slot]
+        seq = int(header["seq"])
+        if seq == END_OF_STREAM:
+            frames = tuple()
+        else:
+            frames = tuple(
+                self.slots[i][slot] if header["valid"][i] else None
+                for i in range(self.n_streams)
+            )
+        if with_header:
+            return frames, seq, header["timestamp"].copy()
+        return frames
+
+    def release(self, n=1):
+        """Hand the `n` oldest slots returned by `get` back to the producer"""
+        n = min(n, self._n_held)
+        for _ in range(n):
+            self._free.release()
+        self._n_held -= n
+
+    def close(self):
+        """Detach from the shared memory blocks, and free them if we created them"""
+        if self.header is None:
+            return
+        self.slots = []
+        self.header = None
+        self.counters = None
+        for shm in self._frame_shm + [self._header_shm]:
+            shm.close()
+            if self._owner == os.getpid():
+                shm.unlink()
+
+
+class FrameMailbox:
+    """A single shared memory slot holding only the newest frame of a stream.
+
+    Used for previews: `put` overwrites whatever frame is there, so a slow
+    reader never builds up a backlog, and `get` returns the newest frame or
+    None if nothing new has arrived since the last call. A sequence number
+    that is odd while a frame is being written lets the reader detect (and
+    skip) frames that were overwritten while it copied them. Supports one
+    producer and any number of readers.
+
+    Frames can have any shape and dtype up to max_bytes; larger frames are
+    downsampled until they fit.
+
+    Args:
+        max_bytes (int, optional): Size of the slot. Defaults to 4 MiB.
+    """
+
+    _header_dtype = np.dtype(
+        [
+            ("seq", np.int64),
+            ("timestamp", np.uint64),
+            ("ndim", np.int64),
+            ("shape", np.int64, (3,)),
+            ("dtype", "S8"),
+        ]
+    )
+
+    def __init__(self, max_bytes=4 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._shm = SharedMemory(create=True, size=self._header_dtype.itemsize + max_bytes)
+        # only the creating process frees the slot, not processes forked from it
+        self._owner = os.getpid()
+        self._attach()
+        self.header["seq"] = 0
+
+    def _attach(self):
+        self.header = np.ndarray((), dtype=self._header_dtype, buffer=self._shm.buf)
+        self.data = np.ndarray(
+            self.max_bytes,
+            dtype=np.uint8,
+            buffer=self._shm.buf,
+            offset=self._header_dtype.itemsize,
+        )
+        self.last_seq = 0
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes, "name": self._shm.name}
+
+    def __setstate__(self, state):
+        self.max_bytes = state["max_bytes"]
+        self._shm = SharedMemory(name=state["name"])
+        self._owner = None
+        self._attach()
+
+    def put(self, frame, timestamp=0):
+        """Replace the frame in the mailbox"""
+        while frame.nbytes > self.max_bytes:
+            frame = frame[::2, ::2]
+        seq = int(self.header["seq"])
+        self.header["seq"] = seq + 1
+        self.header["timestamp"] = timestamp
+        self.header["ndim"] = frame.ndim
+        self.header["shape"][: frame.ndim] = frame.shape
+        self.header["dtype"] = frame.dtype.str.encode()
+        np.copyto(
+            self.data[: frame.nbytes].view(frame.dtype).reshape(frame.shape), frame
+        )
+        self.header["seq"] = seq + 2
+
+    def get(self):
+        """Copy of the newest frame and its timestamp, or None if there is no new
+        frame (or it is being overwritten)
+        """
+        seq = int(self.header["seq"])
+        if seq == self.last_seq or seq % 2 == 1:
+            return None
+        shape = tuple(self.header["shape"][: int(self.header["ndim"])])
+        dtype = np.dtype(self.header["dtype"].item().decode())
+        timestamp = int(self.header["timestamp"])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        frame = self.data[:nbytes].view(dtype).reshape(shape).copy()
+        if int(self.header["seq"]) != seq:
+            return None
+        self.last_seq = seq
+        return frame, timestamp
+
+    def close(self):
+        """Detach from the shared memory, and free it if we created it"""
+        if self.header is None:
+            return
+        self.header = None
+        self.data = None
+        self._shm.close()
+        if self._owner == os.getpid():
+            self._shm.unlink()
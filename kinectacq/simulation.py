@@ -0,0 +1,240 @@
+"""
+Simulation - a hardware-free stand-in for a pyk4a.PyK4A device, producing
+synthetic or file-backed depth, IR and color captures
+"""
+
+import json, time, numpy as np
+from pathlib2 import Path
+
+# frame sizes (rows, columns) of each depth mode and color resolution
+DEPTH_MODE_SHAPES = {
+    "NFOV_2X2BINNED": (288, 320),
+    "NFOV_UNBINNED": (576, 640),
+    "WFOV_2X2BINNED": (512, 512),
+    "WFOV_UNBINNED": (1024, 1024),
+    "PASSIVE_IR": (1024, 1024),
+}
+COLOR_RESOLUTION_SHAPES = {
+    "RES_720P": (720, 1280),
+    "RES_1080P": (1080, 1920),
+    "RES_1440P": (1440, 2560),
+    "RES_1536P": (1536, 2048),
+    "RES_2160P": (2160, 3840),
+    "RES_3072P": (3072, 4096),
+}
+
+
+def host_clock_usec():
+    """Current time (usec) of the clock that simulated devices timestamp frames with"""
+    return time.time_ns() // 1000
+
+
+def _setting(config, key, default):
+    """Name of an enum setting in a pyk4a Config, or a dict of Config kwargs"""
+    value = config.get(key) if isinstance(config, dict) else getattr(config, key, None)
+    if value is None:
+        return default
+    return getattr(value, "name", value)
+
+
+class SimulatedCapture:
+    """A capture with the attributes of a pyk4a.PyK4ACapture that kinectacq reads.
+    Images that were dropped are None, and have a timestamp of 0.
+    """
+
+    def __init__(self, depth, ir, color, timestamp_usec, color_timestamp_usec):
+        self.depth = depth
+        self.ir = ir
+        self.color = color
+        self._depth_timestamp_usec = timestamp_usec if depth is not None else 0
+        self._ir_timestamp_usec = timestamp_usec if ir is not None else 0
+        self._color_timestamp_usec = color_timestamp_usec if color is not None else 0
+
+
+class SimulatedK4A:
+    """A simulated Azure Kinect, which can replace PyK4A in start_recording
+    and capture_from_azure.
+
+    Frames are either synthetic (a depth ramp with a moving object, and
+    matching IR and BGRA color) or read from a file, and are handed out at
+    the configured rate: `get_capture` blocks until the next frame is due.
+    Like the real device, a caller that falls more than a frame behind
+    loses the frames it missed, which shows up as a gap in the timestamps.
+    Timestamps are taken from the host clock (`host_clock_usec`) rather
+    than starting at zero, so the age of a frame can be measured anywhere
+    in the pipeline.
+
+    Args:
+        config (pyk4a.Config or dict, optional): Sets the depth mode and
+            color resolution, as for PyK4A. Defaults to NFOV_UNBINNED and 720P.
+        device_id (int, optional): Reported by save_calibration_json. Defaults to 0.
+        fps (float, optional): Frames per second. None hands out frames as fast
+            as they are requested. Defaults to 30.
+        depth_shape (tuple, optional): (rows, columns) of depth and IR frames,
+            overrides the depth mode. Defaults to None.
+        color_shape (tuple, optional): (rows, columns) of color frames, overrides
+            the color resolution. Defaults to None.
+        source (str, optional): .npz file with "depth", "ir" and optionally "color"
+            arrays (frames x rows x columns), which are played back in a loop
+            instead of synthetic frames. Defaults to None.
+        drop_rate (float, optional): Probability that an image is missing (None)
+            from a capture, independently for each stream. Defaults to 0.
+        skip_rate (float, optional): Probability that the device skips a whole
+            frame. Defaults to 0.
+        drop_streams (tuple, optional): Streams affected by drop_rate. Defaults
+            to ("depth", "ir", "color").
+        n_patterns (int, optional): Number of distinct synthetic frames, generated
+            once on start and cycled through. Defaults to 30.
+        seed (int, optional): Seed of the random drops. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        config=None,
+        device_id=0,
+        fps=30,
+        depth_shape=None,
+        color_shape=None,
+        source=None,
+        drop_rate=0.0,
+        skip_rate=0.0,
+        drop_streams=("depth", "ir", "color"),
+        n_patterns=30,
+        seed=None,
+    ):
+        config = config if config is not None else {}
+        self.device_id = device_id
+        self.fps = fps
+        self.depth_shape = tuple(
+            depth_shape
+            or DEPTH_MODE_SHAPES[_setting(config, "depth_mode", "NFOV_UNBINNED")]
+        )
+        self.color_shape = tuple(
+            color_shape
+            or COLOR_RESOLUTION_SHAPES[_setting(config, "color_resolution", "RES_720P")]
+        )
+        self.source = source
+        self.drop_rate = drop_rate
+        self.skip_rate = skip_rate
+        self.drop_streams = tuple(drop_streams)
+        self.n_patterns = n_patterns
+        self.seed = seed
+        self.is_running = False
+        self.n_captures = 0
+        self.n_skipped = 0
+        self._frames = None
+
+    # the clock frame timestamps are taken from, used to measure frame age
+    device_clock = staticmethod(host_clock_usec)
+
+    def _load_frames(self):
+        if self.source is not None:
+            with np.load(self.source) as data:
+                frames = {
+                    stream: np.ascontiguousarray(data[stream])
+                    for stream in ["depth", "ir", "color"]
+                    if stream in data
+                }
+            self.depth_shape = frames["depth"].shape[1:3]
+            if "color" in frames:
+                self.color_shape = frames["color"].shape[1:3]
+            return frames
+
+        rows, cols = self.depth_shape
+        y, x = np.mgrid[:rows, :cols]
+        background = (500 + 3000 * y / rows).astype(np.uint16)
+        phase = 2 * np.pi * np.arange(self.n_patterns) / self.n_patterns
+        depth = np.empty((self.n_patterns, rows, cols), dtype=np.uint16)
+        for i, angle in enumerate(phase):
+            center_y = rows / 2 * (1 + 0.5 * np.sin(angle))
+            center_x = cols / 2 * (1 + 0.5 * np.cos(angle))
+            blob = (y - center_y) ** 2 + (x - center_x) ** 2 < (min(rows, cols) / 10) ** 2
+            depth[i] = np.where(blob, background - 400, background)
+        ir = (depth >> 2).astype(np.uint16)
+
+        color_rows, color_cols = self.color_shape
+        color = np.empty((self.n_patterns, color_rows, color_cols, 4), dtype=np.uint8)
+        row_index = np.arange(color_rows) * rows // color_rows
+        col_index = np.arange(color_cols) * cols // color_cols
+        for i in range(self.n_patterns):
+            gray = (depth[i][np.ix_(row_index, col_index)] >> 4).astype(np.uint8)
+            color[i, :, :, :3] = gray[:, :, None]
+            color[i, :, :, 3] = 255
+        return {"depth": depth, "ir": ir, "color": color}
+
+    def start(self):
+        if self._frames is None:
+            self._frames = self._load_frames()
+        self._rng = np.random.default_rng(self.seed)
+        self._start_usec = host_clock_usec()
+        self._frame_index = 0
+        self.is_running = True
+
+    def stop(self):
+        self.is_running = False
+
+    def __getstate__(self):
+        # frames are generated in the process that starts the device
+        state = dict(self.__dict__)
+        state["_frames"] = None
+        state.pop("_rng", None)
+        return state
+
+    def get_capture(self, timeout=-1):
+        """Wait for the next frame, and return it as a SimulatedCapture"""
+        if not self.is_running:
+            raise RuntimeError("SimulatedK4A has not been started")
+        if self.fps:
+            period_usec = 1e6 / self.fps
+            due_usec = self._start_usec + self._frame_index * period_usec
+            now_usec = host_clock_usec()
+            if now_usec < due_usec:
+                time.sleep((due_usec - now_usec) / 1e6)
+            else:
+                # frames that were due while the caller was busy are lost
+                missed = int((now_usec - due_usec) // period_usec)
+                self._frame_index += missed
+                self.n_skipped += missed
+            timestamp = int(self._start_usec + self._frame_index * period_usec)
+        else:
+            timestamp = host_clock_usec()
+        self._frame_index += 1
+        if self.skip_rate and self._rng.random() < self.skip_rate:
+            self._frame_index += 1
+            self.n_skipped += 1
+
+        images = {}
+        for stream in ["depth", "ir", "color"]:
+            frames = self._frames.get(stream)
+            if frames is None or (
+                stream in self.drop_streams
+                and self.drop_rate
+                and self._rng.random() < self.drop_rate
+            ):
+                images[stream] = None
+            else:
+                images[stream] = frames[self._frame_index % len(frames)]
+        self.n_captures += 1
+        # the color camera is offset from depth on the real device
+        return SimulatedCapture(
+            images["depth"], images["ir"], images["color"], timestamp, timestamp + 180
+        )
+
+    def save_calibration_json(self, path):
+        """Save a placeholder calibration, marked as simulated"""
+        rows, cols = self.depth_shape
+        calibration = {
+            "simulated": True,
+            "device_id": self.device_id,
+            "depth_shape": list(self.depth_shape),
+            "color_shape": list(self.color_shape),
+            "fps": self.fps,
+            "depth_intrinsics": {
+                "cx": cols / 2,
+                "cy": rows / 2,
+                "fx": cols / 1.3,
+                "fy": rows / 1.1,
+            },
+        }
+        with open(Path(path), "w") as f:
+            json.dump(calibration, f, indent=2)
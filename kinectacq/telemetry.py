@@ -0,0 +1,245 @@
+"""
+Telemetry - low overhead timing, queue depth and resource monitoring
+for the acquisition pipeline
+"""
+
+import bisect, json, os, threading, time, numpy as np
+from pathlib2 import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# histogram bin edges in microseconds, four bins per doubling from 1us to ~16s
+HISTOGRAM_EDGES_US = [2 ** (i / 4) for i in range(4 * 24 + 1)]
+
+
+class Histogram:
+    """A fixed, log-spaced histogram of durations, cheap to update"""
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_EDGES_US) + 1)
+        self.n = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def add(self, duration_us):
+        self.counts[bisect.bisect_right(HISTOGRAM_EDGES_US, duration_us)] += 1
+        self.n += 1
+        self.total_us += duration_us
+        if duration_us > self.max_us:
+            self.max_us = duration_us
+
+    def percentile(self, q):
+        """Upper edge of the bin holding the q-th percentile (us), at most the maximum"""
+        if self.n == 0:
+            return None
+        rank = q / 100 * self.n
+        cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, rank))
+        return min(HISTOGRAM_EDGES_US[min(i, len(HISTOGRAM_EDGES_US) - 1)], self.max_us)
+
+    def summary(self):
+        return {
+            "n": self.n,
+            "mean_us": round(self.total_us / self.n, 1) if self.n else None,
+            "p50_us": self.percentile(50),
+            "p99_us": self.percentile(99),
+            "max_us": round(self.max_us, 1),
+        }
+
+
+def process_usage(pid):
+    """CPU use (percent of one core, since the last call) and resident memory
+    of a process. Requires psutil, returns None otherwise.
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        dict: cpu_percent, rss_mb
+    """
+    if psutil is None:
+        return None
+    try:
+        process = _processes.get(pid)
+        if process is None:
+            process = _processes[pid] = psutil.Process(pid)
+        return {
+            "cpu_percent": process.cpu_percent(),
+            "rss_mb": round(process.memory_info().rss / 2 ** 20, 1),
+        }
+    except psutil.Error:
+        return None
+
+
+# psutil.Process objects are kept so that cpu_percent measures between calls
+_processes = {}
+
+
+class Telemetry:
+    """Collects per-stage latency histograms, gauges (e.g. queue depth),
+    counters (e.g. frames written) and process resource use for one
+    acquisition process. Every `interval` seconds, a sample of everything
+    recorded since the last one is appended as a line of JSON to `path`.
+
+    Stages are timed by the caller, to keep the overhead to a couple of
+    list operations per frame:
+
+        t0 = time.perf_counter_ns()
+        capture = k4a.get_capture()
+        telemetry.record("get_capture", t0)
+
+    Stages and counters can be recorded from several threads of the process
+    (e.g. the preprocessing dispatcher).
+
+    Args:
+        path (pathlib2.Path): Time series file (.jsonl)
+        interval (float, optional): Seconds between samples. Defaults to 1.0.
+        name (str, optional): Name of the process, for the summary. Defaults to the file stem.
+    """
+
+    def __init__(self, path, interval=1.0, name=None):
+        self.path = Path(path)
+        self.interval = interval
+        self.name = name or self.path.stem
+        self.histograms = {}
+        self.totals = {}
+        self.gauges = {}
+        self.gauge_functions = {}
+        self.counters = {}
+        self.processes = {"self": os.getpid()}
+        self.start_time = time.time()
+        self._last_sample = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a")
+
+    def record(self, stage, start_ns):
+        """Record the time since start_ns (from time.perf_counter_ns) for a stage"""
+        self.record_duration(stage, (time.perf_counter_ns() - start_ns) / 1000)
+
+    def record_duration(self, stage, duration_us):
+        """Record a duration (us) measured by the caller for a stage"""
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+                self.totals[stage] = Histogram()
+            self.histograms[stage].add(duration_us)
+            self.totals[stage].add(duration_us)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def gauge(self, name, value=None, function=None):
+        """Set a gauge, or a function that is polled at every sample"""
+        if function is not None:
+            self.gauge_functions[name] = function
+        else:
+            self.gauges[name] = value
+
+    def watch_process(self, name, pid):
+        """Report the CPU and memory use of another process (e.g. an encoder)"""
+        self.processes[name] = pid
+
+    def maybe_sample(self):
+        """Write a sample if the interval has passed. Cheap to call every frame."""
+        if time.monotonic() - self._last_sample >= self.interval:
+            self.sample()
+
+    def sample(self):
+        self._last_sample = time.monotonic()
+        for name, function in self.gauge_functions.items():
+            try:
+                self.gauges[name] = function()
+            except Exception:
+                self.gauges[name] = None
+        with self._lock:
+            histograms = self.histograms
+            self.histograms = {stage: Histogram() for stage in histograms}
+            counters = dict(self.counters)
+        row = {
+            "time": time.time(),
+            "stages": {
+                stage: histogram.summary() for stage, histogram in histograms.items()
+            },
+            "gauges": dict(self.gauges),
+            "counters": counters,
+            "processes": {
+                name: process_usage(pid) for name, pid in self.processes.items()
+            },
+        }
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+    def close(self, verbose=True):
+        """Write a last sample and the session totals, and print a summary"""
+        if self._file.closed:
+            return
+        self.sample()
+        summary = {
+            "summary": True,
+            "time": time.time(),
+            "duration_s": round(time.time() - self.start_time, 3),
+            "stages": {
+                stage: histogram.summary() for stage, histogram in self.totals.items()
+            },
+            "counters": dict(self.counters),
+        }
+        self._file.write(json.dumps(summary) + "\n")
+        self._file.close()
+        if verbose:
+            print_summary(self.name, summary)
+
+
+def print_summary(name, summary):
+    """Print the totals of a telemetry file"""
+    lines = ["Telemetry ({}, {}s):".format(name, summary["duration_s"])]
+    for stage, stats in summary["stages"].items():
+        lines.append(
+            "  {:<12} n={:<8} mean={}us p50<={}us p99<={}us max={}us".format(
+                stage,
+                stats["n"],
+                stats["mean_us"],
+                _round(stats["p50_us"]),
+                _round(stats["p99_us"]),
+                stats["max_us"],
+            )
+        )
+    for counter, value in summary["counters"].items():
+        lines.append("  {:<12} {}".format(counter, value))
+    print("\n".join(lines))
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+def load_telemetry(path):
+    """Load a telemetry file.
+
+    Args:
+        path (pathlib2.Path): Telemetry file (.jsonl)
+
+    Returns:
+        list: samples (dict)
+        dict: session totals, or None if the process did not finish
+    """
+    samples, summary = [], None
+    with open(path) as f:
+        for line in f:
+            row = json.loads(line)
+            if row.get("summary"):
+                summary = row
+            else:
+                samples.append(row)
+    return samples, summary
+
+
+def summarize_session(filename_prefix):
+    """Print the totals of every telemetry file in a session (or device) directory"""
+    for path in sorted(Path(filename_prefix).glob("**/telemetry_*.jsonl")):
+        _, summary = load_telemetry(path)
+        if summary is not None:
+            print_summary(path.parent.name + "/" + path.stem, summary)
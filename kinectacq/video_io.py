@@ -1,16 +1,20 @@
-import datetime, subprocess, numpy as np, cv2, time, sys
+import datetime, subprocess, numpy as np, cv2, time, sys, threading
+from array import array
+from pathlib2 import Path
+from queue import Empty
 from kinectacq.interrupt_handler import DelayedKeyboardInterrupt
+from kinectacq.telemetry import Telemetry
+from kinectacq.frame_index import FrameIndex
+from kinectacq.chunked import ChunkedWriter
+from kinectacq.resources import set_affinity
+from kinectacq.segments import save_manifest
 
 
 def get_number_of_frames(filepath):
-    command = "ffprobe -v error -select_streams v:0 -show_entries stream=nb_frames -of default=nokey=1:noprint_wrappers=1"
-    out = subprocess.Popen(
-        command.split(" ") + [filepath],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    stdout, stderr = out.communicate()
-    return int(stdout.decode("utf8").strip("\n"))
+    """Number of frames in a video, from its sidecar index. Videos recorded
+    without one are scanned once, and the index is saved for next time.
+    """
+    return len(FrameIndex.load(filepath))
 
 
 import subprocess
@@ -148,6 +152,418 @@ def write_frames(
     else:
         return pipe
 
+class FrameWriter:
+    """A persistent writer for one video stream.
+
+    The ffmpeg command and pipe are created once, on the first batch of
+    frames. Each batch is converted into a pre-allocated contiguous buffer
+    and written to the pipe in a single call through a memoryview, so
+    that writing allocates nothing in steady state. When closed, a
+    FrameIndex with the device timestamp of each frame is saved next to
+    each video that was written.
+
+    With segment_frames (or segment_seconds), the stream is written to a
+    new file every segment_frames frames ({stem}_0000.avi, {stem}_0001.avi,
+    ...), so a crash can only damage the last segment. A manifest
+    ({stem}.segments.json, see kinectacq.segments) lists the frame range and
+    timestamps of each segment, and marks segments as closed once their
+    encoder has finished and their index is saved, so they can be processed
+    during the recording. A broken pipe then also moves on to a new segment.
+
+    Args:
+        filename (pathlib2.Path): Where the video is saved
+        video_dtype (np.dtype, optional): dtype of the video frames. Defaults to np.uint8.
+        pixel_format (str, optional): ffmpeg pixel format. Defaults to "gray8".
+        max_batch (int, optional): Maximum number of frames per write. Defaults to 16.
+        segment_frames (int, optional): Frames per segment. Defaults to None (one file).
+        segment_seconds (float, optional): Seconds (at fps) per segment, instead of
+            segment_frames. Defaults to None.
+        write_frames_kwargs: Encoder settings, passed on to write_frames
+    """
+
+    def __init__(
+        self,
+        filename,
+        video_dtype=np.uint8,
+        pixel_format="gray8",
+        max_batch=16,
+        segment_frames=None,
+        segment_seconds=None,
+        **write_frames_kwargs
+    ):
+        self.filename = Path(filename)
+        self.video_dtype = video_dtype
+        self.pixel_format = pixel_format
+        self.max_batch = max_batch
+        self.write_frames_kwargs = {
+            key: value
+            for key, value in write_frames_kwargs.items()
+            if key not in ["get_cmd", "close_pipe", "pipe"]
+        }
+        self.fps = self.write_frames_kwargs.get("fps", 30)
+        if segment_seconds is not None:
+            segment_frames = max(int(segment_seconds * self.fps), 1)
+        self.segment_frames = segment_frames
+        self.command = None
+        self.pipe = None
+        self.buffer = None
+        self.n_frames_written = 0
+        self.timestamps = array("Q")
+        # (video, first frame) of each file written, a new one for every
+        #   segment or repipe
+        self.segments = []
+        # pipes of segments whose encoder is finishing, and closed segments
+        self._closing = []
+        self._closed = set()
+
+    def _segment_filename(self, segment):
+        return self.filename.parent / "{}_{:04d}{}".format(
+            self.filename.stem, segment, self.filename.suffix
+        )
+
+    def _open(self, frame):
+        # color frames are BGRA, only the first three channels are written
+        self.frame_shape = frame.shape[:2] + ((3,) if frame.ndim == 3 else ())
+        self.buffer = np.empty(
+            (self.max_batch,) + self.frame_shape, dtype=self.video_dtype
+        )
+        kwargs = dict(self.write_frames_kwargs)
+        if not kwargs.get("frame_size"):
+            kwargs["frame_size"] = "{0:d}x{1:d}".format(
+                self.frame_shape[1], self.frame_shape[0]
+            )
+        self.command = write_frames(
+            self._segment_filename(0) if self.segment_frames else self.filename,
+            None,
+            pixel_format=self.pixel_format,
+            get_cmd=True,
+            **kwargs
+        )
+        self.pipe = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        self.segments.append((Path(self.command[-1]), 0))
+        if self.segment_frames:
+            self.save_manifest()
+
+    def _repipe(self):
+        """Continue writing to a second file that can later be re-merged"""
+        if self.segment_frames:
+            print("Pipe broken for {}, starting a new segment".format(self.filename.stem))
+            self._rotate()
+            return
+        filename = Path(self.command[-1])
+        self.command[-1] = filename.parent / (
+            filename.stem + "_repipe" + filename.suffix
+        )
+        print(
+            "Pipe broken for {}\n".format(filename.stem)
+            + "  continuing on to {}_repipe".format(filename.stem)
+        )
+        self.pipe = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        self.segments.append((Path(self.command[-1]), self.n_frames_written))
+
+    def _rotate(self):
+        """Let the encoder of the current segment finish in the background, and
+        continue in a new segment
+        """
+        try:
+            self.pipe.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._closing.append((self.pipe, len(self.segments) - 1))
+        self.command[-1] = self._segment_filename(len(self.segments))
+        self.pipe = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        self.segments.append((Path(self.command[-1]), self.n_frames_written))
+        self.save_manifest()
+
+    def _finish_segments(self, wait=False):
+        """Save the index of segments whose encoder has finished, and mark them
+        as closed in the manifest
+        """
+        finished = [
+            (pipe, segment)
+            for pipe, segment in self._closing
+            if wait or pipe.poll() is not None
+        ]
+        for pipe, segment in finished:
+            pipe.wait()
+            self._closing.remove((pipe, segment))
+            self._save_segment_index(segment)
+            self._closed.add(segment)
+        if len(finished) > 0:
+            self.save_manifest()
+
+    def write(self, frames, timestamps=None):
+        """Write a list of frames (np.array) to the video.
+
+        Args:
+            frames (list): Frames of the same shape, None entries are skipped
+            timestamps (list, optional): Device timestamp of each frame (usec),
+                saved in the index. Defaults to None (unknown).
+        """
+        if timestamps is None:
+            timestamps = [0] * len(frames)
+        timestamps = [t for frame, t in zip(frames, timestamps) if frame is not None]
+        frames = [frame for frame in frames if frame is not None]
+        if len(frames) == 0:
+            return
+        if self.pipe is None:
+            self._open(frames[0])
+        if self._closing:
+            self._finish_segments()
+
+        start = 0
+        while start < len(frames):
+            n_batch = self.max_batch
+            if self.segment_frames:
+                in_segment = self.n_frames_written - self.segments[-1][1]
+                if in_segment >= self.segment_frames:
+                    self._rotate()
+                    in_segment = 0
+                n_batch = min(n_batch, self.segment_frames - in_segment)
+            batch = frames[start : start + n_batch]
+            for i, frame in enumerate(batch):
+                if frame.ndim == 3:
+                    frame = frame[:, :, :3]
+                np.copyto(self.buffer[i], frame, casting="unsafe")
+            data = memoryview(self.buffer[: len(batch)]).cast("B")
+            try:
+                self.pipe.stdin.write(data)
+            except BrokenPipeError:
+                self._repipe()
+                self.pipe.stdin.write(data)
+            self.timestamps.extend(timestamps[start : start + len(batch)])
+            self.n_frames_written += len(batch)
+            start += len(batch)
+
+    def close(self):
+        if self.pipe is not None:
+            self.pipe.stdin.close()
+            # the index must be newer than the finished video
+            self.pipe.wait()
+            self.pipe = None
+            if self.segment_frames:
+                self._finish_segments(wait=True)
+                self._save_segment_index(len(self.segments) - 1)
+                self._closed.add(len(self.segments) - 1)
+                self.save_manifest(finished=True)
+            else:
+                self.save_index()
+
+    def _segment_bounds(self, segment):
+        first = self.segments[segment][1]
+        if segment + 1 < len(self.segments):
+            return first, self.segments[segment + 1][1]
+        return first, self.n_frames_written
+
+    def _save_segment_index(self, segment):
+        first, last = self._segment_bounds(segment)
+        timestamps = np.frombuffer(self.timestamps, dtype=np.uint64)
+        FrameIndex.from_recording(
+            last - first,
+            self.fps,
+            timestamps=timestamps[first:last],
+            intra_only=self.write_frames_kwargs.get("codec", "h264") == "ffv1",
+        ).save(FrameIndex.path(self.segments[segment][0]))
+
+    def save_index(self):
+        """Save a FrameIndex next to each video written"""
+        for segment in range(len(self.segments)):
+            self._save_segment_index(segment)
+
+    def save_manifest(self, finished=False):
+        """Save the frame range, timestamps and state of each segment"""
+        timestamps = np.frombuffer(self.timestamps, dtype=np.uint64)
+        segments = []
+        for segment, (filename, _) in enumerate(self.segments):
+            first, last = self._segment_bounds(segment)
+            closed = segment in self._closed
+            segments.append(
+                {
+                    "filename": filename.name,
+                    "first_frame": first,
+                    "n_frames": last - first if closed else None,
+                    "first_timestamp_usec": int(timestamps[first]) if last > first else None,
+                    "last_timestamp_usec": int(timestamps[last - 1])
+                    if closed and last > first
+                    else None,
+                    "closed": closed,
+                }
+            )
+        save_manifest(
+            self.filename,
+            {
+                "video": self.filename.name,
+                "fps": self.fps,
+                "segment_frames": self.segment_frames,
+                "finished": finished,
+                "segments": segments,
+            },
+        )
+
+
+class RawWriter:
+    """Writes frames uncompressed into a memory-mapped .npy file, for when the
+    encoder cannot keep up. Frames are copied straight into the file, which
+    is pre-allocated in blocks of grow_frames frames and grown as needed.
+
+    The .npy header is updated every time the file grows and when it is
+    closed, so after a crash the file loads with the frames written up to
+    the last block. Color frames are stored as their first three channels
+    (BGR). A FrameIndex is saved next to the file, as for videos.
+
+    Args:
+        filename (pathlib2.Path): Where the frames are saved, the suffix is
+            replaced by .npy
+        video_dtype (np.dtype, optional): dtype of the saved frames. Defaults to np.uint8.
+        grow_frames (int, optional): Frames the file grows by at once. Defaults to 1024.
+        fps (float, optional): Frame rate, for the index. Defaults to 30.
+        write_frames_kwargs: Encoder settings, ignored
+    """
+
+    # bytes reserved for the .npy header, so it can be rewritten in place
+    header_size = 128
+    pipe = None
+
+    def __init__(
+        self, filename, video_dtype=np.uint8, grow_frames=1024, fps=30, **write_frames_kwargs
+    ):
+        self.filename = Path(filename).with_suffix(".npy")
+        self.video_dtype = np.dtype(video_dtype)
+        self.grow_frames = grow_frames
+        self.fps = fps
+        self.n_frames_written = 0
+        self.n_allocated = 0
+        self.timestamps = array("Q")
+        self.frames = None
+        self._file = None
+
+    def _header(self):
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {}, }}".format(
+            np.lib.format.dtype_to_descr(self.video_dtype),
+            (self.n_frames_written,) + self.frame_shape,
+        )
+        header = header.ljust(self.header_size - 10 - 1) + "\n"
+        return b"\x93NUMPY\x01\x00" + np.uint16(len(header)).tobytes() + header.encode(
+            "latin1"
+        )
+
+    def _write_header(self):
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.flush()
+
+    def _open(self, frame):
+        self.frame_shape = frame.shape[:2] + ((3,) if frame.ndim == 3 else ())
+        self.frame_bytes = int(np.prod(self.frame_shape)) * self.video_dtype.itemsize
+        self._file = open(self.filename, "w+b")
+        self._write_header()
+        self._grow()
+
+    def _grow(self):
+        """Extend the file by grow_frames frames, and map it again"""
+        if self.frames is not None:
+            self.frames.flush()
+            self.frames = None
+            self._write_header()
+        self.n_allocated += self.grow_frames
+        self._file.truncate(self.header_size + self.n_allocated * self.frame_bytes)
+        self.frames = np.memmap(
+            self._file,
+            dtype=self.video_dtype,
+            mode="r+",
+            offset=self.header_size,
+            shape=(self.n_allocated,) + self.frame_shape,
+        )
+
+    def write(self, frames, timestamps=None):
+        """Write a list of frames (np.array), None entries are skipped"""
+        if timestamps is None:
+            timestamps = [0] * len(frames)
+        for frame, timestamp in zip(frames, timestamps):
+            if frame is None:
+                continue
+            if self._file is None:
+                self._open(frame)
+            if self.n_frames_written == self.n_allocated:
+                self._grow()
+            if frame.ndim == 3:
+                frame = frame[:, :, :3]
+            np.copyto(self.frames[self.n_frames_written], frame, casting="unsafe")
+            self.timestamps.append(int(timestamp))
+            self.n_frames_written += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self.frames.flush()
+        self.frames = None
+        self._file.truncate(self.header_size + self.n_frames_written * self.frame_bytes)
+        self._write_header()
+        self._file.close()
+        self._file = None
+        FrameIndex.from_recording(
+            self.n_frames_written,
+            self.fps,
+            timestamps=np.frombuffer(self.timestamps, dtype=np.uint64),
+            intra_only=True,
+        ).save(FrameIndex.path(self.filename))
+
+
+class NullWriter:
+    """Counts frames without writing them, to benchmark everything but the writer
+
+    Args:
+        filename (pathlib2.Path): Ignored
+        write_frames_kwargs: Ignored
+    """
+
+    pipe = None
+
+    def __init__(self, filename, **write_frames_kwargs):
+        self.filename = filename
+        self.n_frames_written = 0
+
+    def write(self, frames, timestamps=None):
+        self.n_frames_written += sum(frame is not None for frame in frames)
+
+    def close(self):
+        pass
+
+
+# writers selectable with the "backend" entry of *_write_frames_kwargs
+WRITER_BACKENDS = {
+    "ffmpeg": FrameWriter,
+    "raw": RawWriter,
+    "chunked": ChunkedWriter,
+    "null": NullWriter,
+}
+
+
+def make_writer(filename, backend="ffmpeg", **writer_kwargs):
+    """Create the writer of a stream.
+
+    Args:
+        filename (pathlib2.Path): Where the stream is saved
+        backend (str, optional): "ffmpeg" (FrameWriter, encoded video), "raw"
+            (RawWriter, uncompressed memory-mapped .npy), "chunked" (ChunkedWriter,
+            lossless compressed blocks) or "null" (NullWriter, discards frames).
+            Defaults to "ffmpeg".
+        writer_kwargs: Passed on to the writer
+
+    Returns:
+        FrameWriter, RawWriter, ChunkedWriter or NullWriter
+    """
+    if backend not in WRITER_BACKENDS:
+        raise ValueError("writer backend {} has not been defined".format(backend))
+    return WRITER_BACKENDS[backend](filename, **writer_kwargs)
+
+
 def read_frames(
     filename,
     frames,
@@ -208,131 +624,176 @@ def read_frames(
     if err:
         print("error", err)
         return None
-    video = np.frombuffer(out, dtype="uint16").reshape(
-        (len(frames), frame_size[1], frame_size[0])
+    dtype, n_channels = frame_layout(pixel_format)
+    video = np.frombuffer(out, dtype=dtype).reshape(
+        (len(frames), frame_size[1], frame_size[0]) + n_channels
     )
     return video
 
-def write_images(
-    image_queue,
-    filename_prefix,
-    ir_dtype=np.uint8,
-    depth_dtype=np.uint8,
-    save_color=False,
-    ir_write_frames_kwargs={},
-    depth_write_frames_kwargs={},
-    color_write_frames_kwargs={},
-    pbar_device=None,
-    update_frequency=30,
-):
-    """Writes images from a multiprocessing queue to a video file
-    using the write_frames function.
 
-    Args:
-        image_queue ([type]): Multiprocessing queue
-        filename_prefix ([type]): data storage location
-    """
+def frame_layout(pixel_format):
+    """dtype and channel shape of raw frames decoded to an ffmpeg pixel format
 
-    depth_pipe = None
-    ir_pipe = None
-    if save_color:
-        color_pipe = None
+    Args:
+        pixel_format (str): e.g. "gray8", "gray16le" or "rgb24"
 
-    if depth_dtype == np.uint8:
-        depth_pixel_format = "gray8"
-    elif depth_dtype == np.uint16:
-        depth_pixel_format = "gray16"
+    Returns:
+        np.dtype: dtype of a pixel value
+        tuple: () for grayscale, (3,) for rgb
+    """
+    if pixel_format in ["gray", "gray8"]:
+        return np.dtype(np.uint8), ()
+    elif pixel_format in ["gray16", "gray16le"]:
+        return np.dtype("<u2"), ()
+    elif pixel_format == "gray16be":
+        return np.dtype(">u2"), ()
+    elif pixel_format in ["rgb24", "bgr24"]:
+        return np.dtype(np.uint8), (3,)
     else:
-        raise ValueError(
-            "format for dtype {} has not been defined".format(depth_dtype)
-        )
-        
-    if ir_dtype == np.uint8:
-        ir_pixel_format = "gray8"
-    elif ir_dtype == np.uint16:
-        ir_pixel_format = "gray16"
+        raise ValueError("format {} has not been defined".format(pixel_format))
+
+def _pixel_format(dtype):
+    if dtype == np.uint8:
+        return "gray8"
+    elif dtype == np.uint16:
+        return "gray16"
     else:
-        raise ValueError(
-            "format for dtype {} has not been defined".format(ir_dtype)
-        )
-    start_time = time.time()
-    frame_n = 0
-
-    # create a note stating that this device is still
-    np.save(file=filename_prefix / "is_writing", arr=[True])
-
-    # continue writing even if keyboard is interrupted
-    # with DelayedKeyboardInterrupt():
-    s = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    while True:
-        # try:
-        data = image_queue.get()
-
-        if len(data) == 0:
-            pbar_device.update(frame_n - pbar_device.n)
-            depth_pipe.stdin.close()
-            ir_pipe.stdin.close()
-            if save_color:
-                color_pipe.stdin.close()
-
-            # rewrite note
-            np.save(file=filename_prefix / "is_writing", arr=[False])
-            pbar_device.close()
-            print(
-                "Finished writing ({}): {}".format(
-                    filename_prefix.stem, datetime.datetime.now()
-                )
-            )
+        raise ValueError("format for dtype {} has not been defined".format(dtype))
+
+
+def _drain(frame_queue, max_batch, timestamps=None):
+    """Wait for a frame, then take everything else that is waiting.
 
+    Args:
+        timestamps (list, optional): If given, the device timestamp of each
+            frame taken is appended to it. Defaults to None.
+
+    Returns:
+        list: frame tuples
+        int: number of items taken off the queue
+        bool: whether the end of the recording (an empty tuple) was reached
+    """
+    batch = [frame_queue.get()]
+    if timestamps is not None:
+        timestamps.append(frame_queue.last_timestamp)
+    while len(batch[-1]) > 0 and len(batch) < max_batch:
+        try:
+            batch.append(frame_queue.get(block=False))
+        except Empty:
             break
+        if timestamps is not None:
+            timestamps.append(frame_queue.last_timestamp)
+    n_items = len(batch)
+    finished = len(batch[-1]) == 0
+    if finished:
+        batch = batch[:-1]
+    return batch, n_items, finished
+
+
+def write_stream(
+    stream_queue,
+    filename,
+    video_dtype=np.uint8,
+    pixel_format=None,
+    write_frames_kwargs={},
+    pbar_device=None,
+    update_frequency=30,
+    max_batch=16,
+    telemetry_path=None,
+    telemetry_interval=1.0,
+    device_clock=None,
+    cores=None,
+):
+    """Writes the frames of a single stream from its own queue to a video file.
+    Runs as a thread or a process, so that each stream has its own worker and
+    ffmpeg pipe.
+
+    Args:
+        stream_queue (FrameQueue): Source of frames, as 1-tuples
+        filename (pathlib2.Path): Where the video is saved
+        video_dtype (np.dtype, optional): dtype of the video. Defaults to np.uint8.
+        pixel_format (str, optional): ffmpeg pixel format. Defaults to the
+            grayscale format matching video_dtype.
+        write_frames_kwargs (dict, optional): Encoder settings. A "backend" entry
+            selects the writer, see make_writer. Defaults to {}.
+        pbar_device (tqdm, optional): Progress bar of frames written. Defaults to None.
+        update_frequency (int, optional): Frames between progress updates. Defaults to 30.
+        max_batch (int, optional): Maximum number of frames taken off the
+            queue at once. Defaults to 16.
+        telemetry_path (pathlib2.Path, optional): Where to save telemetry (dequeue
+            and pipe write times, frames written, encoder CPU and memory). Defaults
+            to None (no telemetry).
+        telemetry_interval (float, optional): Seconds between telemetry samples.
+            Defaults to 1.0.
+        device_clock (function, optional): Returns the current time on the clock
+            the device timestamps frames with (usec), e.g. SimulatedK4A.device_clock.
+            If given, telemetry also records the age of the oldest frame of each
+            batch once it has been written ("frame_age"). Defaults to None.
+        cores (list, optional): CPU cores to pin the writer, and the encoder it
+            starts, to. Defaults to None (not pinned).
+    """
+    if cores is not None:
+        set_affinity(cores)
+
+    telemetry = None
+    if telemetry_path is not None:
+        telemetry = Telemetry(telemetry_path, interval=telemetry_interval)
+
+    writer_kwargs = dict(write_frames_kwargs, video_dtype=video_dtype)
+    if write_frames_kwargs.get("backend", "ffmpeg") == "ffmpeg":
+        writer_kwargs.update(
+            pixel_format=pixel_format or _pixel_format(video_dtype),
+            max_batch=max_batch,
+        )
+    writer = make_writer(filename, **writer_kwargs)
+
+    # continue writing even if keyboard is interrupted (signals can only be
+    #   handled in the main thread)
+    main_thread = threading.current_thread() is threading.main_thread()
+    if main_thread:
+        s = signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    finished = False
+    while not finished:
+        timestamps = []
+        if telemetry is None:
+            batch, n_items, finished = _drain(stream_queue, max_batch, timestamps)
+            writer.write([data[0] for data in batch], timestamps)
         else:
-            if save_color:
-                ir, depth, color = data
-            else:
-                ir, depth = data
-
-            # write image arrays
-            if depth is not None:
-                depth_pipe = write_frames(
-                    filename_prefix / "depth.avi",
-                    depth.astype(depth_dtype)[None, :, :],
-                    close_pipe=False,
-                    pipe=depth_pipe,
-                    pixel_format=depth_pixel_format,
-                    video_dtype=depth_dtype,
-                    **depth_write_frames_kwargs
-                )
-            if ir is not None:
-                ir_pipe = write_frames(
-                    filename_prefix / "ir.avi",
-                    ir.astype(ir_dtype)[None, :, :],
-                    close_pipe=False,
-                    pipe=ir_pipe,
-                    pixel_format=ir_pixel_format,
-                    video_dtype=ir_dtype,
-                    **ir_write_frames_kwargs
-                )
-
-            if save_color:
-                if color is not None:
-                    color_pipe = write_frames(
-                        filename_prefix / "color.avi",
-                        color.astype(np.uint8)[None, :, :, :3],
-                        close_pipe=False,
-                        pipe=color_pipe,
-                        pixel_format="rgb24",
-                        video_dtype=np.uint8,
-                        **color_write_frames_kwargs
-                    )
-
-            # save progress in writing frames
-            if pbar_device is not None:
-                if frame_n % update_frequency == 0:
-                    _ = pbar_device.update(frame_n - pbar_device.n)
-                    # hack to display pbar (otherwise it won't update)
-                    sys.stdout.write("\r ")
-
-            frame_n += 1
-        # except Exception as e:
-        #    print("In write loop: {}".format(e))
-    signal.signal(signal.SIGINT, s)
+            t0 = time.perf_counter_ns()
+            batch, n_items, finished = _drain(stream_queue, max_batch, timestamps)
+            telemetry.record("dequeue", t0)
+            t0 = time.perf_counter_ns()
+            writer.write([data[0] for data in batch], timestamps)
+            telemetry.record("pipe_write", t0)
+            if device_clock is not None and len(batch) > 0:
+                telemetry.record_duration("frame_age", device_clock() - timestamps[0])
+            telemetry.count("frames_written", len(batch))
+            if "encoder" not in telemetry.processes and writer.pipe is not None:
+                telemetry.watch_process("encoder", writer.pipe.pid)
+            telemetry.maybe_sample()
+        if stream_queue.in_place:
+            stream_queue.release(n_items)
+
+        if pbar_device is not None and not finished:
+            if writer.n_frames_written - pbar_device.n >= update_frequency:
+                _ = pbar_device.update(writer.n_frames_written - pbar_device.n)
+                # hack to display pbar (otherwise it won't update)
+                sys.stdout.write("\r ")
+
+    writer.close()
+    if stream_queue.in_place:
+        stream_queue.close()
+    if telemetry is not None:
+        telemetry.close(verbose=False)
+    if pbar_device is not None:
+        pbar_device.update(writer.n_frames_written - pbar_device.n)
+        pbar_device.close()
+    print(
+        "Finished writing ({}): {}".format(
+            Path(filename).parent.stem + "/" + Path(filename).stem,
+            datetime.datetime.now(),
+        )
+    )
+    if main_thread:
+        signal.signal(signal.SIGINT, s)
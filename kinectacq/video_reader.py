@@ -0,0 +1,721 @@
+"""
+Video reader - random access to the frames of recorded videos through a
+frame index, a persistent ffmpeg decoder and a cache of decoded chunks,
+streaming in chunks, and parallel decoding of whole videos
+"""
+
+import json, os, subprocess, threading, time, numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+from pathlib2 import Path
+
+from kinectacq.video_io import frame_layout
+from kinectacq.frame_index import FrameIndex
+
+# decoder output format for each source pixel format, anything else is rgb24
+DECODE_PIXEL_FORMATS = {
+    "gray": "gray",
+    "gray8": "gray",
+    "gray16le": "gray16le",
+    "gray16be": "gray16le",
+    "rgb24": "rgb24",
+}
+
+
+def probe_video(filename):
+    """Size, pixel format, frame rate and frame count of the first video stream
+
+    Args:
+        filename (pathlib2.Path): Video file
+
+    Returns:
+        dict: width, height, pix_fmt, fps, nb_frames (None if not in the header)
+    """
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=width,height,pix_fmt,avg_frame_rate,r_frame_rate,nb_frames",
+        "-of",
+        "json",
+        str(filename),
+    ]
+    out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode != 0:
+        raise IOError("could not probe {}: {}".format(filename, out.stderr.decode()))
+    stream = json.loads(out.stdout)["streams"][0]
+    rate = stream.get("avg_frame_rate", "0/0")
+    if rate in ["0/0", None]:
+        rate = stream["r_frame_rate"]
+    numerator, denominator = rate.split("/")
+    nb_frames = stream.get("nb_frames")
+    return {
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "pix_fmt": stream["pix_fmt"],
+        "fps": float(numerator) / float(denominator),
+        "nb_frames": int(nb_frames) if nb_frames not in [None, "N/A"] else None,
+    }
+
+
+def open_decoder(filename, pixel_format, threads=6, seek_time=None, buffer_size=-1):
+    """Start an ffmpeg process decoding a video to raw frames on its stdout
+
+    Args:
+        filename (pathlib2.Path): Video file
+        pixel_format (str): Output pixel format
+        threads (int, optional): Decoder threads. Defaults to 6.
+        seek_time (float, optional): Start at the first frame at or after this
+            time (s). Defaults to None (the first frame).
+        buffer_size (int, optional): Buffer size of the pipe. Defaults to -1 (default).
+
+    Returns:
+        subprocess.Popen: the decoder
+    """
+    command = ["ffmpeg", "-loglevel", "fatal", "-threads", str(threads)]
+    if seek_time:
+        command += ["-ss", "{:.6f}".format(seek_time)]
+    command += [
+        "-i",
+        str(filename),
+        "-map",
+        "0:v:0",
+        "-vsync",
+        "passthrough",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        pixel_format,
+        "-",
+    ]
+    return subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=buffer_size
+    )
+
+
+def read_into(pipe, buffer):
+    """Fill a buffer from a decoder, returning the number of bytes read
+    (less than its size at the end of the video)
+    """
+    buffer = memoryview(buffer).cast("B")
+    n_read = 0
+    while n_read < len(buffer):
+        n_bytes = pipe.stdout.readinto(buffer[n_read:])
+        if not n_bytes:
+            break
+        n_read += n_bytes
+    return n_read
+
+
+def open_decoder_at(
+    filename, index, frame, frame_bytes, pixel_format, threads=6, buffer_size=-1
+):
+    """Start an ffmpeg process decoding a video from exactly frame: it seeks to
+    the keyframe at or before it (see FrameIndex.keyframe_before), and the
+    frames up to it are read and discarded.
+
+    Args:
+        filename (pathlib2.Path): Video file
+        index (FrameIndex): Index of the video
+        frame (int): First frame to decode
+        frame_bytes (int): Size of a decoded frame
+        pixel_format, threads, buffer_size: See open_decoder
+
+    Returns:
+        subprocess.Popen: the decoder
+    """
+    keyframe = index.keyframe_before(frame)
+    pipe = open_decoder(
+        filename,
+        pixel_format,
+        threads=threads,
+        seek_time=index.seek_time(keyframe),
+        buffer_size=buffer_size,
+    )
+    skip_frames(pipe, frame - keyframe, frame_bytes)
+    return pipe
+
+
+def skip_frames(pipe, n_frames, frame_bytes):
+    """Read and discard n_frames from a decoder"""
+    discard = bytearray(frame_bytes)
+    for _ in range(n_frames):
+        if read_into(pipe, discard) < frame_bytes:
+            return
+
+
+def close_decoder(pipe):
+    pipe.stdout.close()
+    pipe.kill()
+    pipe.wait()
+
+
+class VideoReader:
+    """Random access to the frames of a video.
+
+    The video is probed and indexed once. Frames are decoded in chunks of
+    chunk_size frames by a single ffmpeg process that is kept open, so
+    reading on from the last chunk needs no seek, and jumping elsewhere
+    restarts it at the keyframe before the chunk, from the frame index.
+    Decoded chunks are kept in a least recently used cache of at most
+    cache_size_mb, so that scattered reads around the same frames are not
+    decoded twice.
+
+    Frames are returned with the dtype of the video: uint8 for gray8,
+    uint16 for gray16, and (rows, columns, 3) uint8 rgb for color.
+
+    Args:
+        filename (pathlib2.Path): Video file
+        chunk_size (int, optional): Frames decoded at once. Defaults to 64.
+        cache_size_mb (float, optional): Memory for decoded chunks. Defaults to 512.
+        threads (int, optional): Decoder threads. Defaults to 6.
+        pixel_format (str, optional): Decode to this format instead of the one
+            matching the video. Defaults to None.
+        index (FrameIndex, optional): Frame index, instead of loading (or
+            building) the one saved next to the video. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        filename,
+        chunk_size=64,
+        cache_size_mb=512,
+        threads=6,
+        pixel_format=None,
+        index=None,
+    ):
+        self.filename = Path(filename)
+        self.chunk_size = chunk_size
+        self.cache_size = int(cache_size_mb * 2 ** 20)
+        self.threads = threads
+
+        info = probe_video(self.filename)
+        self.width, self.height, self.fps = info["width"], info["height"], info["fps"]
+        self.pixel_format = pixel_format or DECODE_PIXEL_FORMATS.get(
+            info["pix_fmt"], "rgb24"
+        )
+        self.dtype, channels = frame_layout(self.pixel_format)
+        self.frame_shape = (self.height, self.width) + channels
+        self.frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        if index is None:
+            index = FrameIndex.load(self.filename, fps=self.fps)
+        self.index = index
+        self.n_frames = len(self.index)
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._pipe = None
+        self._pipe_position = None
+
+    def __len__(self):
+        return self.n_frames
+
+    @property
+    def shape(self):
+        return (self.n_frames,) + self.frame_shape
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.get_frames(range(*key.indices(self.n_frames)))
+        if isinstance(key, (list, tuple, np.ndarray, range)):
+            return self.get_frames(key)
+        return self.get_frame(key)
+
+    def get_frame(self, frame):
+        """One frame, as a read-only view into the cache"""
+        frame = int(frame)
+        if frame < 0:
+            frame += self.n_frames
+        if not 0 <= frame < self.n_frames:
+            raise IndexError("frame {} out of range ({})".format(frame, self.n_frames))
+        chunk = self._get_chunk(frame // self.chunk_size)
+        return chunk[frame % self.chunk_size]
+
+    def get_frames(self, frames, out=None):
+        """Several frames, in the order given.
+
+        Args:
+            frames (list): Frame numbers
+            out (np.array, optional): Array of shape (len(frames),) + frame_shape
+                to fill, instead of allocating one. Defaults to None.
+
+        Returns:
+            np.array: frames x rows x columns (x 3 for color)
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        if out is None:
+            out = np.empty((len(frames),) + self.frame_shape, dtype=self.dtype)
+        # visit each chunk once, in order, so that the decoder reads forward
+        order = np.argsort(frames, kind="stable")
+        for i in order:
+            out[i] = self.get_frame(frames[i])
+        return out
+
+    def _get_chunk(self, chunk_index):
+        chunk = self._cache.get(chunk_index)
+        if chunk is not None:
+            self._cache.move_to_end(chunk_index)
+            return chunk
+        chunk = self._decode_chunk(chunk_index)
+        self._cache[chunk_index] = chunk
+        self._cache_bytes += chunk.nbytes
+        # always keep the newest chunk, however small the cache
+        while self._cache_bytes > self.cache_size and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+        return chunk
+
+    def _decode_chunk(self, chunk_index):
+        start = chunk_index * self.chunk_size
+        n = min(self.chunk_size, self.n_frames - start)
+        if self._pipe is None or self._pipe_position != start:
+            self._open(start)
+        chunk = np.empty((n,) + self.frame_shape, dtype=self.dtype)
+        n_read = read_into(self._pipe, chunk)
+        self._pipe_position = start + n_read // self.frame_bytes
+        if n_read < chunk.nbytes:
+            # the video ended early, e.g. an index of a file still being written
+            self._close_pipe()
+            chunk = chunk[: n_read // self.frame_bytes]
+        chunk.flags.writeable = False
+        return chunk
+
+    def _open(self, start):
+        """Start decoding at frame start"""
+        self._close_pipe()
+        self._pipe = open_decoder_at(
+            self.filename,
+            self.index,
+            start,
+            self.frame_bytes,
+            self.pixel_format,
+            threads=self.threads,
+            buffer_size=self.frame_bytes * self.chunk_size,
+        )
+        self._pipe_position = start
+
+    def _close_pipe(self):
+        if self._pipe is not None:
+            close_decoder(self._pipe)
+            self._pipe = None
+            self._pipe_position = None
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+
+    def close(self):
+        self._close_pipe()
+        self.clear_cache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self._close_pipe()
+        except Exception:
+            pass
+
+
+class VideoStream:
+    """Iterates over a video in chunks of frames, from one long-lived decoder.
+
+    Chunks are decoded into a small set of buffers that are reused, so memory
+    use does not depend on the length of the video. A chunk is only valid
+    until the next one is requested: copy it to keep it. With prefetch, the
+    next chunk is decoded on a background thread while the current one is
+    being processed.
+
+        for first_frame, frames in VideoStream("depth.avi", chunk_size=256):
+            ...
+
+    Args:
+        filename (pathlib2.Path): Video file
+        chunk_size (int, optional): Frames per chunk. Defaults to 256.
+        start (int, optional): First frame. Defaults to 0.
+        stop (int, optional): Frame to stop before. Defaults to None (the end).
+        prefetch (bool, optional): Decode the next chunk on a background thread.
+            Defaults to True.
+        threads (int, optional): Decoder threads. Defaults to 6.
+        pixel_format (str, optional): Decode to this format instead of the one
+            matching the video. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        filename,
+        chunk_size=256,
+        start=0,
+        stop=None,
+        prefetch=True,
+        threads=6,
+        pixel_format=None,
+    ):
+        self.filename = Path(filename)
+        self.chunk_size = chunk_size
+        self.start = start
+        self.stop = stop
+        self.prefetch = prefetch
+        self.threads = threads
+
+        info = probe_video(self.filename)
+        self.fps = info["fps"]
+        self.pixel_format = pixel_format or DECODE_PIXEL_FORMATS.get(
+            info["pix_fmt"], "rgb24"
+        )
+        self.dtype, channels = frame_layout(self.pixel_format)
+        self.frame_shape = (info["height"], info["width"]) + channels
+        self.frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self._pipe = None
+        self._thread = None
+
+    def _open(self):
+        if self.start == 0:
+            self._pipe = open_decoder(
+                self.filename,
+                self.pixel_format,
+                threads=self.threads,
+                buffer_size=self.frame_bytes * self.chunk_size,
+            )
+            return
+        # seeking exactly needs the frame index
+        self._pipe = open_decoder_at(
+            self.filename,
+            FrameIndex.load(self.filename, fps=self.fps),
+            self.start,
+            self.frame_bytes,
+            self.pixel_format,
+            threads=self.threads,
+            buffer_size=self.frame_bytes * self.chunk_size,
+        )
+
+    def _chunks(self, buffers):
+        """Decode into each buffer in turn, yielding (first frame, frames)"""
+        frame = self.start
+        i = 0
+        while self.stop is None or frame < self.stop:
+            n = self.chunk_size
+            if self.stop is not None:
+                n = min(n, self.stop - frame)
+            buffer = buffers[i % len(buffers)][:n]
+            n = read_into(self._pipe, buffer) // self.frame_bytes
+            if n == 0:
+                return
+            yield frame, buffer[:n]
+            frame += n
+            i += 1
+
+    def _prefetch(self, buffers, filled, free):
+        chunks = self._chunks(buffers)
+        while True:
+            # wait until the buffer the next chunk is decoded into is free
+            free.get()
+            if self._closing:
+                return
+            try:
+                item = next(chunks, None)
+            except Exception as error:
+                item = error
+            filled.put(item)
+            if item is None or isinstance(item, Exception):
+                return
+
+    def __iter__(self):
+        self.close()
+        self._open()
+        self._closing = False
+        n_buffers = 3 if self.prefetch else 1
+        buffers = [
+            np.empty((self.chunk_size,) + self.frame_shape, dtype=self.dtype)
+            for _ in range(n_buffers)
+        ]
+        try:
+            if not self.prefetch:
+                yield from self._chunks(buffers)
+                return
+
+            # the decoder may fill a buffer once it has been handed back, which
+            #   is when the consumer asks for the chunk after the one it holds
+            filled, free = Queue(), Queue()
+            for _ in range(n_buffers - 1):
+                free.put(True)
+            self._thread = threading.Thread(
+                target=self._prefetch, args=(buffers, filled, free), daemon=True
+            )
+            self._thread.start()
+            while True:
+                item = filled.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                free.put(True)
+        finally:
+            self.close(free if self.prefetch else None)
+
+    def close(self, free=None):
+        if self._thread is not None:
+            self._closing = True
+            if free is not None:
+                free.put(True)
+            close_decoder(self._pipe)
+            self._pipe = None
+            self._thread.join()
+            self._thread = None
+        if self._pipe is not None:
+            close_decoder(self._pipe)
+            self._pipe = None
+
+
+def iter_session(
+    filename_prefix,
+    streams=("depth", "ir"),
+    devices=None,
+    chunk_size=256,
+    prefetch=True,
+    **stream_kwargs
+):
+    """Iterates over the videos of several streams and devices of a session in
+    lockstep, chunk by chunk, until the shortest video ends.
+
+        for first_frame, chunks in iter_session(session_dir):
+            depth = chunks["master"]["depth"]
+
+    Args:
+        filename_prefix (pathlib2.Path): Session directory, holding a directory
+            per device
+        streams (tuple, optional): Streams to read. Defaults to ("depth", "ir").
+        devices (list, optional): Device names. Defaults to every directory
+            with a video of each stream.
+        chunk_size (int, optional): Frames per chunk. Defaults to 256.
+        prefetch (bool, optional): Decode the next chunks on background threads.
+            Defaults to True.
+        stream_kwargs: Passed on to VideoStream
+
+    Yields:
+        int: first frame of the chunk
+        dict: chunk (frames x rows x columns) per stream, per device
+    """
+    filename_prefix = Path(filename_prefix)
+    if devices is None:
+        devices = sorted(
+            path.name
+            for path in filename_prefix.iterdir()
+            if all((path / "{}.avi".format(stream)).exists() for stream in streams)
+        )
+    video_streams = {
+        (device, stream): VideoStream(
+            filename_prefix / device / "{}.avi".format(stream),
+            chunk_size=chunk_size,
+            prefetch=prefetch,
+            **stream_kwargs
+        )
+        for device in devices
+        for stream in streams
+    }
+    iterators = {key: iter(video_stream) for key, video_stream in video_streams.items()}
+    try:
+        while True:
+            chunks = {device: {} for device in devices}
+            n = None
+            first_frame = None
+            for (device, stream), iterator in iterators.items():
+                item = next(iterator, None)
+                if item is None:
+                    return
+                first_frame, frames = item
+                chunks[device][stream] = frames
+                n = len(frames) if n is None else min(n, len(frames))
+            # trim to the shortest chunk, at the end of the videos
+            for device in chunks:
+                for stream in chunks[device]:
+                    chunks[device][stream] = chunks[device][stream][:n]
+            yield first_frame, chunks
+    finally:
+        for iterator in iterators.values():
+            iterator.close()
+
+
+def _decode_segment(args):
+    """Decode frames [start, stop) of a video into its slice of the output"""
+    filename, pixel_format, threads, seek_time, n_skip, start, stop, output = args
+    t0 = time.perf_counter()
+    if output["kind"] == "npy":
+        video = np.load(output["path"], mmap_mode="r+")
+    else:
+        shm = SharedMemory(name=output["name"])
+        video = np.ndarray(output["shape"], dtype=output["dtype"], buffer=shm.buf)
+    pipe = open_decoder(filename, pixel_format, threads=threads, seek_time=seek_time)
+    try:
+        skip_frames(pipe, n_skip, video[0].nbytes)
+        n_read = read_into(pipe, video[start:stop]) // video[0].nbytes
+    finally:
+        close_decoder(pipe)
+        if output["kind"] == "npy":
+            video.flush()
+        del video
+        if output["kind"] == "shm":
+            shm.close()
+    return start, n_read, time.perf_counter() - t0
+
+
+def time_single_decoder(filename, pixel_format, frame_shape, dtype, n_frames, threads=1):
+    """Time one decoder reading the first n_frames of a video through a single
+    pipe, the baseline of read_video_parallel
+
+    Returns:
+        float: seconds taken
+        int: frames decoded
+    """
+    buffer = np.empty((n_frames,) + tuple(frame_shape), dtype=dtype)
+    t0 = time.perf_counter()
+    pipe = open_decoder(filename, pixel_format, threads=threads)
+    try:
+        n_read = read_into(pipe, buffer) // buffer[0].nbytes
+    finally:
+        close_decoder(pipe)
+    return time.perf_counter() - t0, n_read
+
+
+def read_video_parallel(
+    filename,
+    n_workers=None,
+    n_segments=None,
+    out=None,
+    threads=1,
+    pixel_format=None,
+    baseline_frames=300,
+    verbose=True,
+):
+    """Decode a whole video by splitting it into frame ranges, which are decoded
+    concurrently by a pool of worker processes straight into one output array.
+    Each range is decoded from the keyframe before it, so videos with few
+    keyframes in their index (e.g. h264 recordings, whose index only knows the
+    first) gain little.
+
+    The speedup reported is over a single decoder reading the video through
+    one pipe: after the parallel decode, one decoder is timed on the first
+    baseline_frames frames, and its rate is scaled to the whole video
+    (baseline_s). The parallelism reported is the decoding time summed over
+    the workers, over the time the parallel decode took: how many workers were
+    decoding at once on average.
+
+    Args:
+        filename (pathlib2.Path): Video file
+        n_workers (int, optional): Worker processes. Defaults to the number of CPUs.
+        n_segments (int, optional): Frame ranges the video is split into. More
+            segments than workers balance the load better. Defaults to n_workers.
+        out (pathlib2.Path, optional): .npy file to decode into (as a memmap),
+            for videos that do not fit in memory. Defaults to None (an array in
+            memory).
+        threads (int, optional): Decoder threads per worker. Defaults to 1.
+        pixel_format (str, optional): Decode to this format instead of the one
+            matching the video. Defaults to None.
+        baseline_frames (int, optional): Frames the single decoder baseline
+            decodes, None for the whole video, or 0 for no baseline (and no
+            speedup). Defaults to 300.
+        verbose (bool, optional): Print the frame rate and speedup.
+            Defaults to True.
+
+    Returns:
+        np.array (or np.memmap): frames x rows x columns (x 3 for color), in order
+        dict: n_workers, elapsed_s, decode_s (summed over workers), parallelism,
+            fps, baseline_s and speedup (None without a baseline)
+    """
+    t0 = time.perf_counter()
+    n_workers = n_workers or os.cpu_count()
+    n_segments = n_segments or n_workers
+    info = probe_video(filename)
+    pixel_format = pixel_format or DECODE_PIXEL_FORMATS.get(info["pix_fmt"], "rgb24")
+    dtype, channels = frame_layout(pixel_format)
+    index = FrameIndex.load(filename, fps=info["fps"])
+    shape = (len(index), info["height"], info["width"]) + channels
+
+    shm = None
+    if out is not None:
+        video = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+        del video
+        output = {"kind": "npy", "path": str(out)}
+    else:
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = SharedMemory(create=True, size=size)
+        output = {"kind": "shm", "name": shm.name, "shape": shape, "dtype": dtype.str}
+
+    bounds = np.linspace(0, len(index), n_segments + 1).astype(int)
+    # each range is decoded from the keyframe before it
+    segments = [
+        (
+            str(filename),
+            pixel_format,
+            threads,
+            index.seek_time(index.keyframe_before(start)),
+            start - index.keyframe_before(start),
+            start,
+            stop,
+            output,
+        )
+        for start, stop in zip(bounds[:-1], bounds[1:])
+        if stop > start
+    ]
+    try:
+        with Pool(n_workers) as pool:
+            results = pool.map(_decode_segment, segments, chunksize=1)
+        if out is not None:
+            video = np.load(out, mmap_mode="r+")
+        else:
+            video = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    for (start, n_read, _), segment in zip(results, segments):
+        stop = segment[-2]
+        if n_read < stop - start:
+            raise IOError(
+                "decoded {} of frames {}-{} of {}".format(n_read, start, stop, filename)
+            )
+    elapsed_s = time.perf_counter() - t0
+    decode_s = sum(result[2] for result in results)
+
+    baseline_s = None
+    if baseline_frames is None or baseline_frames > 0:
+        n_baseline = len(index) if baseline_frames is None else min(baseline_frames, len(index))
+        sample_s, n_read = time_single_decoder(
+            filename, pixel_format, shape[1:], dtype, n_baseline, threads=threads
+        )
+        if n_read > 0:
+            baseline_s = sample_s * len(index) / n_read
+    stats = {
+        "n_workers": n_workers,
+        "elapsed_s": round(elapsed_s, 3),
+        "decode_s": round(decode_s, 3),
+        "parallelism": round(decode_s / elapsed_s, 2),
+        "fps": round(len(index) / elapsed_s, 1),
+        "baseline_s": None if baseline_s is None else round(baseline_s, 3),
+        "speedup": None if baseline_s is None else round(baseline_s / elapsed_s, 2),
+    }
+    if verbose:
+        print(
+            "Decoded {} frames of {} in {}s with {} workers ({} fps, {} decoding at once, "
+            "{}x speedup over one decoder)".format(
+                len(index),
+                Path(filename).name,
+                stats["elapsed_s"],
+                n_workers,
+                stats["fps"],
+                stats["parallelism"],
+                stats["speedup"],
+            )
+        )
+    return video, stats
@@ -1,18 +1,93 @@
-import cv2
+import time, numpy as np, cv2
 
+from kinectacq.range_mapping import RangeMap
 
-def display_images(display_queue, ir_display_fcn):
+
+def make_preview(display_fcn=None, downsample=2):
+    """Function turning a frame into its preview: downsampled, then passed
+    through display_fcn. A RangeMap is fused with the downsampling.
+    """
+    if isinstance(display_fcn, RangeMap):
+        return display_fcn.downsampled(downsample)
+    if display_fcn is None:
+        return lambda frame: frame[::downsample, ::downsample]
+    return lambda frame: display_fcn(frame[::downsample, ::downsample])
+
+
+def to_bgr(frame):
+    """Convert a preview frame to 8-bit BGR. Frames that are not 8-bit are
+    scaled to their own range.
+    """
+    if frame.dtype != np.uint8:
+        frame = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    if frame.ndim == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    return np.ascontiguousarray(frame[:, :, :3])
+
+
+def fit_tile(frame, tile):
+    """Resize a BGR frame to fit into tile (np.array), keeping its aspect ratio"""
+    tile[:] = 0
+    scale = min(tile.shape[0] / frame.shape[0], tile.shape[1] / frame.shape[1])
+    height = max(int(frame.shape[0] * scale), 1)
+    width = max(int(frame.shape[1] * scale), 1)
+    top = (tile.shape[0] - height) // 2
+    left = (tile.shape[1] - width) // 2
+    tile[top : top + height, left : left + width] = cv2.resize(
+        frame, (width, height), interpolation=cv2.INTER_AREA
+    )
+
+
+def display_previews(
+    mailboxes, stop_event, max_fps=15, tile_shape=(288, 320), window_name="kinectacq"
+):
+    """Show the newest preview of every device and stream, tiled in one window.
+
+    Each device gets a row and each stream a column. At most max_fps times a
+    second, every mailbox is checked, and only tiles with a new frame are
+    redrawn, so the cost does not grow with the frame rate of the cameras.
+    Runs until stop_event is set, or "q" is pressed.
+
+    Args:
+        mailboxes (dict): shared_memory.FrameMailbox for each (device, stream)
+        stop_event (multiprocessing.Event): Set to close the window
+        max_fps (int, optional): Maximum refresh rate of the window. Defaults to 15.
+        tile_shape (tuple, optional): (height, width) of each tile. Defaults to (288, 320).
+        window_name (str, optional): Title of the window. Defaults to "kinectacq".
+    """
+    devices = list(dict.fromkeys(device for device, _ in mailboxes))
+    streams = list(dict.fromkeys(stream for _, stream in mailboxes))
+    height, width = tile_shape
+    canvas = np.zeros((height * len(devices), width * len(streams), 3), dtype=np.uint8)
+    tiles = {
+        (device, stream): canvas[
+            row * height : (row + 1) * height, col * width : (col + 1) * width
+        ]
+        for row, device in enumerate(devices)
+        for col, stream in enumerate(streams)
+    }
     try:
-        while True:
-            data = display_queue.get()
-            if len(data) == 0:
-                cv2.destroyAllWindows()
+        while not stop_event.is_set():
+            t0 = time.monotonic()
+            for (device, stream), mailbox in mailboxes.items():
+                latest = mailbox.get()
+                if latest is None:
+                    continue
+                tile = tiles[(device, stream)]
+                fit_tile(to_bgr(latest[0]), tile)
+                cv2.putText(
+                    tile,
+                    "{} {}".format(device, stream),
+                    (5, 15),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.4,
+                    (0, 255, 0),
+                )
+            cv2.imshow(window_name, canvas)
+            if cv2.waitKey(1) & 0xFF == ord("q"):
                 break
-            else:
-                ir = data[0]
-                ir = ir_display_fcn(ir)
-                cv2.imshow("ir", ir)
-                if cv2.waitKey(1) & 0xFF == ord("q"):
-                    break
+            time.sleep(max(1 / max_fps - (time.monotonic() - t0), 0))
     except KeyboardInterrupt:
+        pass
+    finally:
         cv2.destroyAllWindows()
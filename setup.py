@@ -33,11 +33,13 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=["numpy>=1.20", "click"],
     extras_require={
-        # "test": ["pytest", "coverage"],
+        "test": ["pytest"],
         # "lint": ["pylama", "isort", "mypy"],
         "docs": docs_requirements,
+        "telemetry": ["psutil"],
+        "chunked": ["zstandard"],
     },
-    python_requires=">=3.7",
+    python_requires=">=3.8",
     include_package_data=True,
     zip_safe=False,
 )
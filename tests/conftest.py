@@ -0,0 +1,8 @@
+import shutil, pytest
+
+
+@pytest.fixture
+def ffmpeg():
+    """Skips tests that need ffmpeg and ffprobe when they are not installed"""
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        pytest.skip("needs ffmpeg and ffprobe")
@@ -0,0 +1,85 @@
+import json, time
+from multiprocessing import Event
+from pathlib2 import Path
+
+from kinectacq.acquisition import capture_from_azure, is_subordinate, prepare_device
+from kinectacq.controller import DeviceStatus, RecordingController
+from kinectacq.frame_log import load_frame_log
+from kinectacq.simulation import SimulatedK4A
+
+SIMULATION = {"fps": 30, "depth_shape": (16, 16), "color_shape": (16, 16)}
+
+
+def simulated_device(device_id, sync_mode="MASTER"):
+    return {
+        "id": device_id,
+        "pyk4a_config": {"wired_sync_mode": sync_mode},
+        "simulation": dict(SIMULATION),
+        "process_kwargs": {"save_color": False, "display_frames": False, "display_time": False},
+    }
+
+
+class _SyncMode:
+    name = "SUBORDINATE"
+
+
+def test_is_subordinate():
+    assert is_subordinate(simulated_device(1, "SUBORDINATE"))
+    assert is_subordinate({"pyk4a_config": {"wired_sync_mode": _SyncMode()}})
+    assert not is_subordinate(simulated_device(0))
+    assert not is_subordinate({})
+
+
+def test_prepare_device(tmp_path):
+    device_dir = Path(tmp_path) / "master"
+    k4a, startup = prepare_device(simulated_device(0), device_dir, warmup=0.1)
+    assert isinstance(k4a, SimulatedK4A) and not k4a.is_running
+    assert startup["warmup_s"] >= 0.1
+    with open(device_dir / "startup.json") as f:
+        assert json.load(f) == startup
+    with open(device_dir / "calibration.json") as f:
+        assert json.load(f)["depth_shape"] == [16, 16]
+
+
+def test_master_waits_for_subordinates(tmp_path):
+    """A master whose subordinates never start gives up, without starting its camera"""
+    k4a = SimulatedK4A(**SIMULATION)
+    status = DeviceStatus()
+    capture_from_azure(
+        k4a,
+        Path(tmp_path),
+        10,
+        depth_write_frames_kwargs={"backend": "null"},
+        ir_write_frames_kwargs={"backend": "null"},
+        writer_workers="thread",
+        wait_for=(Event(),),
+        startup_timeout=0.2,
+        status=status,
+    )
+    assert status.state == "failed"
+    assert k4a.n_captures == 0 and not k4a.is_running
+
+
+def test_start_devices_concurrently(tmp_path):
+    devices = {"master": simulated_device(0), "subordinate": simulated_device(1, "SUBORDINATE")}
+    with RecordingController(
+        devices,
+        warmup=0.5,
+        catalog=False,
+        writer_workers="thread",
+        depth_write_frames_kwargs={"backend": "null"},
+        ir_write_frames_kwargs={"backend": "null"},
+    ) as controller:
+        t0 = time.monotonic()
+        controller.start(Path(tmp_path), 0.5)
+        # both devices warm up at once
+        assert time.monotonic() - t0 < 0.9
+        assert controller.wait(timeout=20)
+    first_frames = []
+    for device_name in devices:
+        startup = json.loads((Path(tmp_path) / device_name / "startup.json").read_text())
+        assert startup["warmup_s"] >= 0.5
+        frames, _ = load_frame_log(Path(tmp_path) / device_name / "frame_log.bin")
+        first_frames.append(int(frames["system_ns"][0]))
+    # capture begins once every device has started
+    assert abs(first_frames[0] - first_frames[1]) < 0.1e9
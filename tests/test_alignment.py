@@ -0,0 +1,132 @@
+import os, numpy as np, pytest
+from pathlib2 import Path
+
+from kinectacq.alignment import (
+    ALIGNMENT_FILE,
+    align_session,
+    fit_clock,
+    load_device_timestamps,
+    match_nearest,
+    missing_frames,
+)
+from kinectacq.frame_log import FrameLog
+
+N_FRAMES = 100
+PERIOD_USEC = 33333
+# host clock minus master clock (usec)
+HOST_OFFSET_USEC = 5_000_000_000
+# frames that reached the host late
+LATE = {10: 20000, 50: 35000, 51: 3000}
+
+
+def _write_log(device_dir, device_start_usec, host_offset_usec, dropped={}, queue_dropped=()):
+    device_dir.mkdir()
+    log = FrameLog(device_dir / "frame_log.bin", ["depth", "ir"])
+    for i in range(N_FRAMES):
+        device_usec = device_start_usec + i * PERIOD_USEC
+        system_usec = device_usec + host_offset_usec + LATE.get(i, 0)
+        log.append(
+            system_usec * 1000,
+            {"depth": device_usec, "ir": device_usec},
+            {"depth": i in dropped},
+        )
+    log.mark_dropped("depth", [device_start_usec + i * PERIOD_USEC for i in queue_dropped])
+    log.close()
+
+
+@pytest.fixture
+def session(tmp_path):
+    """A master, and a subordinate 160us behind it, whose clock started a
+    second later, missing depth frame 20 (dropped by the device) and 30
+    (dropped by a queue)
+    """
+    session = Path(tmp_path)
+    _write_log(session / "master", 1_000_000, HOST_OFFSET_USEC)
+    _write_log(
+        session / "subordinate",
+        2_000_000,
+        HOST_OFFSET_USEC - 1_000_000 + 160,
+        dropped={20},
+        queue_dropped=[30],
+    )
+    return session
+
+
+def test_fit_clock():
+    device = 1e6 + np.arange(N_FRAMES) * PERIOD_USEC
+    system = 1.00001 * device + 42.0
+    system[list(LATE)] += list(LATE.values())
+    slope, intercept = fit_clock(device, system)
+    assert slope == pytest.approx(1.00001, rel=1e-9)
+    assert slope * device[0] + intercept == pytest.approx(system[0], abs=1)
+    assert fit_clock([10], [15]) == (1.0, 5.0)
+
+
+def test_match_nearest():
+    times = np.array([0.0, 10.0, 20.0, 30.0])
+    nearest = match_nearest(np.array([-1.0, 4.0, 6.0, 24.0, 38.0]), times, tolerance=5)
+    np.testing.assert_array_equal(nearest, [0, 0, 1, 2, -1])
+    np.testing.assert_array_equal(match_nearest(np.array([1.0]), np.array([]), 5), [-1])
+
+
+def test_device_timestamps(session):
+    loaded = load_device_timestamps(session / "subordinate")
+    assert len(loaded["ir"][0]) == N_FRAMES
+    # frames that are not in the video are left out
+    assert len(loaded["depth"][0]) == N_FRAMES - 2
+    assert 2_000_000 + 20 * PERIOD_USEC not in loaded["depth"][0]
+
+
+def test_align_session(session):
+    table, metadata = align_session(session)
+    assert metadata["columns"] == [
+        "master/depth",
+        "master/ir",
+        "subordinate/depth",
+        "subordinate/ir",
+    ]
+    assert metadata["reference"] == "master/depth"
+    assert len(table) == N_FRAMES
+    np.testing.assert_allclose(
+        table["time_usec"], 1_000_000 + HOST_OFFSET_USEC + np.arange(N_FRAMES) * PERIOD_USEC, atol=1
+    )
+
+    frames = np.arange(N_FRAMES)
+    expected = np.where(frames < 20, frames, np.where(frames < 30, frames - 1, frames - 2))
+    expected[[20, 30]] = -1
+    np.testing.assert_array_equal(table["frame"][:, 0], frames)
+    np.testing.assert_array_equal(table["frame"][:, 2], expected)
+    np.testing.assert_array_equal(table["frame"][:, 3], frames)
+    np.testing.assert_array_equal(np.flatnonzero(table["missing"].any(axis=1)), [20, 30])
+    np.testing.assert_allclose(table["offset_usec"][:, 3], 160, atol=1)
+    assert missing_frames(table, metadata) == {"master": 0, "subordinate": 2}
+
+
+def test_cached(session):
+    table, _ = align_session(session)
+    assert (session / ALIGNMENT_FILE).exists()
+    cached, _ = align_session(session)
+    np.testing.assert_array_equal(cached, table)
+
+    # other settings, or a newer frame log, are aligned again
+    _, metadata = align_session(session, reference=("subordinate", "ir"))
+    assert metadata["reference"] == "subordinate/ir"
+    stamp = os.path.getmtime(session / ALIGNMENT_FILE) + 10
+    os.utime(session / "master" / "frame_log.bin", (stamp, stamp))
+    _, metadata = align_session(session)
+    assert metadata["reference"] == "master/depth"
+
+
+def test_legacy_timestamps(tmp_path):
+    """Older recordings saved .npy timestamps instead of a frame log"""
+    device_dir = Path(tmp_path) / "master"
+    device_dir.mkdir()
+    device_usec = 1_000_000 + np.arange(10) * PERIOD_USEC
+    np.save(device_dir / "system_timestamps.npy", (device_usec + HOST_OFFSET_USEC) * 1000)
+    depth = device_usec.copy()
+    depth[4] = 0
+    np.save(device_dir / "depth_timestamps.npy", depth)
+    np.save(device_dir / "ir_timestamps.npy", device_usec)
+    table, _ = align_session(tmp_path, cache=False)
+    assert len(table) == 9
+    np.testing.assert_array_equal(table["frame"][:, 1], [0, 1, 2, 3, 5, 6, 7, 8, 9])
@@ -0,0 +1,131 @@
+import json, os, time, numpy as np, pytest
+from pathlib2 import Path
+
+from kinectacq.archive import (
+    archive_path,
+    archive_sessions,
+    archive_settings,
+    find_sessions,
+    is_archived,
+    is_lossless,
+    is_recording,
+    record_path,
+    session_jobs,
+)
+from kinectacq.frame_index import FrameIndex
+from kinectacq.frame_log import FrameLog
+from kinectacq.video_io import FrameWriter
+from kinectacq.video_reader import VideoReader
+
+N_FRAMES = 20
+
+
+def _record_device(device_dir, close_log=True):
+    """depth in one video and ir in segments, with a frame log"""
+    device_dir.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    frames = {}
+    for stream, dtype, segment_frames in [("depth", np.uint16, None), ("ir", np.uint8, 8)]:
+        frames[stream] = rng.integers(0, np.iinfo(dtype).max, size=(N_FRAMES, 8, 8), dtype=dtype)
+        writer = FrameWriter(
+            device_dir / "{}.avi".format(stream),
+            video_dtype=dtype,
+            pixel_format="gray16" if dtype == np.uint16 else "gray8",
+            codec="ffv1",
+            slices=1,
+            threads=1,
+            segment_frames=segment_frames,
+        )
+        writer.write(list(frames[stream]), list(range(N_FRAMES)))
+        writer.close()
+    log = FrameLog(device_dir / "frame_log.bin", ["depth", "ir"])
+    for i in range(N_FRAMES):
+        log.append(i * 1000, {"depth": i, "ir": i})
+    if close_log:
+        log.close()
+    else:
+        log.flush()
+    return frames
+
+
+@pytest.fixture
+def session(tmp_path, ffmpeg):
+    session = Path(tmp_path) / "2026-01-02_03-04-05"
+    frames = _record_device(session / "master")
+    return session, frames
+
+
+def test_settings():
+    assert is_lossless(archive_settings("gray16le"))
+    # 8-bit depth and IR are measurements too
+    assert is_lossless(archive_settings("gray"))
+    assert not is_lossless(archive_settings("yuv420p"))
+    assert is_lossless(["-c:v", "libx264", "-qp", "0"])
+
+
+def test_find_sessions(session):
+    session, _ = session
+    (session.parent / "notes").mkdir()
+    assert find_sessions([session.parent]) == [session]
+    assert find_sessions([session, session.parent]) == [session]
+
+
+def test_archive_and_delete(session):
+    session, frames = session
+    results = archive_sessions([session.parent], n_workers=2, threads=1, delete_source=True, verbose=False)
+    assert len(results) == 2
+    for record in results.values():
+        assert record["verified"] and record["lossless"] and record["frames_identical"]
+        assert record["expected_frames"] == N_FRAMES
+
+    device_dir = session / "master"
+    for stream in ["depth", "ir"]:
+        video = device_dir / "{}.avi".format(stream)
+        assert not video.exists() and not FrameIndex.path(video).exists()
+        assert is_archived(video)
+        with VideoReader(archive_path(video)) as reader:
+            np.testing.assert_array_equal(reader[:], frames[stream])
+        # the device timestamps move over to the archive
+        np.testing.assert_array_equal(
+            FrameIndex.load(archive_path(video), build=False).timestamps, np.arange(N_FRAMES)
+        )
+    # the ir segments and their manifest are gone too
+    assert sorted(path.name for path in device_dir.iterdir()) == [
+        "depth.archive.json",
+        "depth.archive.mkv",
+        "depth.archive.mkv.index.npz",
+        "frame_log.bin",
+        "ir.archive.json",
+        "ir.archive.mkv",
+        "ir.archive.mkv.index.npz",
+    ]
+    with open(session / "archive.json") as f:
+        assert set(json.load(f)) == {"master/depth.archive.json", "master/ir.archive.json"}
+
+
+def test_resumed(session):
+    session, _ = session
+    archive_sessions([session], n_workers=1, threads=1, verbose=False)
+    video = session / "master" / "depth.avi"
+    assert is_archived(video) and video.exists()
+    assert archive_sessions([session], n_workers=1, threads=1, verbose=False) == {}
+    # a changed record is archived again
+    with open(record_path(video)) as f:
+        record = json.load(f)
+    record["archive_bytes"] += 1
+    with open(record_path(video), "w") as f:
+        json.dump(record, f)
+    assert [str(video) for video, _ in session_jobs(session)] == [str(video)]
+
+
+def test_still_recording(tmp_path, ffmpeg):
+    session = Path(tmp_path) / "2026-01-02_03-04-05"
+    _record_device(session / "master", close_log=False)
+    frame_log = session / "master" / "frame_log.bin"
+    assert is_recording(frame_log)
+    assert session_jobs(session) == []
+    # a log that stopped changing long ago belongs to a crashed recording
+    stale = time.time() - 120
+    os.utime(frame_log, (stale, stale))
+    assert not is_recording(frame_log)
+    assert len(session_jobs(session)) == 2
@@ -0,0 +1,91 @@
+import numpy as np, pytest
+
+from kinectacq.capture import BufferPool, CaptureThread
+from kinectacq.simulation import SimulatedK4A
+
+
+def test_buffer_pool_recycles():
+    pool = BufferPool(np.int16, n_slots=2)
+    image = np.full((3, 4), 7, dtype=np.uint16)
+    first = pool.copy(image)
+    assert first.dtype == np.int16 and (first == 7).all()
+    second = pool.copy(image)
+    # both buffers are held, so the next image is allocated
+    third = pool.copy(image)
+    assert pool.n_misses == 1
+    assert not any(third is slot for slot in pool.slots)
+
+    # a buffer is free once nothing refers to it, views included
+    view = first[1:]
+    del first, third
+    pool.copy(image)
+    assert pool.n_misses == 2
+    del view
+    reused = pool.copy(image)
+    assert any(reused is slot for slot in pool.slots)
+    assert pool.n_misses == 2
+    del second
+
+
+def test_buffer_pool_other_shape():
+    pool = BufferPool(np.uint8, n_slots=2)
+    pool.copy(np.zeros((3, 4), dtype=np.uint8))
+    assert pool.copy(np.zeros((5, 4), dtype=np.uint8)).shape == (5, 4)
+    assert pool.n_misses == 1
+
+
+def test_capture_thread():
+    k4a = SimulatedK4A(fps=None, depth_shape=(8, 8), color_shape=(8, 8), seed=0)
+    k4a.start()
+    # captures queued, the one being copied and the one held fit in the pool
+    capture_thread = CaptureThread(
+        k4a, {"depth": np.int16, "ir": np.uint16}, n_slots=4, maxsize=2
+    )
+    capture_thread.start()
+    previous = 0
+    for _ in range(20):
+        system_ns, frames, timestamps = capture_thread.get(timeout=5)
+        assert set(frames) == {"depth", "ir"} and frames["depth"].dtype == np.int16
+        assert system_ns > 0 and timestamps["depth"] == timestamps["ir"] >= previous
+        previous = timestamps["depth"]
+        del frames
+    # stops although the queue is full
+    capture_thread.stop()
+    assert not capture_thread.is_alive()
+    assert capture_thread.n_misses == {"depth": 0, "ir": 0}
+
+
+def test_dropped_images():
+    k4a = SimulatedK4A(
+        fps=None, depth_shape=(8, 8), color_shape=(8, 8), drop_rate=1.0, drop_streams=("ir",)
+    )
+    k4a.start()
+    capture_thread = CaptureThread(k4a, {"depth": np.int16, "ir": np.uint16})
+    capture_thread.start()
+    _, frames, timestamps = capture_thread.get(timeout=5)
+    capture_thread.stop()
+    assert frames["ir"] is None and timestamps["ir"] == 0
+    assert frames["depth"] is not None
+
+
+class _Unplugged:
+    def __init__(self, n_captures):
+        self.k4a = SimulatedK4A(fps=None, depth_shape=(8, 8), color_shape=(8, 8))
+        self.k4a.start()
+        self.n_captures = n_captures
+
+    def get_capture(self):
+        if self.n_captures == 0:
+            raise OSError("device unplugged")
+        self.n_captures -= 1
+        return self.k4a.get_capture()
+
+
+def test_device_error():
+    capture_thread = CaptureThread(_Unplugged(3), {"depth": np.int16})
+    capture_thread.start()
+    for _ in range(3):
+        capture_thread.get(timeout=5)
+    # raised in the capture loop
+    with pytest.raises(OSError, match="unplugged"):
+        capture_thread.get(timeout=5)
@@ -0,0 +1,167 @@
+import numpy as np, pytest
+from datetime import datetime
+from pathlib2 import Path
+
+from kinectacq.catalog import SessionCatalog, summarize_device
+from kinectacq.frame_log import FrameLog
+from kinectacq.paths import most_recent_subdirectory
+
+N_FRAMES = 10
+
+
+def _record_device(device_dir, n_dropped=0, close_log=True):
+    """a frame log of N_FRAMES frames 0.1 s apart, with the first n_dropped
+    depth frames dropped, and a depth video of 1000 bytes
+    """
+    device_dir.mkdir(parents=True)
+    (device_dir / "depth.avi").write_bytes(b"\0" * 1000)
+    log = FrameLog(device_dir / "frame_log.bin", ["depth", "ir"])
+    for i in range(N_FRAMES):
+        log.append(i * 100_000_000, {"depth": i, "ir": i}, {"depth": i < n_dropped})
+    if close_log:
+        log.close()
+    else:
+        log.flush()
+
+
+def _record_session(parent, name, devices=("master",), n_dropped=0, close_log=True):
+    session = Path(parent) / name
+    for device in devices:
+        _record_device(session / device, n_dropped, close_log)
+    return session
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with SessionCatalog(Path(tmp_path) / "catalog" / "catalog.sqlite") as catalog:
+        yield catalog
+
+
+def test_summarize_device(tmp_path):
+    device_dir = Path(tmp_path) / "master"
+    _record_device(device_dir, n_dropped=2)
+    summary = summarize_device(device_dir)
+    assert summary["n_frames"] == N_FRAMES
+    assert summary["n_dropped"] == 2
+    assert summary["duration_s"] == pytest.approx(0.9)
+    assert not summary["is_writing"]
+    assert summary["start_time"] is not None
+    assert summary["streams"]["depth"] == {"n_frames": 8, "n_dropped": 2, "total_bytes": 1000}
+    assert summary["streams"]["ir"]["n_dropped"] == 0
+    assert set(summary["streams"]) == {"depth", "ir"}
+    assert summary["total_bytes"] > 1000
+
+
+def test_summarize_legacy_device(tmp_path):
+    device_dir = Path(tmp_path) / "master"
+    device_dir.mkdir()
+    np.save(device_dir / "system_timestamps.npy", np.arange(5) * 1_000_000_000)
+    np.save(device_dir / "depth_timestamps.npy", np.array([1, 2, 0, 4, 5]))
+    np.save(device_dir / "is_writing.npy", np.array([True]))
+    summary = summarize_device(device_dir)
+    assert summary["n_frames"] == 5
+    assert summary["duration_s"] == pytest.approx(4.0)
+    assert summary["is_writing"]
+    assert summary["start_time"] is None
+    assert summary["streams"]["depth"]["n_dropped"] == 1
+
+
+def test_summarize_without_recording(tmp_path):
+    assert summarize_device(Path(tmp_path)) is None
+
+
+def test_index_session(tmp_path, catalog):
+    session = _record_session(tmp_path, "2026-01-02_03-04-05", ["master", "sub1"], n_dropped=1)
+    (session / "notes").mkdir()
+    assert catalog.index_session(session)
+    assert len(catalog) == 1
+
+    details = catalog.details(session)
+    assert details["started_at"] == datetime(2026, 1, 2, 3, 4, 5).timestamp()
+    assert details["parent"] == str(Path(tmp_path).resolve())
+    assert details["n_devices"] == 2
+    assert details["n_frames"] == 2 * N_FRAMES
+    assert details["n_dropped"] == 2
+    # out of the frames of both streams of both devices
+    assert details["dropped_fraction"] == pytest.approx(2 / (4 * N_FRAMES))
+    assert not details["is_writing"]
+    assert set(details["devices"]) == {"master", "sub1"}
+    assert details["devices"]["sub1"]["streams"]["depth"]["total_bytes"] == 1000
+
+    # indexing again replaces the rows
+    assert catalog.index_session(session)
+    assert len(catalog) == 1
+    assert len(catalog.details(session)["devices"]) == 2
+    assert not catalog.index_session(session / "notes")
+    assert catalog.details(Path(tmp_path) / "missing") is None
+
+
+def test_update(tmp_path, catalog):
+    _record_session(tmp_path, "2026-01-01_00-00-00")
+    writing = _record_session(tmp_path, "2026-01-02_00-00-00", close_log=False)
+    (Path(tmp_path) / "2026-01-03_00-00-00").mkdir()  # nothing recorded
+    (Path(tmp_path) / "scratch").mkdir()
+    assert catalog.update(tmp_path) == 2
+    assert catalog.details(writing)["is_writing"]
+
+    # only the session still being written is read again
+    assert catalog.update(tmp_path) == 1
+    assert catalog.update(tmp_path, rescan=True) == 2
+    assert len(catalog) == 2
+
+
+def test_queries(tmp_path, catalog):
+    names = ["2026-01-01_00-00-00", "2026-01-02_00-00-00", "2026-01-03_00-00-00"]
+    _record_session(tmp_path, names[0], ["master"])
+    _record_session(tmp_path, names[1], ["master", "sub1"], n_dropped=5)
+    _record_session(tmp_path / "other", names[2], ["sub1"])
+    catalog.update(tmp_path)
+    catalog.update(tmp_path / "other")
+
+    def names_of(sessions):
+        return [Path(session["path"]).name for session in sessions]
+
+    assert names_of(catalog.most_recent(n=2)) == [names[2], names[1]]
+    assert names_of(catalog.most_recent(parent=tmp_path)) == [names[1]]
+    assert names_of(catalog.between(names[1])) == names[1:]
+    assert names_of(catalog.between(end="2026-01-02T00:00:00")) == names[:1]
+    assert names_of(catalog.between(datetime(2026, 1, 1), parent=tmp_path)) == names[:2]
+    assert names_of(catalog.with_drops(0.01)) == [names[1]]
+    assert names_of(catalog.with_device("sub1")) == [names[2], names[1]]
+    assert names_of(catalog.query("n_devices = ?", (2,))) == [names[1]]
+    assert len(catalog.query(limit=1)) == 1
+
+
+def test_sync(tmp_path, catalog):
+    old = _record_session(tmp_path, "2026-01-01_00-00-00")
+    catalog.update(tmp_path)
+    for path in sorted(old.glob("*/*")):
+        path.unlink()
+    for path in [old / "master", old]:
+        path.rmdir()
+    new = _record_session(tmp_path, "2026-01-02_00-00-00")
+    assert catalog.sync(tmp_path) == 1
+    assert [session["path"] for session in catalog.query()] == [str(new.resolve())]
+    assert catalog.remove_missing() == 0
+
+
+def test_most_recent_subdirectory(tmp_path):
+    _record_session(tmp_path, "2026-01-01_00-00-00")
+    newest = _record_session(tmp_path, "2026-01-02_00-00-00")
+    # named like a session, but not a directory
+    (Path(tmp_path) / "2026-01-03_00-00-00").write_text("")
+    (Path(tmp_path) / "scratch").mkdir()
+    catalog_path = Path(tmp_path) / "catalog.sqlite"
+    assert str(most_recent_subdirectory(tmp_path)) == str(newest)
+    assert not catalog_path.exists()
+
+    assert str(most_recent_subdirectory(tmp_path, catalog=catalog_path)) == str(newest)
+    with SessionCatalog(catalog_path) as catalog:
+        assert catalog.most_recent(parent=tmp_path)[0]["path"] == str(newest.resolve())
+        assert len(catalog) == 2
+
+
+def test_most_recent_subdirectory_without_sessions(tmp_path):
+    (Path(tmp_path) / "scratch").mkdir()
+    with pytest.raises(FileNotFoundError):
+        most_recent_subdirectory(tmp_path)
@@ -0,0 +1,57 @@
+import numpy as np, pytest
+
+from kinectacq.chunked import ChunkedReader, ChunkedWriter, available_codecs
+from kinectacq.frame_index import FrameIndex
+
+N_FRAMES = 100
+CHUNK_FRAMES = 32
+
+
+def write_frames(path, codec=None, n_frames=N_FRAMES, shape=(24, 32)):
+    """Random 16-bit frames, written in batches of 7 (a partial last block)"""
+    frames = np.random.default_rng(0).integers(
+        -(2 ** 15), 2 ** 15, size=(n_frames,) + shape, dtype=np.int16
+    )
+    writer = ChunkedWriter(path / "round_trip", chunk_frames=CHUNK_FRAMES, codec=codec)
+    for start in range(0, n_frames, 7):
+        writer.write(list(frames[start : start + 7]), range(start, start + 7))
+    writer.close()
+    return frames, writer.filename
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_round_trip(tmp_path, codec):
+    frames, filename = write_frames(tmp_path, codec)
+    with ChunkedReader(filename) as reader:
+        assert len(reader) == N_FRAMES
+        assert reader.dtype == frames.dtype
+        for frame in [0, CHUNK_FRAMES - 1, CHUNK_FRAMES, N_FRAMES - 1, -1]:
+            np.testing.assert_array_equal(reader[frame], frames[frame])
+        for key in [
+            slice(None),
+            slice(CHUNK_FRAMES - 3, CHUNK_FRAMES + 3),
+            slice(None, None, 5),
+            slice(-4, None),
+        ]:
+            np.testing.assert_array_equal(reader[key], frames[key])
+        fancy = [N_FRAMES - 1, 0, CHUNK_FRAMES, 3, CHUNK_FRAMES]
+        np.testing.assert_array_equal(reader[fancy], frames[fancy])
+        np.testing.assert_array_equal(reader[np.array(fancy)], frames[fancy])
+
+
+def test_timestamps_indexed(tmp_path):
+    _, filename = write_frames(tmp_path)
+    index = FrameIndex.load(filename, build=False)
+    np.testing.assert_array_equal(index.timestamps, np.arange(N_FRAMES))
+
+
+def test_unfinished_file(tmp_path):
+    """A file cut off while writing is read up to its last complete block"""
+    frames, filename = write_frames(tmp_path)
+    with ChunkedReader(filename) as reader:
+        last_chunk = reader.index[-1]
+    with open(filename, "r+b") as f:
+        f.truncate(int(last_chunk["offset"]) + int(last_chunk["size"]) // 2)
+    with ChunkedReader(filename) as reader:
+        assert len(reader) == int(last_chunk["first_frame"])
+        np.testing.assert_array_equal(reader[:], frames[: len(reader)])
@@ -0,0 +1,123 @@
+import asyncio, json, time, numpy as np, pytest
+from pathlib2 import Path
+
+from kinectacq.catalog import SessionCatalog
+from kinectacq.controller import DeviceStatus, RecordingController
+from kinectacq.frame_log import load_frame_log
+
+from test_acquisition import simulated_device
+
+
+def _controller(tmp_path, backend="null", catalog=False):
+    devices = {"master": simulated_device(0), "subordinate": simulated_device(1, "SUBORDINATE")}
+    return RecordingController(
+        devices,
+        warmup=0.1,
+        catalog=catalog,
+        writer_workers="thread",
+        depth_write_frames_kwargs={"backend": backend},
+        ir_write_frames_kwargs={"backend": backend},
+    )
+
+
+def _wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_device_status():
+    status = DeviceStatus()
+    assert status.as_dict() == {
+        "state": "starting",
+        "n_frames": 0,
+        "n_dropped": 0,
+        "elapsed_s": 0.0,
+        "fps": 0.0,
+    }
+    status.set_state("recording")
+    time.sleep(0.1)
+    status.update(4, 1)
+    as_dict = status.as_dict()
+    assert as_dict["state"] == "recording"
+    assert (as_dict["n_frames"], as_dict["n_dropped"]) == (4, 1)
+    assert as_dict["elapsed_s"] >= 0.1
+    assert as_dict["fps"] == pytest.approx(3 / as_dict["elapsed_s"], rel=0.01)
+    status.set_state("finished")
+    assert status.state == "finished"
+
+
+def test_unknown_settings():
+    with pytest.raises(TypeError, match="depth_fps"):
+        RecordingController({"master": simulated_device(0)}, depth_fps=30)
+
+
+def test_start_stop_status(tmp_path):
+    session_dir = Path(tmp_path) / "2026-01-02_03-04-05"
+    catalog_path = Path(tmp_path) / "catalog.sqlite"
+    with _controller(tmp_path, "raw", catalog_path) as controller:
+        assert controller.status() == {} and not controller.is_recording
+        controller.start(session_dir)
+        _wait_for(
+            lambda: all(
+                status["state"] == "recording" and status["n_frames"] >= 5
+                for status in controller.status().values()
+            )
+        )
+        assert controller.is_recording
+        with pytest.raises(RuntimeError):
+            controller.start(Path(tmp_path) / "2026-01-02_03-04-06")
+
+        controller.stop()
+        _wait_for(lambda: not controller.is_recording)
+        assert controller.wait(timeout=20)
+        status = controller.status()
+        # the catalog is updated once every device has finished
+        with SessionCatalog(catalog_path) as catalog:
+            assert catalog.details(session_dir)["n_devices"] == 2
+
+    for device_name in ["master", "subordinate"]:
+        assert status[device_name]["state"] == "finished"
+        assert status[device_name]["exitcode"] == 0
+        frames, metadata = load_frame_log(session_dir / device_name / "frame_log.bin")
+        assert not metadata["is_writing"]
+        assert len(frames) == status[device_name]["n_frames"]
+        depth = np.load(session_dir / device_name / "depth.npy")
+        assert depth.shape == (len(frames), 16, 16)
+
+
+def test_next_session_while_writing(tmp_path):
+    """A session started once the previous one's duration is over waits for its
+    cameras to stop, and both are written
+    """
+    with _controller(tmp_path) as controller:
+        first = controller.start(Path(tmp_path) / "first", 0.3)
+        time.sleep(0.35)
+        second = controller.start(Path(tmp_path) / "second", 0.3)
+        assert first.cameras_released
+        # devices are only warmed up before the first session
+        startup = json.loads((Path(tmp_path) / "second" / "master" / "startup.json").read_text())
+        assert startup["warmup_s"] < 0.1
+        assert controller.wait(timeout=20)
+    for session in [first, second]:
+        assert all(status["state"] == "finished" for status in session.status().values())
+
+
+def test_record_async(tmp_path):
+    catalog_path = Path(tmp_path) / "catalog.sqlite"
+
+    async def record(controller):
+        statuses = []
+        for name in ["2026-01-01_00-00-00", "2026-01-01_00-00-01"]:
+            statuses.append(await controller.record_async(Path(tmp_path) / name, 0.3))
+        await controller.wait_async()
+        return statuses
+
+    with _controller(tmp_path, catalog=catalog_path) as controller:
+        statuses = asyncio.run(record(controller))
+    for status in statuses:
+        assert all(device["state"] in ["finalizing", "finished"] for device in status.values())
+        assert all(device["n_frames"] > 0 for device in status.values())
+    with SessionCatalog(catalog_path) as catalog:
+        assert len(catalog) == 2
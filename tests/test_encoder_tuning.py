@@ -0,0 +1,122 @@
+import json, numpy as np, pytest
+
+from kinectacq.encoder_tuning import (
+    candidate_settings,
+    fit_range_map,
+    load_profile,
+    recorded_frames,
+    select_profile,
+    tune_encoders,
+)
+from kinectacq.range_mapping import RangeMap
+from kinectacq.video_io import FrameWriter
+
+SMALL_GRID = {"codec": ["ffv1", "h264"], "slices": [4], "threads": [1], "crf": [0, 22]}
+
+
+def test_candidate_settings():
+    candidates = candidate_settings(SMALL_GRID)
+    # crf only matters for h264
+    assert candidates == [
+        {"codec": "ffv1", "slices": 4, "threads": 1, "crf": 0},
+        {"codec": "h264", "slices": 4, "threads": 1, "crf": 0},
+        {"codec": "h264", "slices": 4, "threads": 1, "crf": 22},
+    ]
+
+
+def test_fit_range_map():
+    frames = np.zeros((2, 100, 10), dtype=np.uint16)
+    # zeros are invalid pixels, and are left out
+    frames[:, :, :5] = np.arange(100)[:, None] * 10 + 500
+    range_map = fit_range_map(frames, percentiles=(0, 100))
+    assert (range_map.settings["low"], range_map.settings["high"]) == (500, 1490)
+    np.testing.assert_array_equal(
+        fit_range_map(frames.view(np.int16), percentiles=(0, 100)).lut, range_map.lut
+    )
+    assert fit_range_map(np.zeros((1, 2, 2), np.uint16)).settings["high"] == 65535
+
+
+def _result(dtype, codec, fps, size, cpu):
+    return {
+        "settings": {"codec": codec},
+        "video_dtype": dtype,
+        "encode_fps": fps,
+        "bytes_per_frame": size,
+        "cpu_ms_per_frame": cpu,
+    }
+
+
+def test_select_profile():
+    results = {
+        "depth": [
+            _result("uint16", "ffv1-fast", 100, 5000, 10),
+            _result("uint16", "ffv1-small", 60, 4000, 20),
+            _result("uint16", "ffv1-slow", 40, 3000, 30),
+            _result("uint8", "h264", 500, 100, 1),
+        ]
+    }
+    choice, sustainable = select_profile(results, fps=30, cpu_budget=1000)
+    # the most precise pixel format, then the smallest that keeps up
+    assert choice["depth"]["settings"]["codec"] == "ffv1-small" and sustainable
+    # 4 cameras need 20 ms * 30 fps * 4 = 240% of a core, a budget of 150% does not fit
+    choice, sustainable = select_profile(results, fps=30, n_cameras=4, cpu_budget=150)
+    assert choice["depth"]["settings"]["codec"] == "ffv1-fast" and sustainable
+    choice, sustainable = select_profile(results, fps=30, n_cameras=4, cpu_budget=50)
+    assert not sustainable
+    with pytest.raises(ValueError):
+        select_profile(results, fps=400)
+
+
+def test_tune_and_load(tmp_path, ffmpeg):
+    profile = tune_encoders(
+        tmp_path / "profile.json",
+        streams=("depth", "ir"),
+        n_frames=10,
+        grid=SMALL_GRID,
+        video_dtypes={"depth": ["uint8"], "ir": ["uint16"]},
+        headroom=0,
+        cpu_budget=10 ** 6,
+        verbose=False,
+    )
+    assert len(profile["results"]["depth"]) == 3 and len(profile["results"]["ir"]) == 1
+    depth = profile["streams"]["depth"]
+    assert depth["video_dtype"] == "uint8" and depth["range_map"] is not None
+    assert profile["streams"]["ir"]["range_map"] is None
+
+    kwargs = load_profile(tmp_path / "profile.json")
+    assert kwargs["depth_dtype"] is np.uint8 and kwargs["ir_dtype"] is np.uint16
+    assert isinstance(kwargs["depth_function"], RangeMap)
+    assert kwargs["depth_function"].settings["low"] == depth["range_map"]["low"]
+    assert "ir_function" not in kwargs
+    assert kwargs["depth_write_frames_kwargs"] == depth["write_frames_kwargs"]
+
+    # a function passed in replaces the profile's mapping
+    range_map = RangeMap(0, 1000)
+    assert load_profile(tmp_path / "profile.json", depth_function=range_map)["depth_function"] is range_map
+
+    depth["range_map"] = None
+    with open(tmp_path / "profile.json", "w") as f:
+        json.dump(profile, f)
+    with pytest.raises(ValueError):
+        load_profile(tmp_path / "profile.json")
+
+
+def test_recorded_in_segments(tmp_path, ffmpeg):
+    frames = np.random.default_rng(0).integers(0, 2 ** 16, size=(25, 8, 8), dtype=np.uint16)
+    writer = FrameWriter(
+        tmp_path / "depth.avi",
+        video_dtype=np.uint16,
+        pixel_format="gray16",
+        codec="ffv1",
+        slices=1,
+        threads=1,
+        segment_frames=10,
+    )
+    writer.write(list(frames))
+    writer.close()
+    assert not (tmp_path / "depth.avi").exists()
+    np.testing.assert_array_equal(
+        recorded_frames(tmp_path, n_frames=15, streams=("depth",))["depth"], frames[:15]
+    )
+    with pytest.raises(FileNotFoundError):
+        recorded_frames(tmp_path, streams=("ir",))
@@ -0,0 +1,69 @@
+import os, numpy as np, pytest
+
+from kinectacq.frame_index import FrameIndex, build_frame_index
+from kinectacq.video_io import FrameWriter, get_number_of_frames
+
+
+def test_from_recording():
+    index = FrameIndex.from_recording(4, 20, timestamps=[5, 6, 7, 8])
+    assert len(index) == 4
+    np.testing.assert_allclose(index.pts_time, [0, 0.05, 0.1, 0.15])
+    np.testing.assert_array_equal(index.keyframe, [True, False, False, False])
+    assert index.timestamps.dtype == np.uint64
+    assert FrameIndex.from_recording(3, 30, intra_only=True).keyframe.all()
+    np.testing.assert_array_equal(FrameIndex.from_recording(3, 30).timestamps, 0)
+
+
+def test_keyframes_and_seeking():
+    keyframe = np.zeros(10, dtype=bool)
+    keyframe[[0, 4, 8]] = True
+    index = FrameIndex(np.arange(10) / 10, keyframe)
+    assert [index.keyframe_before(frame) for frame in [0, 3, 4, 7, 9]] == [0, 0, 4, 4, 8]
+    assert index.seek_time(0) == 0
+    # a quarter of a frame before the keyframe
+    assert index.seek_time(4) == pytest.approx(0.375)
+
+
+def test_save_and_load(tmp_path):
+    video = tmp_path / "depth.avi"
+    video.write_bytes(b"")
+    assert FrameIndex.load(video, build=False) is None
+    FrameIndex.from_recording(5, 30, timestamps=np.arange(5) * 33333).save(FrameIndex.path(video))
+    assert FrameIndex.path(video).name == "depth.avi.index.npz"
+    index = FrameIndex.load(video, build=False)
+    np.testing.assert_array_equal(index.timestamps, np.arange(5) * 33333)
+    np.testing.assert_array_equal(index.keyframe, [True] + [False] * 4)
+
+    # an index older than its video is out of date
+    mtime = os.path.getmtime(video)
+    os.utime(FrameIndex.path(video), (mtime - 10, mtime - 10))
+    assert FrameIndex.load(video, build=False) is None
+
+
+def test_built_from_video(tmp_path, ffmpeg):
+    """Videos recorded without an index are probed once, and their index saved"""
+    video = tmp_path / "depth.avi"
+    writer = FrameWriter(
+        video, video_dtype=np.uint16, pixel_format="gray16", codec="ffv1", slices=1, threads=1
+    )
+    writer.write([np.full((8, 8), i, dtype=np.uint16) for i in range(12)], list(range(12)))
+    writer.close()
+    recorded = FrameIndex.load(video, build=False)
+
+    pts_time, keyframe = build_frame_index(video)
+    # ffprobe prints times to the microsecond
+    np.testing.assert_allclose(pts_time, recorded.pts_time, atol=1e-6)
+    assert keyframe[0]
+
+    FrameIndex.path(video).unlink()
+    assert get_number_of_frames(video) == 12
+    built = FrameIndex.load(video, build=False)
+    np.testing.assert_allclose(built.pts_time, recorded.pts_time, atol=1e-6)
+    # device timestamps are only known at record time
+    np.testing.assert_array_equal(built.timestamps, 0)
+
+
+def test_not_a_video(tmp_path, ffmpeg):
+    (tmp_path / "depth.avi").write_bytes(b"not a video")
+    with pytest.raises(IOError):
+        build_frame_index(tmp_path / "depth.avi")
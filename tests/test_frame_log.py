@@ -0,0 +1,73 @@
+import os, numpy as np, pytest
+
+from kinectacq.frame_log import FrameLog, is_writing, load_frame_log
+
+
+def _log(tmp_path, chunk_size=4):
+    return FrameLog(
+        tmp_path / "frame_log.bin",
+        ["depth", "ir"],
+        metadata={"samplerate": 30},
+        chunk_size=chunk_size,
+    )
+
+
+def _append(log, n, start=0):
+    for i in range(start, start + n):
+        log.append(1000 + i, {"depth": 100 * i, "ir": 100 * i}, {"ir": i == 2})
+
+
+def test_flushed_in_chunks(tmp_path):
+    log = _log(tmp_path)
+    _append(log, 3)
+    frames, metadata = load_frame_log(log.path)
+    # nothing is written until the chunk fills up
+    assert len(frames) == 0
+    assert metadata["is_writing"] and is_writing(log.path)
+    assert metadata["streams"] == ["depth", "ir"] and metadata["samplerate"] == 30
+
+    _append(log, 6, start=3)
+    frames, _ = load_frame_log(log.path)
+    np.testing.assert_array_equal(frames["frame"], np.arange(8))
+    log.flush()
+    frames, _ = load_frame_log(log.path)
+    assert len(frames) == 9
+
+    log.close()
+    frames, metadata = load_frame_log(log.path)
+    assert not metadata["is_writing"] and not is_writing(log.path)
+    np.testing.assert_array_equal(frames["system_ns"], 1000 + np.arange(9))
+    np.testing.assert_array_equal(frames["depth_timestamp_usec"], 100 * np.arange(9))
+    np.testing.assert_array_equal(np.flatnonzero(frames["ir_dropped"]), [2])
+    assert not frames["depth_dropped"].any()
+    assert (log.first_system_ns, log.last_system_ns) == (1000, 1008)
+
+
+def test_dropped_after_capture(tmp_path):
+    log = _log(tmp_path)
+    _append(log, 6)
+    # dropped by a queue after the frames were logged
+    log.mark_dropped("depth", [100, 500])
+    log.close()
+    frames, _ = load_frame_log(log.path)
+    assert len(frames) == 6
+    np.testing.assert_array_equal(np.flatnonzero(frames["depth_dropped"]), [1, 5])
+    np.testing.assert_array_equal(np.flatnonzero(frames["ir_dropped"]), [2])
+
+
+def test_crash(tmp_path):
+    """A log that was never closed, whose last record was cut off"""
+    log = _log(tmp_path)
+    _append(log, 10)
+    log._file.close()
+    os.truncate(log.path, os.path.getsize(log.path) - log.dtype.itemsize // 2)
+    frames, metadata = load_frame_log(log.path)
+    assert metadata["is_writing"]
+    # the last two frames were still in memory, and the one before was cut off
+    np.testing.assert_array_equal(frames["frame"], np.arange(7))
+
+
+def test_not_a_frame_log(tmp_path):
+    np.save(tmp_path / "timestamps.npy", np.zeros(10))
+    with pytest.raises(ValueError):
+        load_frame_log(tmp_path / "timestamps.npy")
@@ -0,0 +1,82 @@
+import time, numpy as np, pytest
+
+from kinectacq.preprocessing import PreprocessStage, apply_functions
+from kinectacq.telemetry import Telemetry, load_telemetry
+
+
+def halve(frame):
+    # later frames finish first, so results come back out of order
+    time.sleep(0.002 * (10 - int(frame[0, 0]) % 10))
+    return frame // 2
+
+
+def fail(frame):
+    raise ValueError("bad frame")
+
+
+def _captures(n):
+    for i in range(n):
+        frames = {
+            "depth": np.full((2, 2), 2 * i, dtype=np.uint16),
+            "ir": np.full((2, 2), i, dtype=np.uint16),
+            "color": None,
+        }
+        yield frames, {"depth": i, "ir": i, "color": 0}
+
+
+def test_apply_functions():
+    frames, durations = apply_functions(
+        {"depth": (np.uint8, halve), "ir": (np.float32, None)},
+        {"depth": np.full((2, 2), 300, dtype=np.uint16), "ir": np.ones((2, 2), np.uint16), "color": None},
+    )
+    # cast, then passed through the function
+    assert frames["depth"].dtype == np.uint8 and frames["depth"][0, 0] == 22
+    assert frames["ir"].dtype == np.float32
+    assert frames["color"] is None
+    assert list(durations) == ["depth_function"]
+
+
+@pytest.mark.parametrize("workers", ["inline", "thread", "process"])
+def test_delivered_in_order(workers):
+    delivered = []
+    stage = PreprocessStage(
+        {"depth": (np.uint16, halve), "ir": (np.uint16, None)},
+        lambda frames, timestamps: delivered.append((frames, timestamps)),
+        workers=workers,
+        n_workers=3,
+    )
+    for frames, timestamps in _captures(20):
+        stage.put(frames, timestamps)
+    stage.close(verbose=False)
+    assert [timestamps["depth"] for _, timestamps in delivered] == list(range(20))
+    for i, (frames, _) in enumerate(delivered):
+        assert frames["depth"][0, 0] == i and frames["ir"][0, 0] == i
+        assert frames["color"] is None
+    assert stage.timings["depth_function"].n == 20
+
+
+def test_error_raised_on_next_put():
+    stage = PreprocessStage({"depth": (np.uint16, fail)}, lambda *args: None, workers="thread")
+    frames, timestamps = next(_captures(1))
+    stage.put(frames, timestamps)
+    stage.close(verbose=False)
+    with pytest.raises(ValueError):
+        stage.put(frames, timestamps)
+
+
+def test_telemetry(tmp_path):
+    telemetry = Telemetry(tmp_path / "telemetry_capture.jsonl")
+    stage = PreprocessStage(
+        {"depth": (np.uint16, halve)}, lambda *args: None, workers="thread", telemetry=telemetry
+    )
+    for frames, timestamps in _captures(5):
+        stage.put(frames, timestamps)
+    stage.close(verbose=False)
+    telemetry.close(verbose=False)
+    _, summary = load_telemetry(tmp_path / "telemetry_capture.jsonl")
+    assert summary["stages"]["depth_function"]["n"] == 5
+
+
+def test_unknown_workers():
+    with pytest.raises(ValueError):
+        PreprocessStage({}, lambda *args: None, workers="gpu")
@@ -0,0 +1,132 @@
+import queue, threading, numpy as np, pytest
+
+from kinectacq.queues import FrameQueue, StreamRouter
+
+
+def frame(i):
+    return (np.full((2, 2), i, dtype=np.uint16),)
+
+
+def drain(frame_queue):
+    items = []
+    while True:
+        try:
+            items.append(frame_queue.get(block=False))
+        except queue.Empty:
+            return items
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FrameQueue(queue.Queue(), policy="drop_all")
+
+
+def test_block():
+    frame_queue = FrameQueue(queue.Queue(maxsize=3), policy="block")
+    for i in range(3):
+        assert frame_queue.put(frame(i), timestamp=i)
+    assert [item[0][0, 0] for item in drain(frame_queue)] == [0, 1, 2]
+    assert frame_queue.n_dropped == 0
+
+
+def test_drop_newest():
+    frame_queue = FrameQueue(queue.Queue(maxsize=2), policy="drop_newest", maxsize=2)
+    results = [frame_queue.put(frame(i), timestamp=100 + i) for i in range(4)]
+    assert results == [True, True, False, False]
+    assert frame_queue.dropped_timestamps == [102, 103]
+    assert frame_queue.fill() == 1.0
+    assert [item[0][0, 0] for item in drain(frame_queue)] == [0, 1]
+
+
+def test_drop_oldest():
+    frame_queue = FrameQueue(queue.Queue(maxsize=2), policy="drop_oldest")
+    for i in range(4):
+        assert frame_queue.put(frame(i), timestamp=100 + i)
+    assert frame_queue.dropped_timestamps == [100, 101]
+    assert [item[0][0, 0] for item in drain(frame_queue)] == [2, 3]
+    assert frame_queue.last_timestamp == 103
+
+
+class _StuckQueue:
+    """Full queue that a consumer empties as soon as it has room"""
+
+    def __init__(self):
+        self.put_kwargs = []
+
+    def put(self, item, block=True, **put_kwargs):
+        self.put_kwargs.append(put_kwargs)
+        raise queue.Full
+
+    def get(self, block=True):
+        raise queue.Empty
+
+
+def test_drop_oldest_gives_up():
+    """A queue that stays full drops the new frame instead of spinning"""
+    stuck = _StuckQueue()
+    frame_queue = FrameQueue(stuck, policy="drop_oldest")
+    assert not frame_queue.put(frame(0), timestamp=7, timeout=1)
+    assert frame_queue.dropped_timestamps == [7]
+    assert stuck.put_kwargs == [{"timeout": 1}, {"timeout": 1}]
+
+
+def test_spill(tmp_path):
+    frame_queue = FrameQueue(queue.Queue(maxsize=2), policy="spill", spill_dir=tmp_path)
+    for i in range(5):
+        assert frame_queue.put(frame(i), timestamp=i)
+    assert frame_queue.n_spilled == 3
+    assert frame_queue.qsize() == 5
+    assert len(list(tmp_path.iterdir())) == 3
+
+    # spilled frames reach the consumer in order, as room is made
+    values = []
+    for i in range(5):
+        values.append(frame_queue.get(block=False)[0][0, 0])
+        frame_queue.put(frame(5 + i), timestamp=5 + i)
+
+    def consume():
+        while True:
+            item = frame_queue.get(timeout=5)
+            if len(item) == 0:
+                return
+            values.append(item[0][0, 0])
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    # the end of the recording waits for every spilled frame
+    frame_queue.put(tuple())
+    consumer.join()
+    assert values == list(range(10))
+    assert frame_queue.n_dropped == 0
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_end_marker_is_never_dropped():
+    frame_queue = FrameQueue(queue.Queue(maxsize=2), policy="drop_newest")
+    frame_queue.put(frame(0))
+    frame_queue.put(frame(1))
+    with pytest.raises(queue.Full):
+        frame_queue.put(tuple(), timeout=0.01)
+    frame_queue.get(block=False)
+    assert frame_queue.put(tuple())
+    assert frame_queue.n_dropped == 0
+
+
+def test_router_sheds_least_important_first():
+    router = StreamRouter(priority=("depth", "ir", "color"))
+    for stream in ["depth", "ir", "color"]:
+        router.add(stream, FrameQueue(queue.Queue(maxsize=4), policy="drop_newest", maxsize=4))
+    assert router.threshold("depth") == np.inf
+    assert router.threshold("color") < router.threshold("ir")
+
+    frames = {stream: frame(0)[0] for stream in router.queues}
+    for i in range(4):
+        router.put(frames, {stream: i for stream in router.queues})
+    # color is shed above half full (the 4th frame), ir above three quarters
+    assert router.queues["color"].qsize() == 3
+    assert router.queues["ir"].qsize() == 4
+    assert router.queues["depth"].qsize() == 4
+    assert router.pop_dropped() == {"color": [3]}
+    router.put(frames, {stream: 4 for stream in router.queues})
+    assert router.pop_dropped() == {"color": [4], "ir": [4], "depth": [4]}
+    assert router.pop_dropped() == {}
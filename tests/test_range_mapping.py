@@ -0,0 +1,50 @@
+import pickle, numpy as np, pytest
+
+from kinectacq.range_mapping import RangeMap, make_lut
+
+
+def test_linear():
+    lut = make_lut(1000, 2000)
+    assert lut.shape == (65536,) and lut.dtype == np.uint8
+    assert [lut[0], lut[1000], lut[1500], lut[2000], lut[65535]] == [0, 0, 128, 255, 255]
+    assert (np.diff(lut.astype(int)) >= 0).all()
+
+
+def test_window_and_invert():
+    lut = make_lut(400, 800, mapping="window", invert=True)
+    assert [lut[399], lut[400], lut[800], lut[801]] == [0, 255, 0, 0]
+    assert lut[600] == 128
+
+
+def test_gamma():
+    lut = make_lut(0, 1000, mapping="gamma", gamma=0.5)
+    assert lut[250] == round(0.5 * 255)
+    assert make_lut(0, 1000, dtype=np.uint16)[1000] == 65535
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        make_lut(mapping="log")
+    with pytest.raises(ValueError):
+        make_lut(1000, 1000)
+
+
+def test_range_map():
+    frame = np.random.default_rng(0).integers(0, 3000, size=(8, 10), dtype=np.uint16)
+    range_map = RangeMap(500, 2500)
+    expected = np.round(np.clip((frame.astype(float) - 500) / 2000, 0, 1) * 255).astype(np.uint8)
+    np.testing.assert_array_equal(range_map(frame), expected)
+    # depth after the int16 cast in capture_from_azure
+    np.testing.assert_array_equal(range_map(frame.astype(np.int16)), expected)
+
+    downsampled = range_map.downsampled(2)
+    assert downsampled.lut is range_map.lut
+    np.testing.assert_array_equal(downsampled(frame), expected[::2, ::2])
+    np.testing.assert_array_equal(downsampled.downsampled(2)(frame), expected[::4, ::4])
+
+
+def test_pickle():
+    range_map = pickle.loads(pickle.dumps(RangeMap(0, 1000, mapping="gamma", gamma=0.5)))
+    assert range_map.settings["gamma"] == 0.5
+    np.testing.assert_array_equal(range_map.lut, make_lut(0, 1000, mapping="gamma", gamma=0.5))
+    assert "mapping=gamma" in repr(range_map)
@@ -0,0 +1,65 @@
+import os, threading, pytest
+
+from kinectacq.resources import apply_threads, available_cores, plan_cores, set_affinity
+
+STREAMS = ["depth", "ir", "color"]
+
+
+def _stream_cores(plan):
+    return [
+        stream_plan["cores"]
+        for device_plan in plan.values()
+        for stream_plan in device_plan["streams"].values()
+    ]
+
+
+def test_plan_with_room():
+    plan = plan_cores(
+        {"master": STREAMS, "subordinate": STREAMS}, cores=range(16), n_preprocess=2
+    )
+    assert plan["master"]["capture"] == [1] and plan["subordinate"]["capture"] == [2]
+    assert plan["master"]["preprocess"] == [3, 4]
+    assert plan["subordinate"]["preprocess"] == [5, 6]
+    stream_cores = _stream_cores(plan)
+    assigned = [core for cores in stream_cores for core in cores]
+    # every core but the reserved one is used once
+    assert sorted(assigned) == list(range(7, 16))
+    for device_plan in plan.values():
+        for stream_plan in device_plan["streams"].values():
+            assert stream_plan["threads"] == len(stream_plan["cores"]) >= 1
+        # color costs the most to encode
+        assert device_plan["streams"]["color"]["threads"] >= 2
+
+
+def test_plan_oversubscribed():
+    plan = plan_cores({"master": STREAMS}, cores=range(4), n_preprocess=2)
+    # too few cores for a capture core of its own, the sets overlap
+    assert plan["master"]["capture"] == [1]
+    assert plan["master"]["preprocess"] == [1, 2, 3]
+    assert _stream_cores(plan) == [[1], [2], [3]]
+    plan = plan_cores({"master": STREAMS, "subordinate": STREAMS}, cores=range(3))
+    assert all(len(cores) == 1 for cores in _stream_cores(plan))
+
+
+def test_apply_threads():
+    assert apply_threads({"codec": "ffv1", "threads": 6}, 2) == {"codec": "ffv1", "threads": 2}
+    assert apply_threads({"backend": "chunked"}, 3) == {"backend": "chunked", "n_threads": 3}
+    assert apply_threads({"backend": "raw"}, 3) == {"backend": "raw"}
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="needs sched_getaffinity")
+def test_set_affinity():
+    results = []
+
+    def pin():
+        # pins only this thread
+        results.append(set_affinity(available_cores()[:1]))
+        results.append(os.sched_getaffinity(0))
+        results.append(set_affinity([10 ** 6]))
+
+    before = os.sched_getaffinity(0)
+    thread = threading.Thread(target=pin)
+    thread.start()
+    thread.join()
+    assert results == [True, set(available_cores()[:1]), False]
+    assert os.sched_getaffinity(0) == before
@@ -0,0 +1,102 @@
+import numpy as np, pytest
+
+from kinectacq.frame_index import FrameIndex
+from kinectacq.segments import (
+    closed_segments,
+    concatenate_segments,
+    load_manifest,
+    manifest_path,
+    process_segments,
+    save_manifest,
+)
+from kinectacq.video_io import FrameWriter, get_number_of_frames
+from kinectacq.video_reader import VideoReader
+
+N_FRAMES = 25
+
+
+def _writer(filename, **kwargs):
+    return FrameWriter(
+        filename,
+        video_dtype=np.uint16,
+        pixel_format="gray16",
+        codec="ffv1",
+        slices=1,
+        threads=1,
+        **kwargs
+    )
+
+
+@pytest.fixture
+def recording(tmp_path, ffmpeg):
+    """depth.avi recorded in segments of 10 frames"""
+    frames = np.random.default_rng(0).integers(0, 2 ** 16, size=(N_FRAMES, 8, 8), dtype=np.uint16)
+    writer = _writer(tmp_path / "depth.avi", segment_frames=10, max_batch=4)
+    writer.write(list(frames[:12]), list(range(1000, 1012)))
+    # the second segment is still being written
+    manifest = load_manifest(tmp_path / "depth.avi")
+    assert not manifest["finished"]
+    assert [segment["closed"] for segment in manifest["segments"]][-1:] == [False]
+    writer.write(list(frames[12:]), list(range(1012, 1000 + N_FRAMES)))
+    writer.close()
+    return tmp_path / "depth.avi", frames
+
+
+def test_manifest(recording):
+    video, frames = recording
+    assert not video.exists()
+    manifest = load_manifest(video)
+    assert load_manifest(manifest_path(video)) == manifest
+    assert manifest["finished"] and manifest["segment_frames"] == 10
+    segments = manifest["segments"]
+    assert [segment["filename"] for segment in segments] == [
+        "depth_0000.avi",
+        "depth_0001.avi",
+        "depth_0002.avi",
+    ]
+    assert [segment["first_frame"] for segment in segments] == [0, 10, 20]
+    assert [segment["n_frames"] for segment in segments] == [10, 10, 5]
+    assert [segment["first_timestamp_usec"] for segment in segments] == [1000, 1010, 1020]
+    assert segments[-1]["last_timestamp_usec"] == 1024
+    for segment, first in zip(closed_segments(video), [0, 10, 20]):
+        with VideoReader(segment) as reader:
+            np.testing.assert_array_equal(reader[:], frames[first : first + 10])
+            np.testing.assert_array_equal(
+                reader.index.timestamps, 1000 + np.arange(first, first + len(reader))
+            )
+
+
+def test_segment_seconds(tmp_path):
+    writer = _writer(tmp_path / "ir.avi", segment_seconds=0.5, fps=30)
+    assert writer.segment_frames == 15
+
+
+def test_concatenate(recording):
+    video, frames = recording
+    assert str(concatenate_segments(video, remove=True)) == str(video)
+    with VideoReader(video) as reader:
+        np.testing.assert_array_equal(reader[:], frames)
+    index = FrameIndex.load(video, build=False)
+    np.testing.assert_array_equal(index.timestamps, 1000 + np.arange(N_FRAMES))
+    np.testing.assert_allclose(index.pts_time, np.arange(N_FRAMES) / 30)
+    assert sorted(path.name for path in video.parent.iterdir()) == [
+        "depth.avi",
+        "depth.avi.index.npz",
+    ]
+
+
+def test_concatenate_unfinished(recording):
+    video, _ = recording
+    manifest = load_manifest(video)
+    manifest["segments"][-1]["closed"] = False
+    save_manifest(video, manifest)
+    with pytest.raises(ValueError):
+        concatenate_segments(video)
+    with pytest.raises(FileNotFoundError):
+        concatenate_segments(video.parent / "ir.avi")
+
+
+def test_process_segments(recording):
+    video, _ = recording
+    results = process_segments(video, get_number_of_frames, n_workers=2, poll_interval=0.1)
+    assert results == [10, 10, 5]
@@ -0,0 +1,129 @@
+import queue, numpy as np, pytest
+from multiprocessing import Process, Queue
+
+from kinectacq.shared_memory import FrameMailbox, FrameRingBuffer
+
+
+def template():
+    return (np.zeros((4, 6), dtype=np.int16), np.zeros((4, 6), dtype=np.uint8))
+
+
+def frames(i):
+    return (np.full((4, 6), -i, dtype=np.int16), np.full((4, 6), i, dtype=np.uint8))
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRingBuffer(template(), n_slots=4)
+    yield ring
+    ring.close()
+
+
+def test_put_get_in_order(ring):
+    for i in range(3):
+        ring.put(frames(i), timestamps=(100 + i, 200 + i))
+    assert ring.qsize() == 3
+    for i in range(3):
+        got, seq, timestamps = ring.get(block=False, with_header=True)
+        assert seq == i
+        assert list(timestamps) == [100 + i, 200 + i]
+        for frame, expected in zip(got, frames(i)):
+            np.testing.assert_array_equal(frame, expected)
+        ring.release()
+    assert ring.qsize() == 0
+    with pytest.raises(queue.Empty):
+        ring.get(block=False)
+
+
+def test_full_until_released(ring):
+    for i in range(4):
+        ring.put(frames(i))
+    with pytest.raises(queue.Full):
+        ring.put(frames(4), block=False)
+    ring.get(block=False)
+    # the slot is read in place, so it is only free once released
+    with pytest.raises(queue.Full):
+        ring.put(frames(4), block=False)
+    ring.release()
+    ring.put(frames(4), block=False)
+
+
+def test_dropped_frames_and_end_of_stream(ring):
+    ring.put((None, frames(1)[1]))
+    ring.put(tuple())
+    depth, ir = ring.get(block=False)
+    assert depth is None
+    np.testing.assert_array_equal(ir, frames(1)[1])
+    assert ring.get(block=False) == tuple()
+
+
+def _consume(ring, results):
+    while True:
+        got = ring.get(timeout=10)
+        if len(got) == 0:
+            break
+        results.put(int(got[1][0, 0]))
+        ring.release()
+    ring.close()
+    results.put(None)
+
+
+def test_across_processes(ring):
+    results = Queue()
+    consumer = Process(target=_consume, args=(ring, results))
+    consumer.start()
+    # more frames than slots, so the producer waits for the consumer
+    for i in range(20):
+        ring.put(frames(i), timeout=10)
+    ring.put(tuple(), timeout=10)
+    received = []
+    for value in iter(lambda: results.get(timeout=10), None):
+        received.append(value)
+    consumer.join(10)
+    assert received == list(range(20))
+
+
+@pytest.fixture
+def mailbox():
+    mailbox = FrameMailbox(max_bytes=1024)
+    yield mailbox
+    mailbox.close()
+
+
+def test_mailbox_newest_frame(mailbox):
+    assert mailbox.get() is None
+    for i in range(3):
+        mailbox.put(np.full((4, 6), i, dtype=np.uint16), timestamp=100 + i)
+    frame, timestamp = mailbox.get()
+    assert timestamp == 102 and frame.dtype == np.uint16
+    np.testing.assert_array_equal(frame, np.full((4, 6), 2))
+    # nothing new since the last call
+    assert mailbox.get() is None
+
+
+def test_mailbox_downsamples_large_frames(mailbox):
+    frame = np.arange(40 * 60, dtype=np.uint16).reshape(40, 60)
+    mailbox.put(frame)
+    np.testing.assert_array_equal(mailbox.get()[0], frame[::2, ::2][::2, ::2])
+
+
+def test_mailbox_being_written(mailbox):
+    mailbox.put(np.zeros((2, 2), dtype=np.uint8))
+    # a writer is part way through replacing the frame
+    mailbox.header["seq"] += 1
+    assert mailbox.get() is None
+
+
+def _put_and_close(mailbox):
+    mailbox.put(np.full((3, 3), 7, dtype=np.uint8), timestamp=5)
+    mailbox.close()
+
+
+def test_mailbox_across_processes(mailbox):
+    writer = Process(target=_put_and_close, args=(mailbox,))
+    writer.start()
+    writer.join(10)
+    frame, timestamp = mailbox.get()
+    assert timestamp == 5 and frame[0, 0] == 7
+    # freed here, by the process that created it
+    mailbox.close()
@@ -0,0 +1,128 @@
+import json, numpy as np, pytest
+from pathlib2 import Path
+
+from kinectacq.benchmark import (
+    DEFAULT_CONFIGURATIONS,
+    _write_rate,
+    compare_results,
+    run_configuration,
+)
+from kinectacq.simulation import SimulatedK4A
+
+
+def test_not_started():
+    with pytest.raises(RuntimeError):
+        SimulatedK4A().get_capture()
+
+
+def test_synthetic_frames():
+    k4a = SimulatedK4A(
+        config={"depth_mode": "WFOV_2X2BINNED", "color_resolution": "RES_720P"}, fps=None
+    )
+    k4a.start()
+    capture = k4a.get_capture()
+    assert capture.depth.shape == (512, 512) and capture.depth.dtype == np.uint16
+    assert capture.ir.shape == (512, 512)
+    assert capture.color.shape == (720, 1280, 4) and capture.color.dtype == np.uint8
+    # the color camera is offset from depth
+    assert capture._color_timestamp_usec == capture._depth_timestamp_usec + 180
+
+
+def test_paced_timestamps():
+    k4a = SimulatedK4A(fps=100, depth_shape=(8, 8), color_shape=(8, 8))
+    k4a.start()
+    timestamps = [k4a.get_capture()._depth_timestamp_usec for _ in range(5)]
+    np.testing.assert_array_equal(np.diff(timestamps), 10000)
+    assert k4a.device_clock() >= timestamps[-1]
+
+
+def test_drops_and_skips():
+    k4a = SimulatedK4A(
+        fps=None,
+        depth_shape=(8, 8),
+        color_shape=(8, 8),
+        drop_rate=1.0,
+        drop_streams=("ir",),
+        skip_rate=0.5,
+        seed=0,
+    )
+    k4a.start()
+    captures = [k4a.get_capture() for _ in range(50)]
+    assert all(capture.ir is None for capture in captures)
+    assert all(capture._ir_timestamp_usec == 0 for capture in captures)
+    assert all(capture.depth is not None for capture in captures)
+    assert 0 < k4a.n_skipped < 50
+    assert k4a.n_captures == 50
+
+
+def test_source(tmp_path):
+    depth = np.arange(3 * 4 * 5, dtype=np.uint16).reshape(3, 4, 5)
+    np.savez(tmp_path / "source.npz", depth=depth, ir=depth + 1)
+    k4a = SimulatedK4A(fps=None, source=tmp_path / "source.npz")
+    k4a.start()
+    captures = [k4a.get_capture() for _ in range(4)]
+    assert k4a.depth_shape == (4, 5)
+    # played back in a loop
+    np.testing.assert_array_equal(captures[0].depth, depth[1])
+    np.testing.assert_array_equal(captures[2].depth, depth[0])
+    np.testing.assert_array_equal(captures[2].ir, depth[0] + 1)
+    assert captures[0].color is None
+
+
+def test_calibration(tmp_path):
+    SimulatedK4A(device_id=3, depth_shape=(8, 10)).save_calibration_json(
+        tmp_path / "calibration.json"
+    )
+    with open(tmp_path / "calibration.json") as f:
+        calibration = json.load(f)
+    assert calibration["simulated"] and calibration["device_id"] == 3
+    assert calibration["depth_shape"] == [8, 10]
+
+
+def test_write_rate():
+    samples = [
+        {"time": t, "counters": {"frames_written": n}}
+        for t, n in [(0, 0), (1, 10), (2, 40), (3, 70), (4, 70), (5, 70)]
+    ]
+    assert _write_rate(samples) == 30
+    assert _write_rate(samples[:2]) is None
+    assert _write_rate([{"time": 0, "counters": {}}]) is None
+
+
+def test_compare_results():
+    def results(fps, age):
+        return {
+            "results": [
+                {
+                    "name": "queue_process",
+                    "n_cameras": 1,
+                    "save_color": False,
+                    "max_sustainable_fps": fps,
+                    "fps_written": 30,
+                    "frame_age_p99_us": age,
+                    "cpu_percent_per_camera": None,
+                }
+            ]
+        }
+
+    assert compare_results(results(200, 1000), results(190, 1050)) == []
+    regressions = compare_results(results(200, 1000), results(150, 2000))
+    assert [regression["metric"] for regression in regressions] == [
+        "max_sustainable_fps",
+        "frame_age_p99_us",
+    ]
+
+
+def test_run_configuration(tmp_path):
+    """A short recording from a simulated camera through the null writers"""
+    result = run_configuration(
+        Path(tmp_path),
+        DEFAULT_CONFIGURATIONS["null_process"],
+        recording_duration=2,
+        simulation_kwargs={"depth_shape": (32, 32), "color_shape": (32, 32)},
+    )
+    camera = result["cameras"][0]
+    assert set(camera["frames_written"]) == {"depth", "ir"}
+    assert camera["frames_captured"] > 30
+    assert min(camera["frames_written"].values()) > 30
+    assert 20 < result["fps_written"] < 40
@@ -0,0 +1,88 @@
+import queue, time, numpy as np
+
+from kinectacq.queues import FrameQueue
+from kinectacq.telemetry import Histogram, Telemetry, load_telemetry
+from kinectacq.video_io import write_stream
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for duration_us in [10] * 98 + [1000, 5000]:
+        histogram.add(duration_us)
+    summary = histogram.summary()
+    assert summary["n"] == 100
+    assert summary["max_us"] == 5000
+    # percentiles are the upper edge of their bin, within a quarter doubling
+    assert 10 <= summary["p50_us"] < 10 * 2 ** 0.25
+    assert 1000 <= summary["p99_us"] < 1000 * 2 ** 0.25
+    assert summary["mean_us"] == round((98 * 10 + 6000) / 100, 1)
+
+
+def test_samples_and_summary(tmp_path):
+    path = tmp_path / "telemetry_depth.jsonl"
+    telemetry = Telemetry(path, interval=3600)
+    depth = [3]
+
+    def broken():
+        raise RuntimeError
+
+    telemetry.gauge("queue_depth", function=lambda: depth[0])
+    telemetry.gauge("broken", function=broken)
+    telemetry.gauge("n_devices", 2)
+    t0 = time.perf_counter_ns()
+    telemetry.record("get_capture", t0)
+    telemetry.record_duration("get_capture", 40000)
+    telemetry.count("frames_written", 16)
+    # not due yet
+    telemetry.maybe_sample()
+    telemetry.sample()
+    depth[0] = 5
+    telemetry.record_duration("pipe_write", 100)
+    telemetry.count("frames_written", 4)
+    telemetry.close(verbose=False)
+    telemetry.close(verbose=False)
+
+    samples, summary = load_telemetry(path)
+    assert len(samples) == 2
+    first, last = samples
+    assert first["stages"]["get_capture"]["n"] == 2
+    assert first["gauges"] == {"queue_depth": 3, "broken": None, "n_devices": 2}
+    assert first["counters"] == {"frames_written": 16}
+    assert "self" in first["processes"]
+    # stages are reset after every sample, counters are not
+    assert last["stages"]["get_capture"]["n"] == 0
+    assert last["stages"]["pipe_write"]["n"] == 1
+    assert last["gauges"]["queue_depth"] == 5
+    assert last["counters"] == {"frames_written": 20}
+    assert summary["stages"]["get_capture"]["n"] == 2
+    assert summary["stages"]["get_capture"]["max_us"] == 40000
+    assert summary["counters"] == {"frames_written": 20}
+
+
+def test_unfinished(tmp_path):
+    path = tmp_path / "telemetry_depth.jsonl"
+    telemetry = Telemetry(path)
+    telemetry.count("frames_written")
+    telemetry.sample()
+    samples, summary = load_telemetry(path)
+    assert len(samples) == 1 and summary is None
+
+
+def test_write_stream(tmp_path):
+    stream_queue = FrameQueue(queue.Queue())
+    for i in range(10):
+        stream_queue.put((np.zeros((2, 2), dtype=np.uint16),), timestamp=1000 * i)
+    stream_queue.put(tuple())
+    write_stream(
+        stream_queue,
+        tmp_path / "depth.avi",
+        video_dtype=np.uint16,
+        write_frames_kwargs={"backend": "null"},
+        telemetry_path=tmp_path / "telemetry_depth.jsonl",
+        device_clock=lambda: 20000,
+    )
+    _, summary = load_telemetry(tmp_path / "telemetry_depth.jsonl")
+    assert summary["counters"]["frames_written"] == 10
+    assert summary["stages"]["frame_age"]["max_us"] == 20000
+    assert {"dequeue", "pipe_write"} <= set(summary["stages"])
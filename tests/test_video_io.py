@@ -0,0 +1,155 @@
+import queue, threading, numpy as np, pytest
+
+from kinectacq.chunked import ChunkedWriter
+from kinectacq.frame_index import FrameIndex
+from kinectacq.queues import FrameQueue, StreamRouter
+from kinectacq.video_io import (
+    FrameWriter,
+    NullWriter,
+    RawWriter,
+    make_writer,
+    write_stream,
+)
+from kinectacq.video_reader import VideoReader
+
+SHAPE = (16, 24)
+
+
+def _frames(n, dtype=np.uint16, shape=SHAPE, seed=0):
+    return np.random.default_rng(seed).integers(
+        0, np.iinfo(dtype).max, size=(n,) + shape, dtype=dtype
+    )
+
+
+def _ffv1_writer(filename, **kwargs):
+    kwargs = dict(
+        dict(video_dtype=np.uint16, pixel_format="gray16", codec="ffv1", slices=1, threads=1),
+        **kwargs
+    )
+    return FrameWriter(filename, **kwargs)
+
+
+def test_frame_writer_batches(tmp_path, ffmpeg):
+    frames = _frames(23)
+    writer = _ffv1_writer(tmp_path / "depth.avi", max_batch=4)
+    # batches larger and smaller than max_batch, with skipped frames
+    writer.write([frames[0], None, frames[1], frames[2]], [0, 1, 2, 3])
+    buffer = writer.buffer
+    writer.write(list(frames[3:13]), list(range(4, 14)))
+    writer.write([None, None], [14, 15])
+    writer.write(list(frames[13:]), list(range(16, 26)))
+    # the batch buffer is allocated once
+    assert writer.buffer is buffer
+    assert buffer.shape == (4,) + SHAPE
+    assert writer.n_frames_written == 23
+    writer.close()
+
+    with VideoReader(tmp_path / "depth.avi") as reader:
+        np.testing.assert_array_equal(reader[:], frames)
+    timestamps = FrameIndex.load(tmp_path / "depth.avi", build=False).timestamps
+    np.testing.assert_array_equal(timestamps, [0, 2, 3] + list(range(4, 14)) + list(range(16, 26)))
+
+
+def test_frame_writer_color(tmp_path, ffmpeg):
+    # BGRA color frames, of which the alpha channel is dropped
+    frames = _frames(5, np.uint8, SHAPE + (4,))
+    writer = FrameWriter(
+        tmp_path / "color.avi",
+        pixel_format="bgr24",
+        codec="ffv1",
+        slices=1,
+        threads=1,
+        max_batch=2,
+    )
+    writer.write(list(frames))
+    writer.close()
+    with VideoReader(tmp_path / "color.avi", pixel_format="bgr24") as reader:
+        np.testing.assert_array_equal(reader[:], frames[..., :3])
+
+
+def test_frame_writer_without_frames(tmp_path):
+    writer = _ffv1_writer(tmp_path / "depth.avi")
+    writer.write([None, None])
+    writer.close()
+    assert writer.pipe is None and writer.n_frames_written == 0
+    assert not (tmp_path / "depth.avi").exists()
+
+
+def test_write_stream_per_stream(tmp_path):
+    """Each stream is drained from its own queue by its own writer"""
+    depth, ir = _frames(40), _frames(40, seed=1)
+    router = StreamRouter(priority=("depth", "ir"))
+    workers = []
+    for stream in ["depth", "ir"]:
+        stream_queue = FrameQueue(queue.Queue(), name=stream)
+        router.add(stream, stream_queue)
+        workers.append(
+            threading.Thread(
+                target=write_stream,
+                args=(stream_queue, tmp_path / "{}.avi".format(stream)),
+                kwargs=dict(
+                    video_dtype=np.uint16,
+                    write_frames_kwargs={"backend": "raw", "grow_frames": 16},
+                    max_batch=8,
+                ),
+            )
+        )
+    for worker in workers:
+        worker.start()
+    for i in range(40):
+        # the device dropped depth frame 5
+        router.put(
+            {"depth": None if i == 5 else depth[i], "ir": ir[i]},
+            {"depth": 1000 * i, "ir": 1000 * i + 1},
+        )
+    router.close()
+    for worker in workers:
+        worker.join(timeout=10)
+        assert not worker.is_alive()
+
+    kept = [i for i in range(40) if i != 5]
+    np.testing.assert_array_equal(np.load(tmp_path / "depth.npy"), depth[kept])
+    np.testing.assert_array_equal(np.load(tmp_path / "ir.npy"), ir)
+    timestamps = FrameIndex.load(tmp_path / "depth.npy", build=False).timestamps
+    np.testing.assert_array_equal(timestamps, 1000 * np.array(kept))
+
+
+def test_raw_writer(tmp_path):
+    frames = _frames(11)
+    writer = make_writer(tmp_path / "depth.avi", backend="raw", video_dtype=np.uint16, grow_frames=4)
+    assert isinstance(writer, RawWriter)
+    writer.write(list(frames[:6]), list(range(6)))
+    # readable while recording, up to the last block the file grew by
+    np.testing.assert_array_equal(np.load(tmp_path / "depth.npy"), frames[:4])
+    writer.write([None] + list(frames[6:]), list(range(5, 11)))
+    writer.close()
+
+    saved = np.load(tmp_path / "depth.npy")
+    np.testing.assert_array_equal(saved, frames)
+    assert (tmp_path / "depth.npy").stat().st_size == 128 + frames.nbytes
+    timestamps = FrameIndex.load(tmp_path / "depth.npy", build=False).timestamps
+    np.testing.assert_array_equal(timestamps, list(range(6)) + list(range(6, 11)))
+
+
+def test_raw_writer_color(tmp_path):
+    frames = _frames(3, np.uint8, SHAPE + (4,))
+    writer = RawWriter(tmp_path / "color.avi")
+    writer.write(list(frames))
+    writer.close()
+    np.testing.assert_array_equal(np.load(tmp_path / "color.npy"), frames[..., :3])
+
+
+def test_null_writer(tmp_path):
+    writer = make_writer(tmp_path / "depth.avi", backend="null", video_dtype=np.uint16)
+    assert isinstance(writer, NullWriter)
+    writer.write([_frames(1)[0], None, _frames(1)[0]])
+    writer.close()
+    assert writer.n_frames_written == 2
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_make_writer(tmp_path):
+    assert isinstance(make_writer(tmp_path / "depth.avi"), FrameWriter)
+    assert isinstance(make_writer(tmp_path / "depth.avi", backend="chunked"), ChunkedWriter)
+    with pytest.raises(ValueError):
+        make_writer(tmp_path / "depth.avi", backend="tape")
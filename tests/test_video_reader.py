@@ -0,0 +1,183 @@
+import numpy as np, pytest
+
+from kinectacq.frame_index import FrameIndex
+from kinectacq.video_io import FrameWriter
+from kinectacq.video_reader import (
+    VideoReader,
+    VideoStream,
+    close_decoder,
+    iter_session,
+    open_decoder,
+    read_into,
+    read_video_parallel,
+    time_single_decoder,
+)
+
+N_FRAMES = 150
+SHAPE = (16, 24)
+ORDER = [70, 3, 149, 16, 15, 100, 0]
+
+
+@pytest.fixture(params=["ffv1", "h264"])
+def video(request, tmp_path, ffmpeg):
+    """A recorded video, and every frame decoded in one pass without seeking"""
+    codec = request.param
+    dtype = np.uint16 if codec == "ffv1" else np.uint8
+    frames = np.random.default_rng(0).integers(
+        0, np.iinfo(dtype).max, size=(N_FRAMES,) + SHAPE, dtype=dtype
+    )
+    filename = tmp_path / "{}.avi".format(codec)
+    writer = FrameWriter(
+        filename,
+        video_dtype=dtype,
+        pixel_format="gray16" if codec == "ffv1" else "gray8",
+        codec=codec,
+        crf=0,
+        fps=30,
+        slices=1,
+        slicecrc=1,
+        threads=1,
+    )
+    writer.write(list(frames), list(range(N_FRAMES)))
+    writer.close()
+
+    with VideoReader(filename) as reader:
+        decoded = np.empty(reader.shape, dtype=reader.dtype)
+        pixel_format = reader.pixel_format
+    pipe = open_decoder(filename, pixel_format, threads=1)
+    assert read_into(pipe, decoded) == decoded.nbytes
+    close_decoder(pipe)
+    if codec == "ffv1":
+        np.testing.assert_array_equal(decoded, frames)
+    return filename, decoded
+
+
+@pytest.mark.parametrize("probe", [False, True])
+def test_random_access(video, probe):
+    filename, decoded = video
+    if probe:
+        # built from the video's packets instead of saved while recording
+        FrameIndex.path(filename).unlink()
+    with VideoReader(filename, chunk_size=16) as reader:
+        assert len(reader) == N_FRAMES
+        np.testing.assert_array_equal(reader[ORDER], decoded[ORDER])
+        np.testing.assert_array_equal(reader[-1], decoded[-1])
+        np.testing.assert_array_equal(reader[10:60:7], decoded[10:60:7])
+        np.testing.assert_array_equal(reader[:], decoded)
+        with pytest.raises(IndexError):
+            reader[N_FRAMES]
+
+
+def test_sidecar_index(video):
+    filename, _ = video
+    index = FrameIndex.load(filename, build=False)
+    assert len(index) == N_FRAMES
+    np.testing.assert_array_equal(index.timestamps, np.arange(N_FRAMES))
+    assert index.keyframe_before(100) <= 100
+
+
+def test_stream_from_start_frame(video):
+    filename, decoded = video
+    stream = VideoStream(filename, chunk_size=32, start=45, stop=140, prefetch=False)
+    # chunks are only valid until the next is decoded
+    chunks = [(first, frames.copy()) for first, frames in stream]
+    assert [first for first, _ in chunks] == [45, 77, 109]
+    for first, frames in chunks:
+        np.testing.assert_array_equal(frames, decoded[first : first + len(frames)])
+    assert sum(len(frames) for _, frames in chunks) == 95
+
+
+def test_stream_prefetch(video):
+    filename, decoded = video
+    n_frames = 0
+    for first, frames in VideoStream(filename, chunk_size=20, prefetch=True):
+        np.testing.assert_array_equal(frames, decoded[first : first + len(frames)])
+        n_frames += len(frames)
+    assert n_frames == N_FRAMES
+
+
+def _write_ffv1(filename, frames):
+    writer = FrameWriter(
+        filename,
+        video_dtype=np.uint16,
+        pixel_format="gray16",
+        codec="ffv1",
+        slices=1,
+        threads=1,
+    )
+    writer.write(list(frames))
+    writer.close()
+
+
+def test_iter_session(tmp_path, ffmpeg):
+    rng = np.random.default_rng(1)
+    frames = {}
+    for device, n_frames in [("master", 40), ("subordinate", 37)]:
+        (tmp_path / device).mkdir()
+        for stream in ["depth", "ir"]:
+            frames[device, stream] = rng.integers(
+                0, 2 ** 16, size=(n_frames,) + SHAPE, dtype=np.uint16
+            )
+            _write_ffv1(tmp_path / device / "{}.avi".format(stream), frames[device, stream])
+    # a device without ir is left out
+    (tmp_path / "broken").mkdir()
+    _write_ffv1(tmp_path / "broken" / "depth.avi", frames["master", "depth"])
+
+    first_frames = []
+    for first, chunks in iter_session(tmp_path, chunk_size=16):
+        first_frames.append(first)
+        assert set(chunks) == {"master", "subordinate"}
+        for device, device_chunks in chunks.items():
+            for stream, chunk in device_chunks.items():
+                expected = frames[device, stream][first : first + 16][: len(chunk)]
+                np.testing.assert_array_equal(chunk, expected)
+                # until the shortest video ends
+                assert len(chunk) == min(16, 37 - first)
+    assert first_frames == [0, 16, 32]
+
+
+@pytest.mark.parametrize("n_workers", [2, 3, 5])
+def test_read_video_parallel(video, n_workers):
+    filename, decoded = video
+    frames, stats = read_video_parallel(
+        filename, n_workers=n_workers, baseline_frames=50, verbose=False
+    )
+    np.testing.assert_array_equal(frames, decoded)
+    assert stats["n_workers"] == n_workers
+    assert stats["speedup"] == pytest.approx(stats["baseline_s"] / stats["elapsed_s"], rel=0.05)
+
+
+def test_read_video_parallel_segments(video):
+    """More segments than workers, decoded as workers free up"""
+    filename, decoded = video
+    frames, stats = read_video_parallel(
+        filename, n_workers=2, n_segments=7, baseline_frames=None, verbose=False
+    )
+    np.testing.assert_array_equal(frames, decoded)
+    assert stats["decode_s"] > 0
+    assert stats["parallelism"] == pytest.approx(stats["decode_s"] / stats["elapsed_s"], rel=0.05)
+    assert stats["fps"] == pytest.approx(N_FRAMES / stats["elapsed_s"], rel=0.05)
+
+
+def test_time_single_decoder(video):
+    filename, decoded = video
+    with VideoReader(filename) as reader:
+        pixel_format = reader.pixel_format
+    seconds, n_read = time_single_decoder(
+        filename, pixel_format, decoded.shape[1:], decoded.dtype, 30
+    )
+    assert n_read == 30 and seconds > 0
+    # more frames than the video has
+    _, n_read = time_single_decoder(
+        filename, pixel_format, decoded.shape[1:], decoded.dtype, N_FRAMES + 10
+    )
+    assert n_read == N_FRAMES
+
+
+def test_read_video_parallel_to_file(video, tmp_path):
+    filename, decoded = video
+    frames, stats = read_video_parallel(
+        filename, n_workers=2, out=tmp_path / "frames.npy", baseline_frames=0, verbose=False
+    )
+    np.testing.assert_array_equal(np.load(tmp_path / "frames.npy"), decoded)
+    assert stats["speedup"] is None
@@ -0,0 +1,34 @@
+import numpy as np
+
+from kinectacq.range_mapping import RangeMap
+from kinectacq.visualization import fit_tile, make_preview, to_bgr
+
+
+def test_make_preview():
+    frame = np.arange(8 * 12, dtype=np.uint16).reshape(8, 12)
+    np.testing.assert_array_equal(make_preview(downsample=2)(frame), frame[::2, ::2])
+    preview = make_preview(lambda frame: frame + 1, downsample=4)
+    np.testing.assert_array_equal(preview(frame), frame[::4, ::4] + 1)
+    # a RangeMap is fused with the downsampling
+    range_map = RangeMap(0, 95)
+    preview = make_preview(range_map, downsample=2)
+    assert isinstance(preview, RangeMap) and preview.lut is range_map.lut
+    np.testing.assert_array_equal(preview(frame), range_map(frame)[::2, ::2])
+
+
+def test_to_bgr():
+    gray = to_bgr(np.array([[0, 500], [1000, 250]], dtype=np.uint16))
+    assert gray.shape == (2, 2, 3) and gray.dtype == np.uint8
+    # scaled to its own range
+    assert gray[0, 0, 0] == 0 and gray[1, 0, 0] == 255
+    bgra = np.zeros((2, 2, 4), dtype=np.uint8)
+    bgra[..., 2] = 200
+    assert to_bgr(bgra).shape == (2, 2, 3) and (to_bgr(bgra)[..., 2] == 200).all()
+
+
+def test_fit_tile():
+    tile = np.full((100, 200, 3), 9, dtype=np.uint8)
+    fit_tile(np.full((50, 50, 3), 255, dtype=np.uint8), tile)
+    # centered, keeping the aspect ratio, with the rest blanked
+    assert (tile[:, 50:150] == 255).all()
+    assert (tile[:, :50] == 0).all() and (tile[:, 150:] == 0).all()